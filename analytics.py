@@ -0,0 +1,205 @@
+# ==========================================
+# NTU Marketplace - Partitioned Analytics
+# 後台報表的時間區間 / 篩選參數；大區間按月切段，
+# 各段在自己的池化連線上平行彙總，再由 server 合併
+# ==========================================
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from psycopg2.extras import RealDictCursor
+
+GRANULARITIES = ("day", "week", "month", "year")
+MAX_PARTITIONS = 120        # 最多切 10 年，避免一個請求佔滿 worker
+MAX_LIMIT = 100
+
+
+def parse_date(value, field):
+    if value in (None, ""):
+        return None
+    try:
+        return datetime.strptime(str(value), "%Y-%m-%d")
+    except ValueError:
+        raise ValueError(f"{field} 格式需為 YYYY-MM-DD")
+
+
+def month_start(d):
+    return datetime(d.year, d.month, 1)
+
+
+def next_month(d):
+    return datetime(d.year + d.month // 12, d.month % 12 + 1, 1)
+
+
+class Window:
+    """
+    報表參數：[start, end) 時間區間、週期粒度、賣家 / 分類篩選。
+    category_pattern 由呼叫端把 category_id 換成子樹的 LIKE pattern 後填入。
+    """
+
+    def __init__(self, start=None, end=None, granularity="month", seller=None,
+                 category_id=None, limit=None):
+        if granularity not in GRANULARITIES:
+            raise ValueError(f"granularity 需為 {', '.join(GRANULARITIES)} 之一")
+        if start is not None and end is not None and start >= end:
+            raise ValueError("start 需早於 end")
+
+        self.start = start
+        self.end = end
+        self.granularity = granularity
+        self.seller = seller
+        self.category_id = category_id
+        self.category_pattern = None
+        self.limit = max(1, min(limit, MAX_LIMIT)) if limit else None   # None：各報表自己的預設
+
+    @classmethod
+    def from_request(cls, req):
+        category_id = req.get("category_id", req.get("root_category_id"))
+        limit = req.get("limit")
+        try:
+            category_id = int(category_id) if category_id is not None else None
+            limit = int(limit) if limit else None
+        except (TypeError, ValueError):
+            raise ValueError("category_id / limit 需為整數")
+        return cls(
+            start=parse_date(req.get("start"), "start"),
+            end=parse_date(req.get("end"), "end"),
+            granularity=req.get("granularity") or "month",
+            seller=req.get("seller") or None,
+            category_id=category_id,
+            limit=limit,
+        )
+
+    @property
+    def filtered(self):
+        return any(v is not None for v in (self.start, self.end, self.seller, self.category_id))
+
+    # -------- 切段 --------
+    def partitions(self):
+        """有頭有尾的區間按月切；開放區間只能整段查"""
+        if self.start is None or self.end is None:
+            return [(self.start, self.end)]
+
+        ranges = []
+        lo = self.start
+        while lo < self.end:
+            hi = min(next_month(month_start(lo)), self.end)
+            ranges.append((lo, hi))
+            lo = hi
+        if len(ranges) > MAX_PARTITIONS:
+            raise ValueError(f"區間過長，最多 {MAX_PARTITIONS} 個月")
+        return ranges
+
+    # -------- SQL 片段 --------
+    def where(self, time_col, seller_col=None, path_col=None, order_col=None):
+        """
+        回傳接在 WHERE 後面的 AND 條件。時間用 %(lo)s / %(hi)s，由各段帶入。
+        分類篩選：有 path_col 直接比對，否則透過 order_col 檢查訂單內的商品。
+        """
+        conds = []
+        if self.start is not None:
+            conds.append(f"{time_col} >= %(lo)s")
+        if self.end is not None:
+            conds.append(f"{time_col} < %(hi)s")
+        if self.seller is not None and seller_col:
+            conds.append(f"{seller_col} = %(seller)s")
+        if self.category_pattern is not None:
+            if path_col:
+                conds.append(f"{path_col} LIKE %(path)s")
+            elif order_col:
+                conds.append(
+                    f"""EXISTS (
+                        SELECT 1 FROM order_items fi
+                        JOIN items fit ON fit.item_id=fi.item_id
+                        JOIN categories fc ON fc.category_id=fit.category_id
+                        WHERE fi.order_id={order_col} AND fc.path LIKE %(path)s
+                    )"""
+                )
+        return "".join(f" AND {c}" for c in conds)
+
+    def params(self, lo, hi):
+        return {
+            "lo": lo,
+            "hi": hi,
+            "seller": self.seller,
+            "path": self.category_pattern,
+            "granularity": self.granularity,
+        }
+
+    def describe(self, partitions):
+        return {
+            "start": self.start.date().isoformat() if self.start else None,
+            "end": self.end.date().isoformat() if self.end else None,
+            "granularity": self.granularity,
+            "seller": self.seller,
+            "category_id": self.category_id,
+            "partitions": partitions,
+        }
+
+
+class ParallelAggregator:
+    """
+    同一份部分彙總 SQL 在每個時間段各跑一次。
+    worker 數固定（所有 analytics 請求共用），所以額外佔用的連線數有上限。
+    """
+
+    def __init__(self, acquire, release, workers, statement_timeout_ms):
+        self._acquire = acquire
+        self._release = release
+        self.statement_timeout_ms = statement_timeout_ms
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="analytics")
+
+    def run(self, conn, sql, window):
+        """回傳 (所有段的 rows 串在一起, 段數)"""
+        ranges = window.partitions()
+        if len(ranges) == 1:
+            # 只有一段就直接用 handler 自己的連線
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(sql, window.params(*ranges[0]))
+                return cur.fetchall(), 1
+
+        futures = [
+            self._executor.submit(self._run_part, sql, window.params(lo, hi))
+            for lo, hi in ranges
+        ]
+        rows = []
+        try:
+            for f in futures:
+                rows.extend(f.result())
+        except Exception:
+            for f in futures:
+                f.cancel()
+            raise
+        return rows, len(ranges)
+
+    def _run_part(self, sql, params):
+        conn = self._acquire(read_only=True)
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("SET LOCAL statement_timeout = %s", (self.statement_timeout_ms,))
+                cur.execute(sql, params)
+                return cur.fetchall()
+        finally:
+            self._release(conn)
+
+
+# -------- 合併 --------
+def merge_rows(rows, keys, sums=(), maxes=()):
+    """依 keys 合併各段結果：sums 欄位相加、maxes 欄位取最大"""
+    merged = {}
+    for r in rows:
+        k = tuple(r[c] for c in keys)
+        m = merged.get(k)
+        if m is None:
+            merged[k] = dict(r)
+            continue
+        for c in sums:
+            m[c] += r[c]
+        for c in maxes:
+            if r[c] is not None and (m[c] is None or r[c] > m[c]):
+                m[c] = r[c]
+    return list(merged.values())
+
+
+def ratio(total, count, digits=2):
+    """AVG 不能直接平均各段的平均，要用合併後的 sum / count"""
+    return round(total / count, digits) if count else None
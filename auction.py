@@ -0,0 +1,480 @@
+# ==========================================
+# NTU Marketplace - Auction Engine
+# 出價只動記憶體裡的拍賣簿（每場一把鎖）並寫入 append-only WAL，
+# 不碰 Postgres；結標時才在一個交易內寫回 orders / auctions / auction_bids
+# ==========================================
+import json
+import os
+import threading
+import time
+from decimal import Decimal, InvalidOperation
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from outbox import emit_event
+
+WAL_PATH = "auction_wal.ndjson"
+CLOSE_INTERVAL = 0.5        # 秒，結標執行緒多久檢查一次
+SNIPE_WINDOW = 60           # 結標前幾秒內出價會觸發延長
+SNIPE_EXTENSION = 60        # 延長到「出價時間 + 幾秒」
+MAX_EXTENSION = 600         # 最多比原訂結標時間晚幾秒
+COMPACT_AFTER = 1000        # 已結標的 WAL 紀錄超過這個數量就重寫 WAL
+SETTLE_ATTEMPTS = 5         # 暫時性錯誤最多重試幾輪，之後一律以流標結算
+
+CENT = Decimal("0.01")
+MAX_AMOUNT = Decimal("9999999999.99")      # orders / auctions 金額欄位是 NUMERIC(12,2)
+
+
+class BidRejected(Exception):
+    pass
+
+
+def to_money(value):
+    try:
+        amount = Decimal(str(value)).quantize(CENT)
+    except (InvalidOperation, ValueError):
+        raise BidRejected("金額格式錯誤")
+    if not amount.is_finite() or amount <= 0:
+        raise BidRejected("金額需大於 0")
+    if amount > MAX_AMOUNT:
+        raise BidRejected(f"金額不可超過 {MAX_AMOUNT}")
+    return amount
+
+
+# ============================================================
+# Write-ahead log
+# ============================================================
+class BidLog:
+    """
+    append-only NDJSON。出價先 write 到 OS，回應前再 sync；
+    同時等待的多筆出價共用一次 fsync（group commit）。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()           # 保護檔案與 _written
+        self._sync_lock = threading.Lock()      # 同時只有一個 fsync
+        self._written = 0
+        self._synced = 0
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._f.write(line)
+            self._f.flush()
+            self._written += 1
+            return self._written
+
+    def sync(self, lsn):
+        if self._synced >= lsn:
+            return
+        with self._sync_lock:
+            if self._synced >= lsn:
+                return          # 別人的 fsync 已經涵蓋這一筆
+            with self._lock:
+                target = self._written
+                fd = self._f.fileno()
+            os.fsync(fd)
+            self._synced = target
+
+    def rewrite(self, records):
+        """壓縮：只留下進行中拍賣的紀錄。呼叫端需先鎖住所有拍賣簿。"""
+        with self._sync_lock, self._lock:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                for r in records:
+                    f.write(json.dumps(r, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._f.close()
+            os.replace(tmp, self.path)
+            self._f = open(self.path, "a", encoding="utf-8")
+            self._synced = self._written
+
+    def close(self):
+        with self._sync_lock, self._lock:
+            self._f.flush()
+            os.fsync(self._f.fileno())
+            self._f.close()
+
+    @staticmethod
+    def replay(path):
+        if not os.path.exists(path):
+            return
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    break       # 當機時寫到一半的最後一行
+
+
+# ============================================================
+# In-memory book
+# ============================================================
+class AuctionBook:
+    def __init__(self, auction_id, item_id, seller, start_price, min_increment, ends_at):
+        self.auction_id = auction_id
+        self.item_id = item_id
+        self.seller = seller
+        self.start_price = start_price
+        self.min_increment = min_increment
+        self.ends_at = ends_at                      # epoch 秒，防狙擊時往後延
+        self.hard_end = ends_at + MAX_EXTENSION
+        self.bids = []                              # [(seq, bidder, amount, ts)]
+        self.closed = False
+        self.settle_failures = 0
+        self.lock = threading.Lock()
+
+    @property
+    def high(self):
+        return self.bids[-1] if self.bids else None
+
+    def min_next(self):
+        high = self.high
+        return high[2] + self.min_increment if high else self.start_price
+
+    def apply(self, seq, bidder, amount, ts, ends_at):
+        self.bids.append((seq, bidder, amount, ts))
+        self.ends_at = ends_at
+
+    def snapshot(self):
+        high = self.high
+        return {
+            "auction_id": self.auction_id,
+            "item_id": self.item_id,
+            "seller_student_no": self.seller,
+            "status": "Closing" if self.closed else "Open",
+            "current_price": float(high[2]) if high else None,
+            "high_bidder": high[1] if high else None,
+            "min_next_bid": float(self.min_next()),
+            "bid_count": len(self.bids),
+            "seconds_left": max(0, round(self.ends_at - time.time(), 1)),
+        }
+
+
+# ============================================================
+# Engine
+# ============================================================
+class AuctionEngine:
+    def __init__(self, connect, wal_path=WAL_PATH):
+        self._connect = connect
+        self.wal_path = wal_path
+        self.wal = None
+        self._books = {}            # auction_id -> AuctionBook
+        self._books_lock = threading.Lock()
+        self._settled_records = 0
+        self._bidders = set()       # 已確認存在的 student_no，只增不減
+        self._stop = threading.Event()
+        self._thread = None
+
+    # -------- 啟動 / 復原 --------
+    def load(self):
+        """DB 的進行中拍賣 + WAL 重播 = 當機前的出價狀態"""
+        conn = self._connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT auction_id, item_id, seller_student_no, start_price, min_increment,
+                           EXTRACT(EPOCH FROM ends_at - NOW())
+                    FROM auctions
+                    WHERE status='Open'
+                """
+                )
+                rows = cur.fetchall()
+            conn.rollback()
+        finally:
+            conn.close()
+
+        now = time.time()
+        books = {
+            r[0]: AuctionBook(r[0], r[1], r[2], r[3], r[4], now + float(r[5]))
+            for r in rows
+        }
+
+        for rec in BidLog.replay(self.wal_path):
+            book = books.get(rec.get("auction_id"))
+            if rec.get("op") != "bid" or book is None:
+                continue
+            if rec["seq"] == len(book.bids) + 1:
+                book.apply(rec["seq"], rec["bidder"], Decimal(rec["amount"]), rec["ts"], rec["ends_at"])
+
+        with self._books_lock:
+            self._books = books
+        self.wal = BidLog(self.wal_path)
+        self.compact()
+
+    def open(self, auction_id, item_id, seller, start_price, min_increment, seconds):
+        """create_auction commit 之後呼叫"""
+        book = AuctionBook(auction_id, item_id, seller, Decimal(start_price),
+                           Decimal(min_increment), time.time() + seconds)
+        with self._books_lock:
+            self._books[auction_id] = book
+        return book.snapshot()
+
+    def _book(self, auction_id):
+        with self._books_lock:
+            return self._books.get(auction_id)
+
+    # -------- 出價 --------
+    def _check_bidder(self, bidder):
+        """寫進 WAL 前確認出價者存在，否則結標時才發現會卡住整場；查過的快取起來"""
+        if not isinstance(bidder, str) or not bidder:
+            raise BidRejected("需指定 student_no")
+        if bidder in self._bidders:
+            return
+        conn = self._connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1 FROM users WHERE student_no=%s", (bidder,))
+                found = cur.fetchone() is not None
+            conn.rollback()
+        finally:
+            conn.close()
+        if not found:
+            raise BidRejected("出價者不存在")
+        self._bidders.add(bidder)
+
+    def place_bid(self, auction_id, bidder, amount):
+        amount = to_money(amount)
+        book = self._book(auction_id)
+        if book is None:
+            raise BidRejected("拍賣不存在或已結標")
+        if bidder == book.seller:
+            raise BidRejected("賣家不能對自己的拍賣出價")
+        self._check_bidder(bidder)
+
+        with book.lock:
+            now = time.time()
+            if book.closed or now >= book.ends_at:
+                raise BidRejected("拍賣已結束")
+            need = book.min_next()
+            if amount < need:
+                raise BidRejected(f"出價需至少 {need}")
+
+            # 防狙擊：最後 SNIPE_WINDOW 秒內出價就往後延，但不超過 hard_end
+            ends_at = book.ends_at
+            if ends_at - now < SNIPE_WINDOW:
+                ends_at = min(max(ends_at, now + SNIPE_EXTENSION), book.hard_end)
+
+            seq = len(book.bids) + 1
+            lsn = self.wal.append({
+                "op": "bid",
+                "auction_id": auction_id,
+                "seq": seq,
+                "bidder": bidder,
+                "amount": str(amount),
+                "ts": now,
+                "ends_at": ends_at,
+            })
+            book.apply(seq, bidder, amount, now, ends_at)
+            snap = book.snapshot()
+
+        # 在鎖外等 fsync，其他出價可以繼續排進同一次 group commit
+        self.wal.sync(lsn)
+        return snap
+
+    # -------- 查詢 --------
+    def snapshot(self, auction_id):
+        book = self._book(auction_id)
+        if book is None:
+            return None
+        with book.lock:
+            return book.snapshot()
+
+    def open_auctions(self):
+        with self._books_lock:
+            books = list(self._books.values())
+        return sorted((b.snapshot() for b in books if not b.closed), key=lambda s: s["seconds_left"])
+
+    # -------- 結標 --------
+    def close_due(self):
+        now = time.time()
+        with self._books_lock:
+            due = [b for b in self._books.values() if b.ends_at <= now]
+
+        for book in due:
+            with book.lock:
+                # 挑選時沒上鎖：這段期間的防狙擊出價可能已把結標時間往後延
+                if not book.closed and book.ends_at > time.time():
+                    continue
+                book.closed = True          # 之後的出價一律拒絕
+            try:
+                self.settle(book)
+            except Exception as e:
+                book.settle_failures += 1
+                permanent = isinstance(e, (LookupError, psycopg2.DataError, psycopg2.IntegrityError))
+                if not permanent and book.settle_failures < SETTLE_ATTEMPTS:
+                    # 留在記憶體，下一輪重試
+                    print(f"[AUCTION] settle {book.auction_id} failed:", e)
+                    continue
+                # 重試也不會成功：改以流標結算，放回庫存，不讓這場永遠卡在記憶體
+                print(f"[AUCTION] settle {book.auction_id} gave up, closing as unsold:", e)
+                try:
+                    self.settle(book, error=str(e))
+                except Exception as e2:
+                    print(f"[AUCTION] unsold fallback {book.auction_id} failed:", e2)
+                    continue
+            with self._books_lock:
+                self._books.pop(book.auction_id, None)
+            self.wal.append({"op": "settled", "auction_id": book.auction_id})
+            self._settled_records += len(book.bids) + 1
+
+        if self._settled_records >= COMPACT_AFTER:
+            self.compact()
+
+    def settle(self, book, error=None):
+        """
+        一個交易：有得標者 → 建 auction 訂單（庫存在開拍時已保留），付款交給 payment worker 扣款，
+        扣款失敗時訂單取消、那 1 件放回庫存；
+        流標 → 把保留的那 1 件放回庫存。最後整批寫入出價紀錄。
+        error：正常結算一再失敗時帶入，直接以流標結算且不寫出價紀錄（出價本身可能就是錯誤來源）。
+        """
+        high = book.high if error is None else None
+        late = max(0.0, time.time() - book.ends_at)
+        conn = self._connect()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT status FROM auctions WHERE auction_id=%s FOR UPDATE",
+                        (book.auction_id,),
+                    )
+                    row = cur.fetchone()
+                    if row is None or row[0] != "Open":
+                        return          # 已經結算過（例如寫回後、記 WAL 前當機）
+
+                    order_id = None
+                    if high is not None:
+                        _, winner, price, _ = high
+                        cur.execute(
+                            """
+                            INSERT INTO orders (
+                                buyer_student_no, seller_student_no,
+                                order_type, status, total_amount,
+                                consignee_name, consignee_phone, shipping_address,
+                                created_at, paid_at
+                            )
+                            SELECT %s, %s, 'auction', 'Created', %s,
+                                   full_name, phone, '校內面交',
+                                   NOW(), NULL
+                            FROM users WHERE student_no=%s
+                            RETURNING order_id
+                        """,
+                            (winner, book.seller, price, winner),
+                        )
+                        row = cur.fetchone()
+                        if row is None:
+                            raise LookupError(f"得標者 {winner} 不存在")
+                        order_id = row[0]
+
+                        cur.execute(
+                            """
+                            INSERT INTO order_items (order_id, item_id, qty, price_each, title_snapshot)
+                            SELECT %s, item_id, 1, %s, title FROM items WHERE item_id=%s
+                        """,
+                            (order_id, price, book.item_id),
+                        )
+                        # 得標即送出付款（next_attempt_at），和 confirm_payment 之後走同一條路
+                        cur.execute(
+                            """
+                            INSERT INTO payments (order_id, method, amount, status, next_attempt_at)
+                            VALUES (%s, 'credit_card', %s, 'Pending', NOW())
+                        """,
+                            (order_id, price),
+                        )
+                        cur.execute(
+                            """
+                            UPDATE auctions
+                            SET status='Closed', winner_student_no=%s, final_price=%s,
+                                order_id=%s, closed_at=NOW(),
+                                ends_at=NOW() - make_interval(secs => %s)
+                            WHERE auction_id=%s
+                        """,
+                            (winner, price, order_id, late, book.auction_id),
+                        )
+                    else:
+                        cur.execute(
+                            """
+                            UPDATE items
+                            SET quantity=quantity + 1, status='Listed', updated_at=NOW()
+                            WHERE item_id=%s AND status IN ('Listed', 'SoldOut')
+                        """,
+                            (book.item_id,),
+                        )
+                        cur.execute(
+                            """
+                            UPDATE auctions SET status='Unsold', closed_at=NOW()
+                            WHERE auction_id=%s
+                        """,
+                            (book.auction_id,),
+                        )
+
+                    if book.bids and error is None:
+                        execute_values(
+                            cur,
+                            """
+                            INSERT INTO auction_bids
+                                (auction_id, seq, bidder_student_no, amount, placed_at)
+                            VALUES %s
+                        """,
+                            [(book.auction_id, seq, b, amt, ts) for seq, b, amt, ts in book.bids],
+                            template="(%s, %s, %s, %s, to_timestamp(%s)::timestamp)",
+                        )
+
+                    emit_event(cur, "auction.closed", "auction", book.auction_id, {
+                        "auction_id": book.auction_id,
+                        "item_id": book.item_id,
+                        "seller_student_no": book.seller,
+                        "winner_student_no": high[1] if high else None,
+                        "final_price": float(high[2]) if high else None,
+                        "order_id": order_id,
+                        "bid_count": len(book.bids),
+                        "error": error,
+                    })
+        finally:
+            conn.close()
+
+    def compact(self):
+        """鎖住所有拍賣簿後，只把進行中拍賣的出價重寫進 WAL"""
+        with self._books_lock:
+            books = sorted(self._books.values(), key=lambda b: b.auction_id)
+        for b in books:
+            b.lock.acquire()
+        try:
+            records = [
+                {"op": "bid", "auction_id": b.auction_id, "seq": seq, "bidder": bidder,
+                 "amount": str(amount), "ts": ts, "ends_at": b.ends_at}
+                for b in books
+                for seq, bidder, amount, ts in b.bids
+            ]
+            self.wal.rewrite(records)
+            self._settled_records = 0
+        finally:
+            for b in books:
+                b.lock.release()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.close_due()
+            except Exception as e:
+                print("[AUCTION] closer error:", e)
+            self._stop.wait(CLOSE_INTERVAL)
+
+    def start(self):
+        self.load()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """等結標執行緒跑完目前這輪，WAL fsync 後關閉"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.wal is not None:
+            self.wal.close()
@@ -0,0 +1,127 @@
+# ==========================================
+# NTU Marketplace - Payment Worker Benchmark
+# 建立 N 筆已送出付款的 Created 訂單，用不同 worker 數跑模擬金流，量每秒處理筆數
+#
+#   python bench_payments.py -n 500 --workers 1,4,8,16 --latency-ms 300 --failure-rate 0.05
+#
+# 請在測試資料庫執行：worker 會一併認領資料庫裡其他到期的付款。
+# 每輪結束後刪除本輪建立的訂單 / 付款 / outbox 事件。
+# ==========================================
+import argparse
+import time
+
+import psycopg2
+
+from db_config import DB_CONFIG
+from payment_worker import PaymentWorker, SimulatedGateway
+
+BENCH_ADDRESS = "__bench_payments__"
+
+
+def connect():
+    return psycopg2.connect(**DB_CONFIG)
+
+
+def pick_users(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT student_no FROM users ORDER BY student_no LIMIT 2")
+        buyer, seller = [r[0] for r in cur.fetchall()]
+    conn.rollback()
+    return buyer, seller
+
+
+def seed(conn, n, buyer, seller):
+    """沒有 order_items：失敗取消時不會動到任何商品庫存"""
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO orders (buyer_student_no, seller_student_no, order_type, status,
+                                    total_amount, shipping_address, hold_expires_at)
+                SELECT %s, %s, 'direct', 'Created', 100, %s, NOW() + INTERVAL '1 hour'
+                FROM generate_series(1, %s)
+                RETURNING order_id
+            """,
+                (buyer, seller, BENCH_ADDRESS, n),
+            )
+            order_ids = [r[0] for r in cur.fetchall()]
+            cur.execute(
+                """
+                INSERT INTO payments (order_id, method, amount, status, next_attempt_at)
+                SELECT order_id, 'credit_card', 100, 'Pending', NOW()
+                FROM unnest(%s::int[]) AS order_id
+            """,
+                (order_ids,),
+            )
+    return order_ids
+
+
+def pending(conn, order_ids):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT COUNT(*) FROM payments WHERE order_id = ANY(%s) AND status='Pending'",
+            (order_ids,),
+        )
+        n = cur.fetchone()[0]
+    conn.rollback()
+    return n
+
+
+def cleanup(conn, order_ids):
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM outbox_events WHERE aggregate_type='order' AND aggregate_id = ANY(%s)",
+                (order_ids,),
+            )
+            cur.execute("DELETE FROM orders WHERE order_id = ANY(%s)", (order_ids,))
+
+
+def bench(conn, args, workers, buyer, seller):
+    order_ids = seed(conn, args.n, buyer, seller)
+    gateway = SimulatedGateway(
+        latency_ms=args.latency_ms,
+        failure_rate=args.failure_rate,
+        decline_rate=args.decline_rate,
+        seed=1,
+    )
+    # 退避縮短，重試的等待不主導量測結果
+    worker = PaymentWorker(connect, gateway, workers=workers, backoff=args.backoff, poll=0.05)
+    try:
+        start = time.perf_counter()
+        worker.start()
+        while pending(conn, order_ids):
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - start
+    finally:
+        worker.stop()
+        cleanup(conn, order_ids)
+    return elapsed, worker.stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="付款 worker 吞吐量")
+    parser.add_argument("-n", type=int, default=500, help="每輪付款筆數")
+    parser.add_argument("--workers", default="1,4,8,16")
+    parser.add_argument("--latency-ms", type=int, default=300)
+    parser.add_argument("--failure-rate", type=float, default=0.05)
+    parser.add_argument("--decline-rate", type=float, default=0.01)
+    parser.add_argument("--backoff", type=float, default=0.05, help="重試退避基數（秒）")
+    args = parser.parse_args()
+
+    conn = connect()
+    buyer, seller = pick_users(conn)
+
+    print(f"n={args.n} latency={args.latency_ms}ms failure={args.failure_rate} "
+          f"decline={args.decline_rate}")
+    print(f"{'workers':>8} {'sec':>8} {'pay/s':>8} {'paid':>6} {'failed':>6} {'retried':>8}")
+    for workers in [int(w) for w in args.workers.split(",")]:
+        elapsed, stats = bench(conn, args, workers, buyer, seller)
+        print(f"{workers:>8} {elapsed:>8.2f} {args.n / elapsed:>8.1f} "
+              f"{stats['paid']:>6} {stats['failed']:>6} {stats['retried']:>8}")
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# ==========================================
+# NTU Marketplace - Prepared Statement Benchmark
+# 比較 place_order 的 SQL 序列：每次送完整 SQL vs PREPARE 一次後 EXECUTE
+#
+#   python bench_prepared.py -n 2000
+#
+# 每筆下單都像 handler 一樣經 ROUTER.acquire / release 借還池化連線，
+# 在自己的交易內執行後 rollback，不會改動資料。
+# ==========================================
+import argparse
+import re
+import time
+
+from db_config import DB_CONFIG, POOL_MAX_CONNECTIONS, POOL_WAIT_SECONDS
+from db_router import DBRouter
+from prepared import STATEMENTS, execute_prepared
+from reservations import HOLD_SECONDS
+
+PLACE_ORDER = (
+    "po_lock_item",
+    "po_insert_order",
+    "po_insert_order_item",
+    "po_insert_payment",
+    "po_update_stock",
+)
+
+
+def plain_sql(name):
+    """$1 → %(p1)s，讓同一段 SQL 能用一般 execute 送出"""
+    return re.sub(r"\$(\d+)", r"%(p\1)s", STATEMENTS[name][1])
+
+
+def pick_target(conn):
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT i.item_id, i.seller_student_no, i.price, i.quantity
+            FROM items i
+            WHERE i.status='Listed' AND i.quantity > 0
+            ORDER BY i.quantity DESC
+            LIMIT 1
+        """
+        )
+        item = cur.fetchone()
+        cur.execute(
+            "SELECT student_no FROM users WHERE student_no <> %s LIMIT 1",
+            (item[1],),
+        )
+        buyer = cur.fetchone()[0]
+    conn.rollback()
+    return item, buyer
+
+
+def place_order_once(cur, run, item, buyer):
+    item_id, seller_no, price, stock = item
+    run(cur, "po_lock_item", (item_id,))
+    cur.fetchone()
+    run(cur, "po_insert_order", (buyer, seller_no, price, HOLD_SECONDS))
+    order_id = cur.fetchone()[0]
+    run(cur, "po_insert_order_item", (order_id, 1, item_id))
+    run(cur, "po_insert_payment", (order_id, price))
+    run(cur, "po_update_stock", (stock - 1, "Listed", item_id))
+
+
+def run_plain(cur, name, params):
+    cur.execute(plain_sql(name), {f"p{i + 1}": v for i, v in enumerate(params)})
+
+
+def bench(router, run, item, buyer, n):
+    """和 handler 一樣每筆下單都從連線池借 / 還，量到的包含池化連線與 PREPARE 的重用"""
+    start = time.perf_counter()
+    for _ in range(n):
+        conn = router.acquire()
+        try:
+            with conn.cursor() as cur:
+                place_order_once(cur, run, item, buyer)
+            conn.rollback()
+        finally:
+            router.release(conn)
+    return (time.perf_counter() - start) / n * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="place_order prepared statement benchmark")
+    parser.add_argument("-n", "--iterations", type=int, default=1000)
+    parser.add_argument("--warmup", type=int, default=50)
+    args = parser.parse_args()
+
+    router = DBRouter(DB_CONFIG, pool_size=POOL_MAX_CONNECTIONS, pool_wait=POOL_WAIT_SECONDS)
+    try:
+        conn = router.acquire()
+        try:
+            item, buyer = pick_target(conn)
+        finally:
+            router.release(conn)
+        print(f"[BENCH] item={item[0]} buyer={buyer} iterations={args.iterations}")
+
+        for label, run in (("plain", run_plain), ("prepared", execute_prepared)):
+            bench(router, run, item, buyer, args.warmup)
+            ms = bench(router, run, item, buyer, args.iterations)
+            print(f"[BENCH] {label:<9} {ms:.3f} ms / order")
+    finally:
+        router.primary.close()
+
+
+if __name__ == "__main__":
+    main()
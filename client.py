@@ -1,26 +1,176 @@
 # ==========================================
 # NTU Marketplace - Final Client.py (Fixed Admin)
 # ==========================================
+import os
 import socket
 import json
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:     # zstd 為選用
+    zstandard = None
 
 HOST = "127.0.0.1"
 PORT = 5000
 
+REQUEST_TIMEOUT = 15        # 秒，一般操作
+ANALYTICS_TIMEOUT = 40      # 秒，後台分析（伺服端 statement_timeout 為 30 秒）
+EXPORT_TIMEOUT = 600        # 秒，匯出整段資料到伺服器上的 columnar 檔
+IMAGE_TIMEOUT = 60          # 秒，上傳 / 下載圖片
+
+# 依偏好順序告訴伺服器可以接受的壓縮格式
+ACCEPT_ENCODING = ["zstd", "zlib"] if zstandard else ["zlib"]
+COLUMNAR_KEYS = ("items", "orders", "data", "categories", "auctions")
+
+
+def decode_body(data: bytes) -> str:
+    """壓縮回應：0x00 + 編碼名稱 + 換行 + 內容；否則就是純 JSON"""
+    if data[:1] != b"\x00":
+        return data.decode("utf-8")
+
+    enc, _, packed = data[1:].partition(b"\n")
+    if enc == b"zlib":
+        return zlib.decompress(packed).decode("utf-8")
+    if enc == b"zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(packed).decode("utf-8")
+    raise ValueError(f"不支援的壓縮格式 {enc!r}")
+
+
+def from_columnar(res: dict) -> dict:
+    """把 {"columns", "rows"} 還原成 list of dict，呼叫端不用管格式"""
+    if res.get("format") != "columnar":
+        return res
+    for key in COLUMNAR_KEYS:
+        v = res.get(key)
+        if isinstance(v, dict) and "columns" in v:
+            cols = v["columns"]
+            res[key] = [dict(zip(cols, row)) for row in v["rows"]]
+    return res
+
+
+def send_request(payload: dict, timeout: float = REQUEST_TIMEOUT, columnar: bool = False) -> dict:
+    payload = dict(payload, accept_encoding=ACCEPT_ENCODING)
+    if columnar:
+        payload["format"] = "columnar"
 
-def send_request(payload: dict) -> dict:
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((HOST, PORT))
-    s.send(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
-    data = s.recv(16384).decode("utf-8")
-    s.close()
+    s.settimeout(timeout)
+    try:
+        s.connect((HOST, PORT))
+        s.sendall(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+
+        # 伺服器送完就關閉連線，讀到 EOF 為止
+        chunks = []
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        data = b"".join(chunks)
+    except socket.timeout:
+        return {"status": "fail", "message": "伺服器回應逾時", "offline": True}
+    except OSError as e:
+        return {"status": "fail", "message": f"無法連線伺服器：{e}", "offline": True}
+    finally:
+        s.close()
 
     try:
-        return json.loads(data)
+        return from_columnar(json.loads(decode_body(data)))
     except:
         return {"status": "fail", "message": "無法解析伺服器回應"}
 
 
+def binary_request(payload: dict, path: str = None, timeout: float = IMAGE_TIMEOUT):
+    """
+    圖片用的請求：JSON header + 換行 + 檔案內容（上傳時）。
+    回應是 JSON header + 換行 + 圖檔（下載時）；失敗時只有 JSON。回傳 (header, bytes)
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    try:
+        s.connect((HOST, PORT))
+        if path:
+            payload = dict(payload, size=os.path.getsize(path))
+        s.sendall(json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n")
+        if path:
+            with open(path, "rb") as f:
+                s.sendfile(f)
+
+        chunks = []
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        data = b"".join(chunks)
+    except socket.timeout:
+        return {"status": "fail", "message": "伺服器回應逾時"}, b""
+    except OSError as e:
+        return {"status": "fail", "message": f"無法連線伺服器：{e}"}, b""
+    finally:
+        s.close()
+
+    head, _, body = data.partition(b"\n")
+    try:
+        return json.loads(head.decode("utf-8")), body
+    except:
+        return {"status": "fail", "message": "無法解析伺服器回應"}, b""
+
+
+def subscribe_loop(student_no):
+    """長連線接收伺服器推播（一行一個 JSON），斷線時結束"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.connect((HOST, PORT))
+        s.sendall(json.dumps({"action": "subscribe", "student_no": student_no}).encode("utf-8"))
+        for line in s.makefile("r", encoding="utf-8"):
+            msg = json.loads(line)
+            if msg.get("type") == "order.new":
+                print(f"\n🔔 新訂單 #{msg['order_id']}（NT${msg['total_amount']}）")
+            elif msg.get("type") == "order.status":
+                print(f"\n🔔 訂單 #{msg['order_id']} 狀態：{msg['old_status'] or '-'} → {msg['status']}")
+            elif msg.get("status") == "fail":
+                print("\n通知訂閱失敗：", msg.get("message"))
+                return
+    except OSError:
+        pass
+    finally:
+        s.close()
+    print("\n（即時通知已中斷）")
+
+
+# ============================================================
+# Response cache（ETag 驗證；伺服器連不上時顯示最後一次的資料）
+# ============================================================
+_cache = {}     # json(payload) -> (etag, response)
+
+
+def cached_request(payload: dict, columnar: bool = False) -> dict:
+    key = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    hit = _cache.get(key)
+
+    req = dict(payload)
+    if hit:
+        req["if_none_match"] = hit[0]
+
+    res = send_request(req, columnar=columnar)
+
+    if res.get("status") == "not_modified" and hit:
+        return hit[1]
+
+    if res.get("status") == "ok" and res.get("etag"):
+        _cache[key] = (res["etag"], res)
+        return res
+
+    if res.get("offline") and hit:
+        print("（無法連線伺服器，顯示上次的資料）")
+        return hit[1]
+
+    return res
+
+
 # ============================================================
 # Login
 # ============================================================
@@ -70,6 +220,16 @@ def show_main_menu(user):
     print("[7] （賣家）出貨")
     print("[8] （買家）評價訂單")
     print("[9] 登出")
+    print("[12] 推薦商品（看過/買過的人也看了）")
+    print("[13] 24 小時熱門趨勢")
+    print("[14] 查看商品詳情")
+    print("[15] 依分類瀏覽（含子分類）")
+    print("[16] 開啟即時訂單通知")
+    print("[17] 拍賣自己的商品")
+    print("[18] 拍賣場（查看 / 出價）")
+    print("[19] 上傳商品圖片")
+    print("[20] 下載圖片")
+    print("[21] 付款（待付款訂單）")
 
     if user["role"] == "admin":
         print("----------------------------------------")
@@ -83,14 +243,22 @@ def show_main_menu(user):
 # ============================================================
 # Basic Functions
 # ============================================================
+def format_rating(row):
+    if not row.get("seller_review_count"):
+        return "(尚無評價)"
+    return f"(★{row['seller_rating']:.2f} / {row['seller_review_count']} 則)"
+
+
 def action_list_items(user):
-    res = send_request({"action": "list_items"})
+    res = cached_request({"action": "list_items"}, columnar=True)
     if res["status"] != "ok":
         print("失敗：", res["message"])
         return
 
     for it in res["items"]:
-        print(f"#{it['item_id']} {it['title']} | NT${it['price']} | 庫存 {it['quantity']} | 賣家 {it['seller_name']}")
+        thumb = " | 🖼" if it.get("thumbnail") else ""
+        print(f"#{it['item_id']} {it['title']} | NT${it['price']} | 庫存 {it['quantity']} | 賣家 {it['seller_name']}"
+              f" {format_rating(it)}{thumb}")
 
 
 def action_place_order(user):
@@ -109,25 +277,52 @@ def action_place_order(user):
     })
 
     if res.get("status") == "ok":
-        print("✅ 下單成功！")
+        print("✅ 已保留庫存！")
         print(f"訂單編號：{res.get('order_id')}")
         print(f"總金額：NT${res.get('total_amount')}")
+        print(f"請於 {res.get('hold_expires_at')} 前完成付款，逾時自動取消")
+        if input("現在付款？(y/n)：").strip().lower() == "y":
+            confirm_payment(user, res.get("order_id"))
     else:
         print("❌ 下單失敗：", res.get("message"))
 
 
+def confirm_payment(user, order_id):
+    res = send_request({
+        "action": "confirm_payment",
+        "student_no": user["student_no"],
+        "order_id": order_id,
+    })
+    if res.get("status") == "ok":
+        print(f"✅ 訂單#{order_id}：{res.get('message')}（結果可於 [3] 查看）")
+    else:
+        print("❌ 付款失敗：", res.get("message"))
+
+
+def action_pay_order(user):
+    try:
+        order_id = int(input("要付款的訂單編號："))
+    except:
+        print("格式錯誤")
+        return
+    confirm_payment(user, order_id)
+
+
 def action_my_orders(user):
-    res = send_request({"action": "my_orders", "student_no": user["student_no"]})
+    res = cached_request({"action": "my_orders", "student_no": user["student_no"]})
     if res["status"] != "ok":
         print("查詢失敗：", res["message"])
         return
 
     for o in res["orders"]:
-        print(f"訂單#{o['order_id']} | {o['status']} | NT${o['total_amount']} | 賣家 {o['seller_name']}")
+        print(f"訂單#{o['order_id']} | {o['status']} | NT${o['total_amount']} | 賣家 {o['seller_name']}"
+              f" {format_rating(o)}")
+        if o.get("hold_expires_at"):
+            print(f"    待付款，保留至 {o['hold_expires_at']}")
 
 
 def action_my_selling_items(user):
-    res = send_request({
+    res = cached_request({
         "action": "list_my_selling_items",
         "student_no": user["student_no"]
     })
@@ -171,6 +366,10 @@ def action_orders_to_ship(user):
         "action": "orders_to_ship",
         "student_no": user["student_no"]
     })
+    if res.get("status") != "ok":
+        print("查詢失敗：", res.get("message"))
+        return
+
     for o in res["orders"]:
         print(f"訂單 #{o['order_id']} | NT${o['total_amount']} | 買家 {o['buyer_name']}")
 
@@ -201,6 +400,10 @@ def action_pending_reviews(user):
         "student_no": user["student_no"],
     })
 
+    if res.get("status") != "ok":
+        print("查詢失敗：", res.get("message"))
+        return []
+
     if not res["orders"]:
         print("沒有可評價的訂單")
         return []
@@ -231,23 +434,258 @@ def action_create_review(user):
     print(res["message"])
 
 
+def action_recommend_items(user):
+    raw = input("item_id（留空 = 依我的紀錄推薦）：").strip()
+    payload = {"action": "recommend_items", "student_no": user["student_no"]}
+    if raw:
+        try:
+            payload["item_id"] = int(raw)
+        except:
+            print("格式錯誤")
+            return
+
+    res = send_request(payload)
+    if res.get("status") != "ok":
+        print("查詢失敗：", res.get("message"))
+        return
+
+    if not res["items"]:
+        print("目前沒有推薦商品")
+        return
+
+    for it in res["items"]:
+        print(f"#{it['item_id']} {it['title']} | 相關度 {it['score']}")
+
+
+def action_browse_category(user):
+    res = send_request({"action": "list_categories"})
+    if res.get("status") != "ok":
+        print("查詢失敗：", res.get("message"))
+        return
+
+    for c in res["categories"]:
+        print(f"{'  ' * c['depth']}[{c['category_id']}] {c['name']}")
+
+    try:
+        category_id = int(input("分類 ID："))
+    except:
+        print("格式錯誤")
+        return
+
+    res = cached_request({"action": "list_items", "category_id": category_id}, columnar=True)
+    if res.get("status") != "ok":
+        print("查詢失敗：", res.get("message"))
+        return
+
+    if not res["items"]:
+        print("此分類目前沒有商品")
+        return
+
+    for it in res["items"]:
+        print(f"#{it['item_id']} {it['title']} | NT${it['price']} | {it['category_path']} | 賣家 {it['seller_name']}")
+
+
+def action_trending_items(user):
+    res = send_request({"action": "trending_items", "limit": 10})
+    if res.get("status") != "ok":
+        print("查詢失敗：", res.get("message"))
+        return
+
+    if not res["items"]:
+        print("最近 24 小時沒有瀏覽 / 下單紀錄")
+        return
+
+    for rank, it in enumerate(res["items"], 1):
+        print(f"{rank}. #{it['item_id']} {it['title']} | 瀏覽 {it['views']} | 下單 {it['orders']}")
+
+
+def action_view_item(user):
+    try:
+        item_id = int(input("item_id："))
+    except:
+        print("格式錯誤")
+        return
+
+    res = send_request({
+        "action": "view_item",
+        "student_no": user["student_no"],
+        "item_id": item_id,
+    })
+    if res.get("status") != "ok":
+        print("查詢失敗：", res.get("message"))
+        return
+
+    it = res["item"]
+    print(f"#{it['item_id']} {it['title']} | NT${it['price']} | {it['condition']} | 庫存 {it['quantity']}")
+    print(f"分類：{it['category_name']} | 賣家 {it['seller_name']} {format_rating(it)}")
+    print(it["description"] or "")
+    for im in it.get("images", []):
+        print(f"  圖片 #{im['image_id']}：{im['sha256'] or im['image_url']}")
+
+
+def action_upload_image(user):
+    try:
+        item_id = int(input("item_id："))
+    except:
+        print("格式錯誤")
+        return
+    path = input("圖檔路徑：").strip()
+    if not os.path.isfile(path):
+        print("找不到檔案")
+        return
+
+    res, _ = binary_request({
+        "action": "upload_image",
+        "student_no": user["student_no"],
+        "item_id": item_id,
+    }, path=path)
+    print(res["message"])
+
+
+def action_download_image(user):
+    sha = input("圖片代碼（sha256）：").strip()
+    res, data = binary_request({"action": "get_image", "student_no": user["student_no"], "sha256": sha})
+    if res["status"] != "ok":
+        print(res["message"])
+        return
+    if len(data) != res["size"]:
+        print("下載不完整")
+        return
+
+    out = f"{sha[:12]}.img"
+    with open(out, "wb") as f:
+        f.write(data)
+    print(f"已存成 {out}（{len(data)} bytes）")
+
+
+def format_auction(a):
+    price = f"NT${a['current_price']}" if a.get("current_price") is not None else "尚無出價"
+    line = f"拍賣 #{a['auction_id']} 商品 #{a['item_id']} | {a['status']} | 目前 {price}"
+    if a.get("high_bidder"):
+        line += f"（{a['high_bidder']}）"
+    if a["status"] in ("Open", "Closing"):
+        line += f" | 下一口至少 NT${a['min_next_bid']} | 剩 {a['seconds_left']} 秒"
+    return line + f" | {a.get('bid_count', 0)} 次出價"
+
+
+def action_create_auction(user):
+    try:
+        item_id = int(input("要拍賣的 item_id："))
+        start_price = float(input("起標價："))
+        raw = input("每口最少加價（留空 = 1）：").strip()
+        min_increment = float(raw) if raw else 1
+        raw = input("拍賣時間（分鐘，留空 = 60）：").strip()
+        minutes = int(raw) if raw else 60
+    except:
+        print("格式錯誤")
+        return
+
+    res = send_request({
+        "action": "create_auction",
+        "student_no": user["student_no"],
+        "item_id": item_id,
+        "start_price": start_price,
+        "min_increment": min_increment,
+        "duration_minutes": minutes,
+    })
+    print(res["message"])
+    if res["status"] == "ok":
+        print(format_auction(res["auction"]))
+
+
+def action_auctions(user):
+    res = send_request({"action": "auction_status", "student_no": user["student_no"]}, columnar=True)
+    if res.get("status") != "ok":
+        print("查詢失敗：", res.get("message"))
+        return
+
+    if not res["auctions"]:
+        print("目前沒有進行中的拍賣")
+    for a in res["auctions"]:
+        print(format_auction(a))
+
+    raw = input("輸入拍賣 ID 出價 / 查詢（留空返回）：").strip()
+    if not raw:
+        return
+    try:
+        auction_id = int(raw)
+    except:
+        print("格式錯誤")
+        return
+
+    status = send_request({"action": "auction_status", "student_no": user["student_no"],
+                           "auction_id": auction_id})
+    if status.get("status") != "ok":
+        print(status.get("message"))
+        return
+    print(format_auction(status["auction"]))
+    if status["auction"]["status"] != "Open":
+        return
+
+    raw = input("出價金額（留空不出價）：").strip()
+    if not raw:
+        return
+    res = send_request({
+        "action": "place_bid",
+        "student_no": user["student_no"],
+        "auction_id": auction_id,
+        "amount": raw,
+    })
+    if res["status"] != "ok":
+        print("出價失敗：", res["message"])
+        return
+    print("出價成功！")
+    print(format_auction(res["auction"]))
+
+
 # ============================================================
 # SQL Analytics (Admin)
 # ============================================================
 def sql_menu():
     print("\n=== SQL 系統分析 ===")
     print("[1] 依分類銷售額")
-    print("[2] 每月營收")
+    print("[2] 營收趨勢（日 / 週 / 月 / 年）")
     print("[3] 賣家平均評價")
     print("[4] 熱門商品")
+    print("[5] 伺服器指標（排隊拒絕 / 逾時次數）")
+    print("[6] 分類階層營收（含子分類累計）")
+    print("[7] 匯出訂單 / 瀏覽紀錄（Parquet / Arrow）")
     print("[0] 返回")
     return input("選項：")
 
 
+def ask_window(payload, granularity=False):
+    """詢問報表的時間區間與篩選條件（都可留空）；格式錯誤回傳 False"""
+    start = input("起始日 YYYY-MM-DD（留空 = 不限）：").strip()
+    end = input("結束日 YYYY-MM-DD，不含（留空 = 不限）：").strip()
+    if start:
+        payload["start"] = start
+    if end:
+        payload["end"] = end
+    if granularity:
+        g = input("週期 day/week/month/year（留空 = month）：").strip()
+        if g:
+            payload["granularity"] = g
+    seller = input("賣家學號（留空 = 全部）：").strip()
+    if seller:
+        payload["seller"] = seller
+    raw = input("分類 ID，含子分類（留空 = 全部）：").strip()
+    if raw:
+        try:
+            payload["category_id"] = int(raw)
+        except:
+            print("格式錯誤")
+            return False
+    return True
+
+
 def sql_show(res):
     if res["status"] != "ok":
         print(res["message"])
         return
+    w = res.get("window")
+    if w and w.get("partitions", 1) > 1:
+        print(f"（{w['start']} ~ {w['end']}，分 {w['partitions']} 段平行彙總）")
     for r in res["data"]:
         print(r)
 
@@ -257,29 +695,78 @@ def action_sql_analytics(user):
         c = sql_menu()
 
         if c == "1":
-            sql_show(send_request({
+            payload = {
                 "action": "analytics_category_revenue",
                 "student_no": user["student_no"],
                 "role": user["role"]
-            }))
+            }
+            if not ask_window(payload):
+                continue
+            sql_show(send_request(payload, timeout=ANALYTICS_TIMEOUT))
         elif c == "2":
-            sql_show(send_request({
+            payload = {
                 "action": "analytics_monthly_revenue",
                 "student_no": user["student_no"],
                 "role": user["role"]
-            }))
+            }
+            if not ask_window(payload, granularity=True):
+                continue
+            sql_show(send_request(payload, timeout=ANALYTICS_TIMEOUT))
         elif c == "3":
-            sql_show(send_request({
+            payload = {
                 "action": "analytics_seller_rating",
                 "student_no": user["student_no"],
                 "role": user["role"]
-            }))
+            }
+            if not ask_window(payload):
+                continue
+            sql_show(send_request(payload, timeout=ANALYTICS_TIMEOUT))
         elif c == "4":
-            sql_show(send_request({
+            payload = {
                 "action": "analytics_top_items",
                 "student_no": user["student_no"],
                 "role": user["role"]
-            }))
+            }
+            if not ask_window(payload):
+                continue
+            sql_show(send_request(payload, timeout=ANALYTICS_TIMEOUT))
+        elif c == "6":
+            payload = {
+                "action": "analytics_category_rollup",
+                "student_no": user["student_no"],
+                "role": user["role"]
+            }
+            if not ask_window(payload):
+                continue
+            sql_show(send_request(payload, timeout=ANALYTICS_TIMEOUT))
+        elif c == "7":
+            payload = {
+                "action": "export_data",
+                "student_no": user["student_no"],
+                "role": user["role"]
+            }
+            if not ask_window(payload):
+                continue
+            fmt = input("格式 parquet/arrow（留空 = parquet）：").strip()
+            if fmt:
+                payload["format"] = fmt
+            res = send_request(payload, timeout=EXPORT_TIMEOUT)
+            if res["status"] != "ok":
+                print(res["message"])
+                continue
+            for f in res["files"]:
+                print(f"{f['dataset']}: {f['rows']} 列, {f['bytes']} bytes → {f['path']}")
+        elif c == "5":
+            res = send_request({
+                "action": "server_metrics",
+                "student_no": user["student_no"],
+                "role": user["role"]
+            })
+            if res["status"] != "ok":
+                print(res["message"])
+                continue
+            for name, count in res["data"].items():
+                print(f"{name}: {count}")
         elif c == "0":
             return
         else:
@@ -302,17 +789,23 @@ def action_nosql_analytics(user):
         c = nosql_menu()
 
         if c == "1":
-            sql_show(send_request({
+            payload = {
                 "action": "nosql_mobile_views",
                 "student_no": user["student_no"],
                 "role": user["role"]
-            }))
+            }
+            if not ask_window(payload):
+                continue
+            sql_show(send_request(payload, timeout=ANALYTICS_TIMEOUT))
         elif c == "2":
-            sql_show(send_request({
+            payload = {
                 "action": "nosql_hot_views",
                 "student_no": user["student_no"],
                 "role": user["role"]
-            }))
+            }
+            if not ask_window(payload):
+                continue
+            sql_show(send_request(payload, timeout=ANALYTICS_TIMEOUT))
         elif c == "0":
             return
         else:
@@ -331,6 +824,8 @@ def main():
     if not user:
         return
 
+    notify_thread = None
+
     while True:
         choice = show_main_menu(user)
 
@@ -354,6 +849,33 @@ def main():
         elif choice == "9":
             print("已登出，再見！")
             break
+        elif choice == "12":
+            action_recommend_items(user)
+        elif choice == "13":
+            action_trending_items(user)
+        elif choice == "14":
+            action_view_item(user)
+        elif choice == "15":
+            action_browse_category(user)
+        elif choice == "17":
+            action_create_auction(user)
+        elif choice == "18":
+            action_auctions(user)
+        elif choice == "19":
+            action_upload_image(user)
+        elif choice == "20":
+            action_download_image(user)
+        elif choice == "21":
+            action_pay_order(user)
+        elif choice == "16":
+            if notify_thread and notify_thread.is_alive():
+                print("即時通知已開啟")
+            else:
+                notify_thread = threading.Thread(
+                    target=subscribe_loop, args=(user["student_no"],), daemon=True
+                )
+                notify_thread.start()
+                print("已開啟即時通知，訂單有變化會直接顯示")
 
         # Admin only
         elif choice == "10" and user["role"] == "admin":
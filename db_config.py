@@ -8,3 +8,46 @@ DB_CONFIG = {
     "host": "localhost",
     "port": 5432,
 }
+
+# 唯讀副本（streaming replication）的 DSN，留空代表全部走主庫
+# 例："dbname=NTU_market user=postgres password=xxx host=10.0.0.12 port=5432"
+REPLICA_DSNS = [
+]
+
+# 副本落後超過幾秒就改走主庫
+REPLICA_MAX_LAG_SECONDS = 5
+
+# 使用者寫入後，這段時間內的讀取都固定走主庫（read-your-writes）
+STICKY_PRIMARY_SECONDS = 10
+
+# 每個資料庫節點常駐的連線池上限
+# 應 >= interactive + analytics 併發上限 + 報表分段 worker 數（64 + 4 + 8）
+POOL_MAX_CONNECTIONS = 80
+
+# 連線池借不到連線時最多等幾秒
+POOL_WAIT_SECONDS = 5
+
+# 後台報表的執行引擎："postgres"（預設，按月分段平行查詢）或 "duckdb"
+# duckdb 需 pip install duckdb，會定期把報表用到的表同步成本機的欄式快照
+ANALYTICS_BACKEND = "postgres"
+
+# duckdb 快照多久重新同步一次（秒）
+OLAP_SYNC_SECONDS = 300
+
+# 付款 worker 同時呼叫金流的筆數（各自一條資料庫連線，不佔用上面的連線池）
+PAYMENT_WORKERS = 8
+
+# 本機模擬金流的平均延遲（毫秒）與暫時失敗率（失敗會依退避重試）
+PAYMENT_GATEWAY_LATENCY_MS = 300
+PAYMENT_GATEWAY_FAILURE_RATE = 0.05
+
+# 速率限制（token bucket）：{範圍: (每秒補充數, 最大突發)}
+# ip：每個來源位址；user：每個 student_no；read / write / analytics：每個使用者在該類 action
+# 未帶 student_no 的請求（login 等）以來源位址代替使用者
+RATE_LIMITS = {
+    "ip": (50, 100),
+    "user": (20, 40),
+    "read": (10, 30),
+    "write": (2, 10),
+    "analytics": (0.5, 5),
+}
@@ -0,0 +1,191 @@
+# ==========================================
+# NTU Marketplace - Primary / Replica Routing
+# 唯讀 action 走副本，落後太多或剛寫入的使用者改走主庫
+# handler 的連線從每個節點常駐的連線池借用
+# ==========================================
+import itertools
+import threading
+import time
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_UNKNOWN
+from psycopg2.pool import PoolError
+
+from prepared import PreparedConnection
+
+LAG_CHECK_INTERVAL = 2      # 秒，同一個副本多久量一次 lag
+
+LAG_SQL = """
+    SELECT CASE
+               WHEN NOT pg_is_in_recovery() THEN 0
+               WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+               ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+           END
+"""
+
+
+class Endpoint:
+    """
+    一個資料庫節點：可以開新連線，也可以從它的連線池借。
+    池子是閒置連線的堆疊：需要時才連線，歸還後保留重用（連同已 PREPARE 的 statement），
+    總數由 semaphore 限制在 pool_size。
+    """
+
+    def __init__(self, pool_size, pool_wait, *args, **kwargs):
+        self.args = args
+        self.kwargs = dict(kwargs, connection_factory=PreparedConnection)
+        self.pool_size = pool_size
+        self.pool_wait = pool_wait
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._pool_lock = threading.Lock()
+
+    def open(self):
+        return psycopg2.connect(*self.args, **self.kwargs)
+
+    def getconn(self):
+        if not self._slots.acquire(timeout=self.pool_wait):
+            raise PoolError("連線池已滿，請稍後再試")
+        try:
+            conn = None
+            with self._pool_lock:
+                while self._idle and conn is None:
+                    conn = self._idle.pop()
+                    if conn.closed:
+                        conn = None
+            if conn is None:
+                conn = self.open()
+        except Exception:
+            self._slots.release()
+            raise
+        conn.pool = self
+        return conn
+
+    def putconn(self, conn):
+        broken = conn.closed or conn.info.transaction_status == TRANSACTION_STATUS_UNKNOWN
+        if not broken:
+            try:
+                conn.rollback()     # 收掉 handler 沒 commit 的唯讀交易
+            except Exception:
+                broken = True
+        conn.pool = None
+        try:
+            if broken:
+                conn.close()
+            else:
+                with self._pool_lock:
+                    self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """關閉所有閒置連線（借出中的歸還時照常回池）"""
+        with self._pool_lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class Replica(Endpoint):
+    def __init__(self, dsn, pool_size, pool_wait):
+        super().__init__(pool_size, pool_wait, dsn)
+        self.dsn = dsn
+        self.lag = 0.0
+        self.checked_at = 0.0
+        self.healthy = True
+
+
+class DBRouter:
+    def __init__(self, primary_config, replica_dsns=(), max_lag=5, sticky_seconds=10,
+                 pool_size=20, pool_wait=5):
+        self.primary = Endpoint(pool_size, pool_wait, **primary_config)
+        self.replicas = [Replica(dsn, pool_size, pool_wait) for dsn in replica_dsns]
+        self.max_lag = max_lag
+        self.sticky_seconds = sticky_seconds
+
+        self._rr = itertools.cycle(range(len(self.replicas))) if self.replicas else None
+        self._rr_lock = threading.Lock()
+        self._last_write = {}       # student_no -> 寫入時間
+        self._write_lock = threading.Lock()
+
+    # -------- connections --------
+    def connect_primary(self):
+        """新開一條主庫連線（背景工作 / LISTEN 用，呼叫端自己 close）"""
+        return self.primary.open()
+
+    def connect(self, read_only=False, student_no=None):
+        """新開連線並依 action 性質路由（背景工作用，呼叫端自己 close）"""
+        return self._route(read_only, student_no, pooled=False)
+
+    def acquire(self, read_only=False, student_no=None):
+        """從連線池借（handler 用），用完要呼叫 release"""
+        return self._route(read_only, student_no, pooled=True)
+
+    def release(self, conn):
+        if conn.pool is not None:
+            conn.pool.putconn(conn)
+        else:
+            conn.close()
+
+    def _route(self, read_only, student_no, pooled):
+        """副本都不可用時一律回主庫"""
+        if read_only and self.replicas and not self.is_sticky(student_no):
+            for replica in self._candidates():
+                conn = self._try_replica(replica, pooled)
+                if conn is not None:
+                    return conn
+
+        return self.primary.getconn() if pooled else self.primary.open()
+
+    def _candidates(self):
+        with self._rr_lock:
+            start = next(self._rr)
+        n = len(self.replicas)
+        ordered = [self.replicas[(start + i) % n] for i in range(n)]
+        # 不健康的副本排在最後，仍然給它復活的機會
+        return sorted(ordered, key=lambda r: not r.healthy)
+
+    def _try_replica(self, replica, pooled):
+        try:
+            conn = replica.getconn() if pooled else replica.open()
+        except Exception:
+            replica.healthy = False
+            return None
+
+        now = time.time()
+        if now - replica.checked_at >= LAG_CHECK_INTERVAL:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(LAG_SQL)
+                    replica.lag = float(cur.fetchone()[0])
+                conn.rollback()
+                replica.checked_at = now
+            except Exception:
+                self.release(conn)
+                replica.healthy = False
+                return None
+
+        replica.healthy = replica.lag <= self.max_lag
+        if not replica.healthy:
+            self.release(conn)
+            return None
+
+        return conn
+
+    # -------- read-your-writes --------
+    def mark_write(self, student_no):
+        if not student_no:
+            return
+        now = time.time()
+        with self._write_lock:
+            self._last_write[student_no] = now
+            # 順手清掉過期的紀錄，避免 dict 無限長大
+            if len(self._last_write) > 10000:
+                cutoff = now - self.sticky_seconds
+                self._last_write = {k: t for k, t in self._last_write.items() if t >= cutoff}
+
+    def is_sticky(self, student_no):
+        if not student_no:
+            return False
+        t = self._last_write.get(student_no)
+        return t is not None and time.time() - t < self.sticky_seconds
@@ -0,0 +1,244 @@
+# ==========================================
+# NTU Marketplace - Columnar Export
+# 把一段時間的訂單 / 明細 / 付款與攤平後的 view_logs 匯出成 Parquet 或 Arrow IPC，
+# 讓重分析在 OLTP 資料庫之外跑
+# ==========================================
+import os
+import threading
+import time
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:     # pyarrow 為選用，沒裝時匯出 action 直接回報
+    pa = None
+    pq = None
+
+EXPORT_DIR = "exports"
+CHUNK_ROWS = 50000          # server-side cursor 每次 FETCH 的列數 = 每個 record batch 的大小
+FORMATS = ("parquet", "arrow")
+COMPRESSION = "zstd"
+
+# 同時只跑一個匯出，避免長交易互相疊加
+_export_slot = threading.BoundedSemaphore(1)
+
+
+def _schemas():
+    money = pa.decimal128(12, 2)
+    ts = pa.timestamp("us")
+    return {
+        # 不匯出收件人姓名 / 電話 / 地址
+        "orders": pa.schema([
+            ("order_id", pa.int32()),
+            ("buyer_student_no", pa.string()),
+            ("seller_student_no", pa.string()),
+            ("order_type", pa.string()),
+            ("status", pa.string()),
+            ("total_amount", money),
+            ("created_at", ts),
+            ("paid_at", ts),
+            ("shipped_at", ts),
+            ("completed_at", ts),
+            ("cancelled_at", ts),
+        ]),
+        "order_items": pa.schema([
+            ("order_id", pa.int32()),
+            ("item_id", pa.int32()),
+            ("qty", pa.int32()),
+            ("price_each", money),
+            ("title_snapshot", pa.string()),
+            ("category_id", pa.int32()),
+        ]),
+        "payments": pa.schema([
+            ("payment_id", pa.int32()),
+            ("order_id", pa.int32()),
+            ("method", pa.string()),
+            ("amount", money),
+            ("status", pa.string()),
+            ("paid_at", ts),
+        ]),
+        "view_logs": pa.schema([
+            ("id", pa.int32()),
+            ("student_no", pa.string()),
+            ("item_id", pa.int32()),
+            ("viewed_at", ts),
+            ("device", pa.string()),
+            ("ip", pa.string()),
+            ("browser", pa.string()),
+            ("meta_other", pa.string()),
+        ]),
+    }
+
+
+# dataset -> (SQL 範本, 時間欄位, 賣家欄位, 分類 path 欄位, 訂單欄位)；{where} 由 Window.where 產生
+# 分類篩選：逐列有商品的 dataset 直接比對 path，整張訂單的以訂單內是否有該分類商品判斷
+DATASETS = {
+    "orders": (
+        """
+        SELECT o.order_id, o.buyer_student_no, o.seller_student_no, o.order_type,
+               o.status, o.total_amount, o.created_at, o.paid_at, o.shipped_at,
+               o.completed_at, o.cancelled_at
+        FROM orders o
+        WHERE TRUE {where}
+        ORDER BY o.order_id
+    """,
+        "o.created_at",
+        "o.seller_student_no",
+        None,
+        "o.order_id",
+    ),
+    "order_items": (
+        """
+        SELECT oi.order_id, oi.item_id, oi.qty, oi.price_each, oi.title_snapshot,
+               i.category_id
+        FROM orders o
+        JOIN order_items oi ON oi.order_id=o.order_id
+        JOIN items i ON i.item_id=oi.item_id
+        JOIN categories c ON c.category_id=i.category_id
+        WHERE TRUE {where}
+        ORDER BY oi.order_id, oi.item_id
+    """,
+        "o.created_at",
+        "o.seller_student_no",
+        "c.path",
+        None,
+    ),
+    "payments": (
+        """
+        SELECT p.payment_id, p.order_id, p.method, p.amount, p.status, p.paid_at
+        FROM orders o
+        JOIN payments p ON p.order_id=o.order_id
+        WHERE TRUE {where}
+        ORDER BY p.order_id
+    """,
+        "o.created_at",
+        "o.seller_student_no",
+        None,
+        "o.order_id",
+    ),
+    # JSONB 攤平：常見的 key 各成一欄，其餘留在 meta_other（JSON 字串）
+    "view_logs": (
+        """
+        SELECT v.id, v.student_no, v.item_id, v.viewed_at,
+               v.meta->>'device', v.meta->>'ip', v.meta->>'browser',
+               NULLIF(v.meta - 'device' - 'ip' - 'browser', '{{}}'::jsonb)::text
+        FROM view_logs v
+        LEFT JOIN items i ON i.item_id=v.item_id
+        LEFT JOIN categories c ON c.category_id=i.category_id
+        WHERE TRUE {where}
+        ORDER BY v.id
+    """,
+        "v.viewed_at",
+        "i.seller_student_no",
+        "c.path",
+        None,
+    ),
+}
+
+
+class _Writer:
+    """Parquet / Arrow IPC 共用介面，寫到暫存檔，完成後才改名"""
+
+    def __init__(self, path, schema, fmt):
+        self.path = path
+        self.tmp = path + ".part"
+        if fmt == "parquet":
+            self._w = pq.ParquetWriter(self.tmp, schema, compression=COMPRESSION)
+        else:
+            self._sink = pa.OSFile(self.tmp, "wb")
+            self._w = pa.ipc.new_file(
+                self._sink, schema, options=pa.ipc.IpcWriteOptions(compression=COMPRESSION)
+            )
+
+    def write(self, batch):
+        self._w.write_batch(batch)
+
+    def close(self, ok):
+        self._w.close()
+        if hasattr(self, "_sink"):
+            self._sink.close()
+        if ok:
+            os.replace(self.tmp, self.path)
+        else:
+            os.remove(self.tmp)
+
+
+def export_dataset(conn, name, window, fmt, path):
+    sql, time_col, seller_col, path_col, order_col = DATASETS[name]
+    schema = _schemas()[name]
+    writer = _Writer(path, schema, fmt)
+    rows_out = 0
+    ok = False
+    try:
+        # 具名 cursor = server-side cursor，每次只把 CHUNK_ROWS 列拉進記憶體
+        with conn.cursor(name=f"export_{name}") as cur:
+            cur.itersize = CHUNK_ROWS
+            cur.execute(
+                sql.format(where=window.where(time_col, seller_col, path_col, order_col)),
+                window.params(window.start, window.end),
+            )
+            while True:
+                rows = cur.fetchmany(CHUNK_ROWS)
+                if not rows:
+                    break
+                columns = list(zip(*rows))
+                batch = pa.RecordBatch.from_arrays(
+                    [pa.array(col, type=field.type) for col, field in zip(columns, schema)],
+                    schema=schema,
+                )
+                writer.write(batch)
+                rows_out += len(rows)
+        ok = True
+    finally:
+        writer.close(ok)
+    return rows_out
+
+
+def export_range(connect, window, datasets, fmt="parquet", statement_timeout_ms=None):
+    """
+    所有 dataset 在同一個 REPEATABLE READ 唯讀交易內匯出，彼此是一致的快照。
+    回傳每個檔案的 {dataset, path, rows, bytes}。
+    """
+    if pa is None:
+        raise RuntimeError("伺服器未安裝 pyarrow，無法匯出")
+    if fmt not in FORMATS:
+        raise ValueError(f"format 需為 {', '.join(FORMATS)} 之一")
+    unknown = [d for d in datasets if d not in DATASETS]
+    if unknown:
+        raise ValueError(f"未知的 dataset：{', '.join(unknown)}")
+    if not _export_slot.acquire(blocking=False):
+        raise RuntimeError("已有匯出在進行中，請稍後再試")
+
+    try:
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        span = "{}_{}".format(
+            window.start.strftime("%Y%m%d") if window.start else "begin",
+            window.end.strftime("%Y%m%d") if window.end else "now",
+        )
+        ext = "parquet" if fmt == "parquet" else "arrow"
+
+        conn = connect()
+        try:
+            conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+            if statement_timeout_ms:
+                with conn.cursor() as cur:
+                    # 逾時是針對每一次 FETCH，不是整個匯出
+                    cur.execute("SET LOCAL statement_timeout = %s", (statement_timeout_ms,))
+
+            files = []
+            for name in datasets:
+                path = os.path.join(EXPORT_DIR, f"{name}_{span}_{stamp}.{ext}")
+                rows = export_dataset(conn, name, window, fmt, path)
+                files.append({
+                    "dataset": name,
+                    "path": os.path.abspath(path),
+                    "rows": rows,
+                    "bytes": os.path.getsize(path),
+                })
+            conn.rollback()
+        finally:
+            conn.close()
+        return files
+    finally:
+        _export_slot.release()
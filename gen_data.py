@@ -0,0 +1,424 @@
+# ==========================================
+# NTU Marketplace - Synthetic Data Generator
+# 依 scale factor 產生大量測試資料（COPY + 多 process 平行載入）
+#
+#   python gen_data.py --scale 1            # 約 2.5 萬列
+#   python gen_data.py --scale 4000 -w 16   # 約 1 億列
+#
+# 需先匯入 schema.sql；產生的資料接在既有假資料之後，保持外鍵完整。
+# ==========================================
+import argparse
+import io
+import os
+import time
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+import psycopg2
+
+from db_config import DB_CONFIG
+
+# -------- 每個 scale factor 的列數 --------
+USERS_PER_SCALE = 1000
+ITEMS_PER_SCALE = 2000
+ORDERS_PER_SCALE = 3000
+VIEWS_PER_SCALE = 10000
+
+SELLER_RATIO = 0.3          # 有賣家身分的比例
+SUBCATEGORIES = 40          # 額外產生的子分類數
+
+# 偏斜程度：u ** alpha，alpha 越大越集中在前段（熱門商品 / 大賣家）
+SELLER_SKEW = 2.5
+ITEM_SKEW = 3.0
+BUYER_SKEW = 1.5
+
+CHUNK_ROWS = 100000         # 每個平行 task 負責的列數
+COPY_BATCH = 20000          # 每次 COPY 的列數，控制記憶體
+
+HISTORY_DAYS = 365
+VIEW_DAYS = 30
+
+CONDITIONS = ("new", "like-new", "good", "fair", "used")
+CARRIERS = ("7-11", "Familymart", "Post")
+METHODS = ("credit_card", "bank_transfer")
+BROWSERS = ("Chrome", "Safari", "Firefox")
+
+
+# ============================================================
+# 決定性的亂數：同一個 (seed, id, salt) 在任何 process 都得到同樣結果
+# ============================================================
+MASK = (1 << 64) - 1
+
+
+def _mix(x):
+    x = (x + 0x9E3779B97F4A7C15) & MASK
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK
+    return x ^ (x >> 31)
+
+
+def rand(seed, n, salt):
+    """回傳 [0, 1) 的浮點數"""
+    return _mix((seed * 1000003 + n) * 131 + salt) / 2.0 ** 64
+
+
+def skewed(seed, n, salt, size, alpha):
+    """偏斜抽樣：回傳 [0, size)，越小的 index 越常被抽到"""
+    return min(int(size * rand(seed, n, salt) ** alpha), size - 1)
+
+
+# ============================================================
+# 共用的實體屬性（orders phase 需要回推 item 的賣家與價格）
+# ============================================================
+def student_no_of(i):
+    return f"G{i:09d}"
+
+
+def item_seller(ctx, j):
+    return student_no_of(skewed(ctx["seed"], j, 11, ctx["sellers"], SELLER_SKEW))
+
+
+def item_price(ctx, j):
+    return round(50 + rand(ctx["seed"], j, 12) ** 2 * 30000)
+
+
+def ts(ctx, days_ago):
+    return (ctx["now"] - timedelta(days=days_ago)).isoformat(sep=" ", timespec="seconds")
+
+
+def copy_rows(cur, table, columns, rows):
+    """rows 為 list of tuple；None 轉成 \\N"""
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join("\\N" if v is None else str(v) for v in row))
+        buf.write("\n")
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buf)
+
+
+class Batcher:
+    """累積到 COPY_BATCH 列就送出，避免整個 chunk 放在記憶體裡"""
+
+    def __init__(self, cur, table, columns):
+        self.cur = cur
+        self.table = table
+        self.columns = columns
+        self.rows = []
+        self.total = 0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= COPY_BATCH:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            copy_rows(self.cur, self.table, self.columns, self.rows)
+            self.total += len(self.rows)
+            self.rows = []
+
+
+# ============================================================
+# 各 phase 的 worker（在子 process 執行）
+# ============================================================
+def gen_users(ctx, lo, hi, cur):
+    users = Batcher(cur, "users", ("student_no", "email", "password_hash", "full_name",
+                                   "phone", "is_verified", "created_at", "updated_at"))
+    roles = Batcher(cur, "user_roles", ("student_no", "role", "granted_at"))
+    seed = ctx["seed"]
+
+    for i in range(lo, hi):
+        sno = student_no_of(i)
+        created = ts(ctx, 30 + rand(seed, i, 1) * HISTORY_DAYS)
+        users.add((sno, f"g{i:09d}@gen.ntu.edu.tw", f"hash_g{i}", f"測試用戶{i}",
+                   f"09{i % 100000000:08d}", "t" if rand(seed, i, 2) < 0.95 else "f",
+                   created, created))
+        roles.add((sno, "buyer", created))
+        if i < ctx["sellers"]:
+            roles.add((sno, "seller", created))
+
+    users.flush()
+    roles.flush()
+    return users.total + roles.total
+
+
+def gen_items(ctx, lo, hi, cur):
+    items = Batcher(cur, "items", ("item_id", "seller_student_no", "category_id", "title",
+                                   "description", "condition", "quantity", "price",
+                                   "status", "created_at", "updated_at"))
+    images = Batcher(cur, "item_images", ("item_id", "image_url", "sort_order"))
+    seed = ctx["seed"]
+    categories = ctx["categories"]
+
+    for j in range(lo, hi):
+        item_id = ctx["item_base"] + j
+        category_id = categories[int(rand(seed, j, 13) * len(categories))]
+        created = ts(ctx, rand(seed, j, 14) * HISTORY_DAYS)
+        items.add((item_id, item_seller(ctx, j), category_id, f"測試商品 {item_id}",
+                   f"自動產生的商品 #{item_id}", CONDITIONS[int(rand(seed, j, 15) * 5)],
+                   1 + int(rand(seed, j, 16) * 5), item_price(ctx, j), "Listed",
+                   created, created))
+        for k in range(1 + int(rand(seed, j, 17) * 3)):
+            images.add((item_id, f"https://example.com/items/{item_id}_{k + 1}.jpg", k))
+
+    items.flush()
+    images.flush()
+    return items.total + images.total
+
+
+def gen_orders(ctx, lo, hi, cur):
+    orders = Batcher(cur, "orders", ("order_id", "buyer_student_no", "seller_student_no",
+                                     "order_type", "status", "total_amount",
+                                     "consignee_name", "consignee_phone", "shipping_address",
+                                     "created_at", "paid_at", "shipped_at", "completed_at",
+                                     "cancelled_at"))
+    order_items = Batcher(cur, "order_items", ("order_id", "item_id", "qty", "price_each",
+                                               "title_snapshot"))
+    payments = Batcher(cur, "payments", ("order_id", "method", "amount", "status",
+                                         "txn_ref", "paid_at"))
+    shipments = Batcher(cur, "shipments", ("order_id", "carrier", "tracking_no",
+                                           "shipped_at", "delivered_at"))
+    reviews = Batcher(cur, "reviews", ("order_id", "rater_student_no", "ratee_student_no",
+                                       "rating", "comment", "created_at"))
+    seed = ctx["seed"]
+
+    for k in range(lo, hi):
+        order_id = ctx["order_base"] + k
+        j = skewed(seed, k, 21, ctx["items"], ITEM_SKEW)
+        item_id = ctx["item_base"] + j
+        seller = item_seller(ctx, j)
+
+        b = skewed(seed, k, 22, ctx["users"], BUYER_SKEW)
+        buyer = student_no_of(b)
+        if buyer == seller:
+            buyer = student_no_of((b + 1) % ctx["users"])
+
+        qty = 1 if rand(seed, k, 23) < 0.85 else 2
+        price = item_price(ctx, j)
+        total = price * qty
+
+        age = rand(seed, k, 24) * HISTORY_DAYS
+        p = rand(seed, k, 25)
+        if p < 0.05:
+            status = "Cancelled"
+        elif p < 0.15:
+            status = "Paid"
+        elif p < 0.25:
+            status = "Shipped"
+        else:
+            status = "Completed"
+
+        # 時間軸：建立 → 1 小時後付款 → 1 天後出貨 → 3 天後完成（不超過現在）
+        created = ts(ctx, age)
+        paid = ts(ctx, max(age - 1 / 24, 0)) if status != "Cancelled" else None
+        shipped = ts(ctx, max(age - 1, 0)) if status in ("Shipped", "Completed") else None
+        completed = ts(ctx, max(age - 3, 0)) if status == "Completed" else None
+        cancelled = ts(ctx, max(age - 1, 0)) if status == "Cancelled" else None
+
+        orders.add((order_id, buyer, seller, "direct", status, total,
+                    f"測試用戶{b}", None, "校內面交",
+                    created, paid, shipped, completed, cancelled))
+        order_items.add((order_id, item_id, qty, price, f"測試商品 {item_id}"))
+        payments.add((order_id, METHODS[int(rand(seed, k, 26) * 2)], total,
+                      "Refunded" if status == "Cancelled" else "Success",
+                      f"GEN-{order_id}", paid))
+
+        if shipped:
+            shipments.add((order_id, CARRIERS[int(rand(seed, k, 27) * 3)],
+                           f"GEN{order_id:010d}", shipped, completed))
+
+        if completed and rand(seed, k, 28) < 0.6:
+            # 評分偏向高分，和真實平台類似
+            rating = 5 - int(rand(seed, k, 29) ** 2 * 5)
+            reviews.add((order_id, buyer, seller, rating, "自動產生的評價",
+                         ts(ctx, max(age - 4, 0))))
+
+    for batcher in (orders, order_items, payments, shipments, reviews):
+        batcher.flush()
+    return sum(b.total for b in (orders, order_items, payments, shipments, reviews))
+
+
+def gen_views(ctx, lo, hi, cur):
+    views = Batcher(cur, "view_logs", ("student_no", "item_id", "viewed_at", "meta"))
+    seed = ctx["seed"]
+
+    for n in range(lo, hi):
+        item_id = ctx["item_base"] + skewed(seed, n, 31, ctx["items"], ITEM_SKEW)
+        student_no = student_no_of(skewed(seed, n, 32, ctx["users"], BUYER_SKEW))
+        if rand(seed, n, 33) < 0.6:
+            meta = f'{{"device":"mobile","ip":"140.112.{n % 256}.{(n >> 8) % 256}"}}'
+        else:
+            meta = f'{{"device":"web","browser":"{BROWSERS[n % 3]}"}}'
+        views.add((student_no, item_id, ts(ctx, rand(seed, n, 34) * VIEW_DAYS), meta))
+
+    views.flush()
+    return views.total
+
+
+PHASES = [
+    ("users", gen_users, "users"),
+    ("items", gen_items, "items"),
+    ("orders", gen_orders, "orders"),
+    ("view_logs", gen_views, "views"),
+]
+
+
+def run_task(task):
+    name, lo, hi, ctx = task
+    fn = {phase: f for phase, f, _ in PHASES}[name]
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                # 載入期間不觸發 trigger：orders 的 NOTIFY 會每列排一則通知，
+                # cache_versions 的 bump 會讓所有 chunk 搶同一批 shard 列；快取版本在 finish 一次更新。
+                # 外鍵檢查也一併略過，資料本身依序產生、保持完整（需 superuser）
+                cur.execute("SET session_replication_role = replica")
+                return fn(ctx, lo, hi, cur)
+    finally:
+        conn.close()
+
+
+# ============================================================
+# Main（單一 process：準備 context、分派 task、收尾）
+# ============================================================
+def prepare(conn, args):
+    with conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM users WHERE student_no LIKE 'G%' LIMIT 1")
+        if cur.fetchone():
+            raise SystemExit("已經產生過資料，請先重新匯入 schema.sql")
+
+        cur.execute("SELECT COALESCE(MAX(item_id), 0) + 1 FROM items")
+        item_base = cur.fetchone()[0]
+        cur.execute("SELECT COALESCE(MAX(order_id), 0) + 1 FROM orders")
+        order_base = cur.fetchone()[0]
+
+        # 在既有大分類底下補子分類，path 沿用 /Parent/Child/ 格式
+        cur.execute(
+            "SELECT category_id, path FROM categories WHERE parent_category_id IS NULL ORDER BY category_id"
+        )
+        roots = cur.fetchall()
+        cur.execute("SELECT setval('categories_category_id_seq', (SELECT MAX(category_id) FROM categories))")
+        for n in range(SUBCATEGORIES):
+            parent_id, parent_path = roots[n % len(roots)]
+            name = f"Sub {n + 1}"
+            cur.execute(
+                """
+                INSERT INTO categories (name, parent_category_id, path)
+                VALUES (%s, %s, %s)
+            """,
+                (name, parent_id, f"{parent_path}{name}/"),
+            )
+        cur.execute("SELECT category_id FROM categories WHERE parent_category_id IS NOT NULL")
+        categories = [r[0] for r in cur.fetchall()]
+    conn.commit()
+
+    users = max(int(USERS_PER_SCALE * args.scale), 10)
+    return {
+        "seed": args.seed,
+        "now": datetime.now().replace(microsecond=0),
+        "users": users,
+        "sellers": max(int(users * SELLER_RATIO), 1),
+        "items": max(int(ITEMS_PER_SCALE * args.scale), 10),
+        "orders": max(int(ORDERS_PER_SCALE * args.scale), 10),
+        "views": max(int(VIEWS_PER_SCALE * args.scale), 10),
+        "item_base": item_base,
+        "order_base": order_base,
+        "categories": categories,
+    }
+
+
+def finish(conn):
+    """重設 sequence、重算 seller_ratings、一次更新快取版本、更新統計資訊"""
+    with conn.cursor() as cur:
+        for table, col in (
+            ("items", "item_id"),
+            ("item_images", "image_id"),
+            ("orders", "order_id"),
+            ("payments", "payment_id"),
+            ("shipments", "shipment_id"),
+            ("reviews", "review_id"),
+            ("view_logs", "id"),
+        ):
+            cur.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table}', '{col}'), "
+                f"(SELECT COALESCE(MAX({col}), 1) FROM {table}))"
+            )
+
+        cur.execute(
+            """
+            INSERT INTO seller_ratings (seller_student_no, review_count, rating_sum,
+                                        avg_rating, last_review_at)
+            SELECT ratee_student_no, COUNT(*), SUM(rating), ROUND(AVG(rating), 2), MAX(created_at)
+            FROM reviews
+            GROUP BY ratee_student_no
+            ON CONFLICT (seller_student_no)
+            DO UPDATE SET review_count   = EXCLUDED.review_count,
+                          rating_sum     = EXCLUDED.rating_sum,
+                          avg_rating     = EXCLUDED.avg_rating,
+                          last_review_at = EXCLUDED.last_review_at
+        """
+        )
+
+        # 載入時關掉了 trigger：讓所有列表 / 個人頁的 ETag 失效一次
+        cur.execute(
+            """
+            SELECT bump_cache_version(scope, '*')
+            FROM unnest(ARRAY['items', 'ratings', 'users', 'categories']) AS scope
+        """
+        )
+        cur.execute(
+            """
+            SELECT bump_cache_version('orders', buyer_student_no)
+            FROM (SELECT DISTINCT buyer_student_no FROM orders) t
+        """
+        )
+        cur.execute(
+            """
+            SELECT bump_cache_version('selling', seller_student_no)
+            FROM (SELECT DISTINCT seller_student_no FROM items) t
+        """
+        )
+    conn.commit()
+
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("ANALYZE")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NTU Marketplace 大量測試資料產生器")
+    parser.add_argument("-s", "--scale", type=float, default=1.0,
+                        help="scale factor，1 約 2.5 萬列，4000 約 1 億列")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 4,
+                        help="平行載入的 process 數")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        ctx = prepare(conn, args)
+        print(f"[GEN] scale={args.scale} users={ctx['users']} items={ctx['items']} "
+              f"orders={ctx['orders']} views={ctx['views']} workers={args.workers}")
+
+        # phase 之間有外鍵相依，必須依序；phase 內的 chunk 平行
+        with Pool(args.workers) as pool:
+            for name, _, count_key in PHASES:
+                start = time.time()
+                total = ctx[count_key]
+                tasks = [
+                    (name, lo, min(lo + CHUNK_ROWS, total), ctx)
+                    for lo in range(0, total, CHUNK_ROWS)
+                ]
+                rows = sum(pool.imap_unordered(run_task, tasks))
+                print(f"[GEN] {name}: {rows} rows in {time.time() - start:.1f}s")
+
+        start = time.time()
+        finish(conn)
+        print(f"[GEN] finish (sequences / seller_ratings / cache versions / ANALYZE) in {time.time() - start:.1f}s")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
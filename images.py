@@ -0,0 +1,188 @@
+# ==========================================
+# NTU Marketplace - Item Image Store
+# 內容定址（sha256）的本機圖片庫：image_store/ab/cd/<sha256>
+# 同一張圖只存一份；縮圖由背景 pool 產生一次後同樣存進圖片庫
+# ==========================================
+import hashlib
+import io
+import os
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:     # Pillow 為選用，沒裝時不產生縮圖
+    Image = None
+
+IMAGE_DIR = "image_store"
+MAX_IMAGE_BYTES = 8 * 1024 * 1024
+READ_CHUNK = 64 * 1024
+THUMB_SIZE = (256, 256)
+THUMB_WORKERS = 2
+
+SHA_RE = re.compile(r"^[0-9a-f]{64}$")
+
+# 只收常見的圖片格式，用檔頭判斷，不信任 client 宣稱的型別
+MAGIC = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+
+def sniff(head):
+    for magic, content_type in MAGIC:
+        if head.startswith(magic):
+            return content_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+class ImageStore:
+    def __init__(self, root=IMAGE_DIR):
+        self.root = root
+        os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+
+    def path(self, sha):
+        if not SHA_RE.match(sha or ""):
+            raise ValueError("圖片代碼格式錯誤")
+        return os.path.join(self.root, sha[:2], sha[2:4], sha)
+
+    def exists(self, sha):
+        return os.path.exists(self.path(sha))
+
+    def put_stream(self, chunks):
+        """
+        邊收邊寫暫存檔邊算 hash，記憶體只放一個 chunk。
+        回傳 (sha256, size, content_type)；內容相同的檔案只保留一份。
+        """
+        digest = hashlib.sha256()
+        size = 0
+        head = b""
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.root, "tmp"))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > MAX_IMAGE_BYTES:
+                        raise ValueError(f"圖片超過 {MAX_IMAGE_BYTES // (1024 * 1024)} MB")
+                    if len(head) < 16:
+                        head += chunk[:16 - len(head)]
+                    digest.update(chunk)
+                    f.write(chunk)
+
+            content_type = sniff(head)
+            if content_type is None:
+                raise ValueError("只接受 JPEG / PNG / GIF / WebP")
+
+            sha = digest.hexdigest()
+            final = self.path(sha)
+            if os.path.exists(final):
+                os.remove(tmp)
+            else:
+                os.makedirs(os.path.dirname(final), exist_ok=True)
+                os.replace(tmp, final)      # 同目錄內改名是原子的
+            return sha, size, content_type
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def put_bytes(self, data):
+        return self.put_stream([data])
+
+
+def make_thumbnail(path):
+    with Image.open(path) as im:
+        im.thumbnail(THUMB_SIZE)
+        if im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        buf = io.BytesIO()
+        im.save(buf, format="JPEG", quality=80)
+        return buf.getvalue()
+
+
+class ThumbnailPool:
+    """
+    上傳後把縮圖工作丟進背景 pool；同一張原圖（sha）只產生一次，
+    結果記在 item_images.thumb_sha256（不另外在記憶體快取，圖片再多也不會長大）。
+    """
+
+    def __init__(self, store, connect, workers=THUMB_WORKERS):
+        self.store = store
+        self._connect = connect
+        self.workers = workers
+        self._executor = None
+
+    @property
+    def enabled(self):
+        return Image is not None
+
+    def submit(self, sha):
+        if self.enabled and self._executor is not None:
+            self._executor.submit(self._run, sha)
+
+    def _run(self, sha):
+        try:
+            conn = self._connect()
+            try:
+                # 同一張原圖的其他列可能已經有縮圖（例如重複排進 pool）
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """
+                        SELECT thumb_sha256 FROM item_images
+                        WHERE sha256=%s AND thumb_sha256 IS NOT NULL LIMIT 1
+                    """,
+                        (sha,),
+                    )
+                    row = cur.fetchone()
+                conn.rollback()
+                if row:
+                    thumb = row[0]
+                else:
+                    thumb, _, _ = self.store.put_bytes(make_thumbnail(self.store.path(sha)))
+
+                with conn:
+                    with conn.cursor() as cur:
+                        cur.execute(
+                            """
+                            UPDATE item_images SET thumb_sha256=%s
+                            WHERE sha256=%s AND thumb_sha256 IS NULL
+                        """,
+                            (thumb, sha),
+                        )
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"[IMAGES] thumbnail {sha[:12]} failed:", e)
+
+    def backfill(self):
+        """啟動時補做上次沒做完的縮圖"""
+        if not self.enabled:
+            return
+        conn = self._connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT DISTINCT sha256 FROM item_images
+                    WHERE sha256 IS NOT NULL AND thumb_sha256 IS NULL
+                """
+                )
+                pending = [r[0] for r in cur.fetchall()]
+            conn.rollback()
+        finally:
+            conn.close()
+        for sha in pending:
+            self.submit(sha)
+
+    def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="thumb")
+        self.backfill()
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,151 @@
+# ==========================================
+# NTU Marketplace - Order Status Push
+# orders 上的 trigger 發 NOTIFY，這裡 LISTEN 後推給已連線的買家 / 賣家
+# ==========================================
+import json
+import select
+import socket
+import threading
+import time
+
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+CHANNEL = "order_events"
+HEARTBEAT_SECONDS = 30      # 沒事件時多久送一次 ping，順便偵測斷線
+MAX_SUBSCRIBERS = 1000
+RECONNECT_DELAY = 2
+
+
+class Subscription:
+    def __init__(self, student_no, sock):
+        self.student_no = student_no
+        self.sock = sock
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def push(self, msg):
+        line = json.dumps(msg, ensure_ascii=False) + "\n"
+        with self._lock:
+            self.sock.sendall(line.encode("utf-8"))
+
+
+class OrderNotifier:
+    def __init__(self, connect):
+        self._connect = connect
+        self._subs = {}         # student_no -> set(Subscription)
+        self._count = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # -------- subscriptions --------
+    def register(self, student_no, sock):
+        with self._lock:
+            if self._count >= MAX_SUBSCRIBERS:
+                return None
+            sub = Subscription(student_no, sock)
+            self._subs.setdefault(student_no, set()).add(sub)
+            self._count += 1
+        return sub
+
+    def unregister(self, sub):
+        with self._lock:
+            subs = self._subs.get(sub.student_no)
+            if subs and sub in subs:
+                subs.discard(sub)
+                self._count -= 1
+                if not subs:
+                    del self._subs[sub.student_no]
+        sub.closed = True
+
+    def _targets(self, student_no):
+        with self._lock:
+            return list(self._subs.get(student_no, ()))
+
+    # -------- NOTIFY → push --------
+    def dispatch(self, ev):
+        """
+        ev 來自 trigger：{order_id, op, status, old_status, buyer, seller, total_amount}
+        買家收到狀態變化；賣家收到新訂單與狀態變化。
+        """
+        if ev["op"] == "INSERT":
+            self._send(ev["seller"], {"type": "order.new", **ev})
+            self._send(ev["buyer"], {"type": "order.status", **ev})
+        else:
+            self._send(ev["buyer"], {"type": "order.status", **ev})
+            self._send(ev["seller"], {"type": "order.status", **ev})
+
+    def _send(self, student_no, msg):
+        for sub in self._targets(student_no):
+            try:
+                sub.push(msg)
+            except OSError:
+                self.unregister(sub)
+
+    def _listen(self):
+        conn = self._connect()
+        try:
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {CHANNEL}")
+
+            while not self._stop.is_set():
+                if select.select([conn], [], [], 1.0) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    n = conn.notifies.pop(0)
+                    try:
+                        self.dispatch(json.loads(n.payload))
+                    except Exception as e:
+                        print("[NOTIFY] bad payload:", e)
+        finally:
+            conn.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._listen()
+            except Exception as e:
+                print("[NOTIFY] listener error, reconnecting:", e)
+                time.sleep(RECONNECT_DELAY)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止 LISTEN，並關閉所有訂閱連線（client 端會看到通知中斷）"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            subs = [sub for group in self._subs.values() for sub in group]
+        for sub in subs:
+            sub.closed = True
+            try:
+                sub.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    # -------- 長連線：在 client handler 的執行緒裡跑到對方斷線為止 --------
+    def serve(self, student_no, sock):
+        sub = self.register(student_no, sock)
+        if sub is None:
+            sock.sendall(b'{"status": "fail", "message": "too many subscribers"}\n')
+            return
+
+        try:
+            sub.push({"status": "ok", "message": "subscribed", "student_no": student_no})
+            sock.settimeout(HEARTBEAT_SECONDS)
+            while not self._stop.is_set() and not sub.closed:
+                try:
+                    if not sock.recv(1024):
+                        break           # client 關閉連線
+                except TimeoutError:
+                    sub.push({"type": "ping", "ts": int(time.time())})
+        except OSError:
+            pass
+        finally:
+            self.unregister(sub)
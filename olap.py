@@ -0,0 +1,166 @@
+# ==========================================
+# NTU Marketplace - Embedded OLAP Backend
+# 定期把報表用到的表 COPY 成 CSV 載入 DuckDB（欄式、向量化執行），
+# 後台 analytics / nosql 查詢改在這裡跑，不再佔用 OLTP 資料庫
+# ==========================================
+import os
+import re
+import tempfile
+import threading
+import time
+
+try:
+    import duckdb
+except ImportError:     # duckdb 為選用，沒裝時報表一律走 Postgres
+    duckdb = None
+
+SYNC_INTERVAL = 300         # 秒
+
+# table -> (Postgres 端 SELECT, DuckDB 欄位型別)
+# 只同步報表用得到的欄位；JSONB 先以文字載入再轉成 DuckDB 的 JSON
+TABLES = {
+    "categories": (
+        "SELECT category_id, name, parent_category_id, path FROM categories",
+        {"category_id": "INTEGER", "name": "VARCHAR", "parent_category_id": "INTEGER",
+         "path": "VARCHAR"},
+    ),
+    "items": (
+        "SELECT item_id, seller_student_no, category_id, title, price, status FROM items",
+        {"item_id": "INTEGER", "seller_student_no": "VARCHAR", "category_id": "INTEGER",
+         "title": "VARCHAR", "price": "DECIMAL(12,2)", "status": "VARCHAR"},
+    ),
+    "orders": (
+        """SELECT order_id, buyer_student_no, seller_student_no, order_type, status,
+                  total_amount, created_at, paid_at, shipped_at, completed_at
+           FROM orders""",
+        {"order_id": "INTEGER", "buyer_student_no": "VARCHAR", "seller_student_no": "VARCHAR",
+         "order_type": "VARCHAR", "status": "VARCHAR", "total_amount": "DECIMAL(12,2)",
+         "created_at": "TIMESTAMP", "paid_at": "TIMESTAMP", "shipped_at": "TIMESTAMP",
+         "completed_at": "TIMESTAMP"},
+    ),
+    "order_items": (
+        "SELECT order_id, item_id, qty, price_each, title_snapshot FROM order_items",
+        {"order_id": "INTEGER", "item_id": "INTEGER", "qty": "INTEGER",
+         "price_each": "DECIMAL(12,2)", "title_snapshot": "VARCHAR"},
+    ),
+    "reviews": (
+        """SELECT review_id, order_id, rater_student_no, ratee_student_no, rating, created_at
+           FROM reviews""",
+        {"review_id": "INTEGER", "order_id": "INTEGER", "rater_student_no": "VARCHAR",
+         "ratee_student_no": "VARCHAR", "rating": "SMALLINT", "created_at": "TIMESTAMP"},
+    ),
+    "view_logs": (
+        "SELECT id, student_no, item_id, viewed_at, meta FROM view_logs",
+        {"id": "INTEGER", "student_no": "VARCHAR", "item_id": "INTEGER",
+         "viewed_at": "TIMESTAMP", "meta": "VARCHAR"},
+    ),
+}
+
+JSON_COLUMNS = {"view_logs": ("meta",)}
+
+PARAM_RE = re.compile(r"%\((\w+)\)s")
+LIKE_PARAM_RE = re.compile(r"LIKE %\((\w+)\)s")
+
+
+def to_duckdb(sql, params):
+    """
+    psycopg2 的 %(name)s → DuckDB 的 $name，只保留 SQL 裡真的有用到的參數。
+    Postgres 的 LIKE 預設以反斜線跳脫，DuckDB 沒有預設，要明寫 ESCAPE。
+    """
+    sql = LIKE_PARAM_RE.sub(r"LIKE $\1 ESCAPE '\\'", sql)
+    sql = PARAM_RE.sub(r"$\1", sql)
+    used = set(re.findall(r"\$(\w+)", sql))
+    return sql, {k: v for k, v in params.items() if k in used}
+
+
+def load_snapshot(conn):
+    """
+    在同一個 REPEATABLE READ 交易內把所有表 COPY 出來，
+    載入一個新的 in-memory DuckDB，回傳 (db, 各表列數)。
+    """
+    db = duckdb.connect(":memory:")
+    counts = {}
+    conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+    try:
+        with tempfile.TemporaryDirectory(prefix="olap-") as tmp:
+            for table, (select_sql, columns) in TABLES.items():
+                path = os.path.join(tmp, f"{table}.csv")
+                with open(path, "w", encoding="utf-8", newline="") as f:
+                    with conn.cursor() as cur:
+                        cur.copy_expert(f"COPY ({select_sql}) TO STDOUT WITH (FORMAT csv, HEADER)", f)
+
+                col_spec = ", ".join(f"'{c}': '{t}'" for c, t in columns.items())
+                casts = ", ".join(f"{c}::JSON AS {c}" for c in JSON_COLUMNS.get(table, ()))
+                projection = f"* REPLACE ({casts})" if casts else "*"
+                db.execute(
+                    f"CREATE TABLE {table} AS SELECT {projection} "
+                    f"FROM read_csv('{path}', header=true, columns={{{col_spec}}})"
+                )
+                counts[table] = db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        conn.rollback()
+    except Exception:
+        db.close()
+        raise
+    return db, counts
+
+
+class OlapStore:
+    """持有目前的 DuckDB 快照；背景執行緒定期重新同步，完成後整個替換。"""
+
+    def __init__(self, connect, interval=SYNC_INTERVAL):
+        self._connect = connect
+        self.interval = interval
+        self._db = None
+        self._lock = threading.Lock()
+        self.synced_at = None
+        self.counts = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self._db is not None
+
+    def sync(self):
+        conn = self._connect()
+        try:
+            db, counts = load_snapshot(conn)
+        finally:
+            conn.close()
+        with self._lock:
+            # 舊快照上還在跑的查詢持有自己的 cursor，不受影響
+            self._db = db
+            self.synced_at = time.time()
+            self.counts = counts
+
+    def query(self, sql, params):
+        """執行 psycopg2 風格的 SQL，回傳 list of dict（欄位名稱同 RealDictCursor）"""
+        sql, params = to_duckdb(sql, params)
+        with self._lock:
+            cur = self._db.cursor()
+        try:
+            cur.execute(sql, params)
+            names = [d[0] for d in cur.description]
+            return [dict(zip(names, row)) for row in cur.fetchall()]
+        finally:
+            cur.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                start = time.time()
+                self.sync()
+                print(f"[OLAP] synced {self.counts} in {time.time() - start:.1f}s")
+            except Exception as e:
+                print("[OLAP] sync failed:", e)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self._thread is not None:
+            self._thread.join()     # stop() 不等執行緒；重新啟動前確定上一輪已結束
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
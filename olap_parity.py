@@ -0,0 +1,103 @@
+# ==========================================
+# NTU Marketplace - OLAP Parity Check
+# 同一組報表參數分別在 Postgres 與 DuckDB 快照上跑，比對結果是否一致
+#
+#   python olap_parity.py
+#   python olap_parity.py --start 2025-01-01 --end 2026-01-01
+#
+# 需先 pip install duckdb；同步後到比對前資料若有寫入，結果可能有落差。
+# ==========================================
+import argparse
+import sys
+from datetime import datetime
+
+import server
+from olap import OlapStore, duckdb
+
+# (報表, 比對方式)：full = 整份結果當集合比對；其他 = 只比對該欄依序的值（Top N 同分時順序不定）
+REPORTS = [
+    (server.analytics_category_revenue, "full"),
+    (server.analytics_monthly_revenue, "full"),
+    (server.analytics_seller_rating, "full"),
+    (server.analytics_top_items, "total_sold"),
+    (server.analytics_category_rollup, "full"),
+    (server.nosql_mobile_views, "viewed_at"),
+    (server.nosql_hot_views, "views"),
+]
+
+
+def normalize(value):
+    if isinstance(value, float):
+        return round(value, 2)
+    return value
+
+
+def compare(pg, olap, mode):
+    if mode == "full":
+        a = sorted(tuple(sorted((k, normalize(v)) for k, v in r.items())) for r in pg)
+        b = sorted(tuple(sorted((k, normalize(v)) for k, v in r.items())) for r in olap)
+    else:
+        a = [normalize(r[mode]) for r in pg]
+        b = [normalize(r[mode]) for r in olap]
+    return a == b
+
+
+def run(report, req, backend):
+    server.OLAP = backend
+    conn = server.ROUTER.acquire(read_only=True)
+    try:
+        window = server.analytics_window(conn, req)
+        return report(conn, window)
+    finally:
+        server.ROUTER.release(conn)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DuckDB 報表與 Postgres 報表的一致性檢查")
+    parser.add_argument("--start", default=None, help="YYYY-MM-DD")
+    parser.add_argument("--end", default=None, help="YYYY-MM-DD，不含")
+    parser.add_argument("--seller", default=None)
+    parser.add_argument("--category-id", type=int, default=None)
+    args = parser.parse_args()
+
+    if duckdb is None:
+        print("需先 pip install duckdb")
+        sys.exit(2)
+
+    store = OlapStore(server.get_read_connection)
+    store.sync()
+    print(f"[PARITY] snapshot loaded: {store.counts}")
+
+    year = datetime.now().year
+    windows = [
+        {},
+        {"start": args.start or f"{year - 1}-01-01", "end": args.end or f"{year}-01-01",
+         "granularity": "week"},
+    ]
+    if args.seller or args.category_id is not None:
+        windows.append({
+            "start": args.start, "end": args.end,
+            "seller": args.seller, "category_id": args.category_id,
+        })
+
+    failed = 0
+    for report, mode in REPORTS:
+        for req in windows:
+            pg = run(report, req, None)
+            olap = run(report, req, store)
+            if pg["status"] != "ok" or olap["status"] != "ok":
+                ok = pg["status"] == olap["status"]
+            else:
+                ok = compare(pg["data"], olap["data"], mode)
+            failed += not ok
+            print(f"[{'OK' if ok else 'DIFF'}] {report.__name__} {req}")
+            if not ok:
+                print("    postgres:", pg.get("data", pg.get("message"))[:5])
+                print("    duckdb:  ", olap.get("data", olap.get("message"))[:5])
+
+    print(f"[PARITY] {failed} mismatch(es)")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
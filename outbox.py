@@ -0,0 +1,379 @@
+# ==========================================
+# NTU Marketplace - Transactional Outbox Dispatcher
+# handler 在同一交易內寫 outbox_events，這裡批次讀出後分送給訂閱者
+# ==========================================
+import json
+import queue
+import select
+import socket
+import struct
+import threading
+import time
+
+from psycopg2.extras import Json
+
+POLL_INTERVAL = 0.5         # 秒
+BATCH_SIZE = 500
+RETRY_BASE = 1.0            # 秒，訂閱者失敗後第 n 次重試前等 RETRY_BASE * 2^(n-1)
+RETRY_MAX = 60.0
+STOP_TIMEOUT = 10           # 秒，stop() 最多等 dispatcher 執行緒多久
+PRUNE_INTERVAL = 60         # 秒，多久清一次所有 consumer 都已處理過的事件
+PRUNE_BATCH = 10000         # 每次 DELETE 的列數，避免一個大交易鎖太久
+FEED_QUEUE_SIZE = 1000      # 每個 feed client 最多暫存幾個還沒送出的事件
+FEED_SEND_TIMEOUT = 10      # 秒，對方不讀時 sendall 最多卡多久
+
+FEED_HOST = "127.0.0.1"
+FEED_PORT = 5001
+
+# 位置 = (txid, event_id)。
+# 只讀 txid < 目前 snapshot xmin 的事件：這些交易都已結束，之後不可能再冒出
+# 排在前面的事件，所以游標只會往前、不會漏掉還沒 commit 的較小 event_id。
+FETCH_SQL = """
+    SELECT txid::text::bigint, event_id, event_type, aggregate_type, aggregate_id,
+           payload, created_at
+    FROM outbox_events
+    WHERE (txid, event_id) > (%s::text::xid8, %s)
+      AND txid < pg_snapshot_xmin(pg_current_snapshot())
+    ORDER BY txid, event_id
+    LIMIT %s
+"""
+
+
+# 刪除位置 <= 所有 consumer 中最小 offset 的事件（依 (txid, event_id) 索引由舊到新）
+PRUNE_SQL = """
+    DELETE FROM outbox_events
+    WHERE event_id IN (
+        SELECT event_id FROM outbox_events
+        WHERE (txid, event_id) <= (%s::text::xid8, %s)
+        ORDER BY txid, event_id
+        LIMIT %s
+    )
+"""
+
+
+def emit_event(cur, event_type, aggregate_type, aggregate_id, payload):
+    """在呼叫端的交易內寫入 outbox（交易 rollback 時事件也一起消失）"""
+    cur.execute(
+        """
+        INSERT INTO outbox_events (event_type, aggregate_type, aggregate_id, payload)
+        VALUES (%s, %s, %s, %s)
+    """,
+        (event_type, aggregate_type, aggregate_id, Json(payload)),
+    )
+
+
+class Subscriber:
+    def __init__(self, name, callback, auto_commit):
+        self.name = name
+        self.callback = callback
+        self.auto_commit = auto_commit   # False：等對方 ack 才寫回 offset
+        self.cursor = (0, 0)             # 已送出的位置（記憶體）
+        self.failures = 0
+        self.retry_at = 0.0              # 失敗後退避，期間不送、也不擋其他訂閱者
+
+
+class OutboxDispatcher:
+    """
+    at-least-once：offset 只在訂閱者處理成功（或 ack）之後才寫回，
+    重啟或重連時從最後寫回的位置重送。
+    """
+
+    def __init__(self, connect, interval=POLL_INTERVAL, batch_size=BATCH_SIZE):
+        self._connect = connect
+        self.interval = interval
+        self.batch_size = batch_size
+        self._subs = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # -------- subscription --------
+    def subscribe(self, name, callback, auto_commit=True):
+        sub = Subscriber(name, callback, auto_commit)
+        sub.cursor = self.load_offset(name)
+        with self._lock:
+            if name in self._subs:
+                raise ValueError(f"consumer {name} 已經在線上")
+            self._subs[name] = sub
+        return sub
+
+    def unsubscribe(self, name):
+        with self._lock:
+            self._subs.pop(name, None)
+
+    # -------- offsets --------
+    def load_offset(self, name):
+        conn = self._connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT last_txid, last_event_id FROM outbox_offsets WHERE consumer=%s",
+                    (name,),
+                )
+                row = cur.fetchone()
+        finally:
+            conn.close()
+        return (row[0], row[1]) if row else (0, 0)
+
+    def commit(self, name, position):
+        conn = self._connect()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """
+                        INSERT INTO outbox_offsets (consumer, last_txid, last_event_id, updated_at)
+                        VALUES (%s, %s, %s, NOW())
+                        ON CONFLICT (consumer)
+                        DO UPDATE SET last_txid=EXCLUDED.last_txid,
+                                      last_event_id=EXCLUDED.last_event_id,
+                                      updated_at=EXCLUDED.updated_at
+                        WHERE (outbox_offsets.last_txid, outbox_offsets.last_event_id)
+                              < (EXCLUDED.last_txid, EXCLUDED.last_event_id)
+                    """,
+                        (name, position[0], position[1]),
+                    )
+        finally:
+            conn.close()
+
+    # -------- dispatch --------
+    def fetch(self, conn, cursor):
+        with conn.cursor() as cur:
+            cur.execute(FETCH_SQL, (cursor[0], cursor[1], self.batch_size))
+            rows = cur.fetchall()
+        conn.rollback()
+        return [
+            {
+                "txid": r[0],
+                "event_id": r[1],
+                "event_type": r[2],
+                "aggregate_type": r[3],
+                "aggregate_id": r[4],
+                "payload": r[5],
+                "created_at": r[6].isoformat(sep=" ", timespec="seconds"),
+            }
+            for r in rows
+        ]
+
+    def deliver(self, sub, events):
+        """依序送給單一訂閱者；失敗就停在該事件並進入退避，不影響其他訂閱者"""
+        before = sub.cursor
+        for ev in events:
+            pos = (ev["txid"], ev["event_id"])
+            try:
+                sub.callback(ev)
+            except Exception as e:
+                sub.failures += 1
+                delay = min(RETRY_BASE * 2 ** (sub.failures - 1), RETRY_MAX)
+                sub.retry_at = time.monotonic() + delay
+                print(f"[OUTBOX] consumer {sub.name} failed at {pos}, retry in {delay:.0f}s: {e}")
+                break
+            sub.cursor = pos
+        else:
+            sub.failures = 0
+
+        if sub.auto_commit and sub.cursor != before:
+            try:
+                self.commit(sub.name, sub.cursor)
+            except Exception as e:
+                print(f"[OUTBOX] commit offset failed ({sub.name}):", e)
+
+    def poll_once(self):
+        """
+        每個訂閱者從自己的游標讀（同一個位置的共用一次查詢），
+        慢的或一直失敗的訂閱者不會把其他人拖在後面。回傳單一訂閱者最多拿到的事件數。
+        """
+        now = time.monotonic()
+        with self._lock:
+            subs = [s for s in self._subs.values() if s.retry_at <= now]
+        if not subs:
+            return 0
+
+        fetched = {}
+        conn = self._connect()
+        try:
+            for sub in subs:
+                if sub.cursor not in fetched:
+                    fetched[sub.cursor] = self.fetch(conn, sub.cursor)
+        finally:
+            conn.close()
+
+        for sub in subs:
+            self.deliver(sub, fetched[sub.cursor])
+
+        return max(len(events) for events in fetched.values())
+
+    # -------- 清理 --------
+    def prune(self, batch=PRUNE_BATCH):
+        """
+        刪掉所有 consumer 都已寫回 offset 的事件，回傳刪除筆數。
+        線上有訂閱者還沒寫回過 offset（會從頭讀）時不刪；
+        不再使用的 consumer 需從 outbox_offsets 移除，否則會一直擋住清理。
+        """
+        with self._lock:
+            names = list(self._subs)
+        conn = self._connect()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT consumer, last_txid, last_event_id FROM outbox_offsets")
+                    offsets = {r[0]: (r[1], r[2]) for r in cur.fetchall()}
+                    if not offsets or any(name not in offsets for name in names):
+                        return 0
+                    low_txid, low_event_id = min(offsets.values())
+                    cur.execute(PRUNE_SQL, (low_txid, low_event_id, batch))
+                    return cur.rowcount
+        finally:
+            conn.close()
+
+    def _prune_all(self):
+        total = 0
+        while not self._stop.is_set():
+            n = self.prune()
+            total += n
+            if n < PRUNE_BATCH:
+                break
+        if total:
+            print(f"[OUTBOX] pruned {total} delivered event(s)")
+
+    def _run(self):
+        next_prune = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                n = self.poll_once()
+            except Exception as e:
+                print("[OUTBOX] poll failed:", e)
+                n = 0
+            if time.monotonic() >= next_prune:
+                next_prune = time.monotonic() + PRUNE_INTERVAL
+                try:
+                    self._prune_all()
+                except Exception as e:
+                    print("[OUTBOX] prune failed:", e)
+            # 滿批代表還有積壓，馬上再抓
+            if n < self.batch_size:
+                self._stop.wait(self.interval)
+
+    def start(self):
+        # stop() 可能在投遞還沒結束時就放棄等待：舊執行緒還在跑就不能再起一個，
+        # 否則兩個執行緒會同時投遞、搶著寫 offset
+        if self._thread is not None:
+            self._thread.join(STOP_TIMEOUT)
+            if self._thread.is_alive():
+                raise RuntimeError("outbox dispatcher 上一輪的執行緒還在投遞，無法重新啟動")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """
+        等目前這輪投遞結束，最多 timeout 秒；卡在慢訂閱者的投遞不會擋住關機。
+        沒投遞完的事件 offset 還沒推進，下次啟動會重送。
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                print(f"[OUTBOX] dispatcher still busy after {timeout}s, not waiting")
+
+
+# ============================================================
+# NDJSON feed：外部 consumer 連上 FEED_PORT 訂閱
+#   → {"consumer": "search-indexer"}
+#   ← 一行一個事件（含 txid / event_id）
+#   → {"ack": [txid, event_id]}      處理完成後回報，才會寫回 offset
+# ============================================================
+def handle_feed_client(dispatcher, conn_sock):
+    name = None
+    out = None
+    try:
+        reader = conn_sock.makefile("r", encoding="utf-8")
+        hello = json.loads(reader.readline() or "{}")
+        name = hello.get("consumer")
+        if not name:
+            conn_sock.sendall(b'{"status": "fail", "message": "consumer required"}\n')
+            return
+
+        # dispatcher 執行緒只把事件放進有上限的佇列，真正 sendall 在這條連線自己的 writer 執行緒
+        out = queue.Queue(maxsize=FEED_QUEUE_SIZE)
+        conn_sock.setsockopt(
+            socket.SOL_SOCKET, socket.SO_SNDTIMEO, struct.pack("ll", FEED_SEND_TIMEOUT, 0)
+        )
+
+        def push(ev):
+            try:
+                out.put_nowait(ev)
+            except queue.Full:
+                raise RuntimeError("feed client 跟不上，佇列已滿") from None
+
+        def writer():
+            try:
+                while True:
+                    ev = out.get()
+                    if ev is None:
+                        return
+                    line = json.dumps(ev, ensure_ascii=False) + "\n"
+                    conn_sock.sendall(line.encode("utf-8"))
+            except OSError as e:
+                # 對方不讀（送出逾時）或已斷線：關掉連線，讀取迴圈結束後取消訂閱
+                print(f"[OUTBOX] feed client {name} send failed:", e)
+                try:
+                    conn_sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+        threading.Thread(target=writer, daemon=True).start()
+
+        try:
+            dispatcher.subscribe(f"feed:{name}", push, auto_commit=False)
+        except ValueError as e:
+            conn_sock.sendall((json.dumps({"status": "fail", "message": str(e)}) + "\n").encode("utf-8"))
+            name = None
+            return
+
+        for line in reader:
+            msg = json.loads(line)
+            if "ack" in msg:
+                txid, event_id = msg["ack"]
+                dispatcher.commit(f"feed:{name}", (int(txid), int(event_id)))
+
+    except Exception as e:
+        print("[OUTBOX] feed client error:", e)
+    finally:
+        if name:
+            dispatcher.unsubscribe(f"feed:{name}")
+        if out is not None:
+            try:
+                out.put_nowait(None)
+            except queue.Full:
+                pass
+        conn_sock.close()
+
+
+def serve_feed(dispatcher, host=FEED_HOST, port=FEED_PORT, sock=None):
+    """
+    sock：繼承來的 listening socket（熱重啟 handoff）；沒有才自己 bind。
+    dispatcher.stop() 後一秒內停止 accept，回傳 (socket, accept 執行緒)。
+    """
+    s = sock
+    if s is None:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((host, port))
+        s.listen(5)
+
+    def accept_loop():
+        while not dispatcher._stop.is_set():
+            if not select.select([s], [], [], 1.0)[0]:
+                continue
+            try:
+                client, _ = s.accept()
+            except OSError:
+                continue
+            threading.Thread(
+                target=handle_feed_client, args=(dispatcher, client), daemon=True
+            ).start()
+
+    t = threading.Thread(target=accept_loop, daemon=True)
+    t.start()
+    return s, t
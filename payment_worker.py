@@ -0,0 +1,333 @@
+# ==========================================
+# NTU Marketplace - Payment Worker
+# confirm_payment 只把付款標記為「已送出」（payments.next_attempt_at），
+# 真正呼叫金流在這裡：背景 dispatcher 以 SKIP LOCKED 認領到期的 Pending 付款，
+# 交給固定大小的 worker pool 呼叫 gateway，不在任何商品 / 訂單鎖內等網路
+# ==========================================
+import random
+import threading
+from abc import ABC, abstractmethod
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from outbox import emit_event
+from reservations import release_orders
+
+PAYMENT_WORKERS = 8
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 2.0          # 秒，第 n 次失敗後等 BACKOFF_BASE * 2^(n-1)
+BACKOFF_MAX = 60.0
+LEASE_SECONDS = 60          # 認領後的租期；行程掛掉時付款過期後會被重新認領
+POLL_SECONDS = 1.0
+
+
+class GatewayDeclined(Exception):
+    """金流明確拒絕（卡片被拒、餘額不足），不重試"""
+
+
+class GatewayUnavailable(Exception):
+    """逾時 / 暫時性錯誤，可重試"""
+
+
+class Gateway(ABC):
+    """
+    金流介面。charge 以 idempotency_key 去重：同一筆付款重試時
+    gateway 若已扣過款，必須回傳同一個 txn_ref 而不是再扣一次。
+    """
+
+    name = "gateway"
+
+    @abstractmethod
+    def charge(self, idempotency_key, amount):
+        """成功回傳 txn_ref；失敗丟 GatewayDeclined / GatewayUnavailable"""
+
+    @abstractmethod
+    def refund(self, txn_ref, amount):
+        """退回已扣款的 txn_ref"""
+
+
+class SimulatedGateway(Gateway):
+    """本機模擬金流：固定延遲（含抖動）＋ 可設定的暫時失敗率 / 拒絕率"""
+
+    name = "simulated"
+
+    def __init__(self, latency_ms=300, failure_rate=0.05, decline_rate=0.01, seed=None):
+        self.latency_ms = latency_ms
+        self.failure_rate = failure_rate
+        self.decline_rate = decline_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._charges = {}          # idempotency_key -> txn_ref
+        self._seq = 0
+
+    def _roll(self):
+        with self._lock:
+            return self._rng.random(), self._rng.uniform(0.5, 1.5)
+
+    def charge(self, idempotency_key, amount):
+        roll, jitter = self._roll()
+        time.sleep(self.latency_ms * jitter / 1000)
+
+        with self._lock:
+            if idempotency_key in self._charges:
+                return self._charges[idempotency_key]
+        if roll < self.failure_rate:
+            raise GatewayUnavailable("gateway timeout")
+        if roll < self.failure_rate + self.decline_rate:
+            raise GatewayDeclined("card declined")
+
+        with self._lock:
+            self._seq += 1
+            txn_ref = f"SIM-{self._seq:08d}"
+            self._charges[idempotency_key] = txn_ref
+        return txn_ref
+
+    def refund(self, txn_ref, amount):
+        time.sleep(self.latency_ms / 1000)
+
+
+# 只認領訂單仍是 Created 的付款；認領時先把 next_attempt_at 推到租期之後
+CLAIM_SQL = """
+    UPDATE payments p
+    SET attempts = p.attempts + 1,
+        next_attempt_at = NOW() + make_interval(secs => %(lease)s)
+    FROM (
+        SELECT p.payment_id
+        FROM payments p
+        JOIN orders o ON o.order_id = p.order_id
+        WHERE p.status='Pending' AND p.next_attempt_at <= NOW()
+          AND o.status='Created'
+        ORDER BY p.next_attempt_at
+        LIMIT %(n)s
+        FOR UPDATE OF p SKIP LOCKED
+    ) due
+    WHERE p.payment_id = due.payment_id
+    RETURNING p.payment_id, p.order_id, p.amount, p.attempts
+"""
+
+
+class PaymentWorker:
+    """
+    dispatcher 執行緒只在 pool 有空位時才認領（最多 workers 筆同時在跑），
+    所以待處理的佇列留在資料庫，不會在記憶體無限堆積；多個 server 行程可同時跑。
+    """
+
+    def __init__(self, connect, gateway, workers=PAYMENT_WORKERS, max_attempts=MAX_ATTEMPTS,
+                 backoff=BACKOFF_BASE, poll=POLL_SECONDS, metrics=None):
+        self._connect = connect
+        self.gateway = gateway
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll = poll
+        self.metrics = metrics
+        self._executor = None
+        self._local = threading.local()
+        self._conns = []            # 各 worker 執行緒各自一條連線，stop 時關閉
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"paid": 0, "retried": 0, "failed": 0, "refunded": 0}
+
+    def wake(self):
+        """confirm_payment 送出付款後叫醒 dispatcher，不必等下一次輪詢"""
+        self._wake.set()
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+        if self.metrics is not None:
+            self.metrics.incr(f"payments.{name}")
+
+    # -------- 認領 --------
+    def claim(self, conn, n):
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute(CLAIM_SQL, {"lease": LEASE_SECONDS, "n": n})
+                return cur.fetchall()
+
+    def _dispatch(self):
+        conn = self._connect()
+        try:
+            while not self._stop.is_set():
+                with self._lock:
+                    free = self.workers - self._in_flight
+                jobs = []
+                if free > 0:
+                    try:
+                        jobs = self.claim(conn, free)
+                    except Exception as e:
+                        print("[PAYMENTS] claim failed:", e)
+                        conn.close()
+                        self._stop.wait(self.poll)
+                        conn = self._connect()
+                        continue
+
+                with self._lock:
+                    self._in_flight += len(jobs)
+                for job in jobs:
+                    self._executor.submit(self._process, *job)
+
+                # 認領滿額代表可能還有積壓，有空位時立刻再認領
+                if not jobs or len(jobs) < free:
+                    self._wake.wait(self.poll)
+                    self._wake.clear()
+        finally:
+            conn.close()
+
+    # -------- 單筆付款 --------
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or conn.closed:
+            conn = self._local.conn = self._connect()
+            with self._lock:
+                self._conns.append(conn)
+        return conn
+
+    def _process(self, payment_id, order_id, amount, attempts):
+        try:
+            try:
+                txn_ref = self.gateway.charge(f"PAY-{payment_id}", amount)
+            except GatewayDeclined as e:
+                self._fail(payment_id, order_id, str(e))
+            except Exception as e:
+                if attempts >= self.max_attempts:
+                    self._fail(payment_id, order_id, f"{e}（已重試 {attempts} 次）")
+                else:
+                    self._retry(payment_id, attempts, str(e))
+            else:
+                self._succeed(payment_id, order_id, amount, txn_ref)
+        except Exception as e:
+            # DB 寫回失敗：租期到了付款會被重新認領，gateway 以 idempotency key 去重
+            print(f"[PAYMENTS] payment #{payment_id} write-back failed:", e)
+            conn = getattr(self._local, "conn", None)
+            if conn is not None:
+                conn.close()
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._wake.set()
+
+    def _lock_order(self, cur, order_id):
+        cur.execute(
+            """
+            SELECT status, buyer_student_no, seller_student_no
+            FROM orders WHERE order_id=%s
+            FOR UPDATE
+        """,
+            (order_id,),
+        )
+        return cur.fetchone()
+
+    def _succeed(self, payment_id, order_id, amount, txn_ref):
+        refund = False
+        conn = self._conn()
+        with conn:
+            with conn.cursor() as cur:
+                status, buyer, seller = self._lock_order(cur, order_id)
+                if status == "Created":
+                    cur.execute(
+                        """
+                        UPDATE payments
+                        SET status='Success', txn_ref=%s, paid_at=NOW(), last_error=NULL
+                        WHERE payment_id=%s
+                    """,
+                        (txn_ref, payment_id),
+                    )
+                    cur.execute(
+                        """
+                        UPDATE orders
+                        SET status='Paid', paid_at=NOW(), hold_expires_at=NULL
+                        WHERE order_id=%s
+                    """,
+                        (order_id,),
+                    )
+                    emit_event(cur, "order.paid", "order", order_id, {
+                        "order_id": order_id,
+                        "buyer_student_no": buyer,
+                        "seller_student_no": seller,
+                        "total_amount": float(amount),
+                        "txn_ref": txn_ref,
+                    })
+                else:
+                    # 扣款期間訂單已不是 Created（例如人工取消）：款項退回
+                    cur.execute(
+                        "UPDATE payments SET status='Refunded', txn_ref=%s WHERE payment_id=%s",
+                        (txn_ref, payment_id),
+                    )
+                    refund = True
+
+        if refund:
+            self.gateway.refund(txn_ref, amount)
+            self._count("refunded")
+        else:
+            self._count("paid")
+
+    def _retry(self, payment_id, attempts, error):
+        delay = min(self.backoff * 2 ** (attempts - 1), BACKOFF_MAX) * random.uniform(0.5, 1.0)
+        conn = self._conn()
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    UPDATE payments
+                    SET next_attempt_at = NOW() + make_interval(secs => %s), last_error=%s
+                    WHERE payment_id=%s AND status='Pending'
+                """,
+                    (delay, error, payment_id),
+                )
+        self._count("retried")
+
+    def _fail(self, payment_id, order_id, error):
+        """付款失敗：訂單取消、庫存放回（和逾時保留走同一段邏輯）"""
+        conn = self._conn()
+        with conn:
+            with conn.cursor() as cur:
+                status, buyer, seller = self._lock_order(cur, order_id)
+                cur.execute(
+                    "UPDATE payments SET last_error=%s WHERE payment_id=%s",
+                    (error, payment_id),
+                )
+                if status == "Created":
+                    cur.execute(
+                        """
+                        UPDATE orders
+                        SET status='Cancelled', cancelled_at=NOW(), hold_expires_at=NULL
+                        WHERE order_id=%s
+                    """,
+                        (order_id,),
+                    )
+                    release_orders(cur, [(order_id, buyer, seller)], "order.payment_failed")
+                else:
+                    cur.execute(
+                        "UPDATE payments SET status='Failed' WHERE payment_id=%s AND status='Pending'",
+                        (payment_id,),
+                    )
+        self._count("failed")
+
+    # -------- lifecycle --------
+    @property
+    def in_flight(self):
+        with self._lock:
+            return self._in_flight
+
+    def start(self):
+        self._stop.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pay")
+        self._thread = threading.Thread(target=self._dispatch, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止認領新付款，等進行中的付款寫回完成"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        with self._lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.close()
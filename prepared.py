@@ -0,0 +1,101 @@
+# ==========================================
+# NTU Marketplace - Prepared Statements
+# handler 的熱門 SQL 在每條連線上只 PREPARE 一次，之後 EXECUTE 直接重用
+# ==========================================
+from psycopg2.extensions import connection
+
+# name -> (參數型別, SQL)；SQL 使用 $1 $2 ... 佔位
+STATEMENTS = {
+    # ---------- place_order ----------
+    "po_lock_item": (
+        ("integer",),
+        """
+        SELECT seller_student_no, price, quantity, status
+        FROM items
+        WHERE item_id=$1 FOR UPDATE
+        """,
+    ),
+    "po_insert_order": (
+        ("varchar", "varchar", "numeric", "integer"),
+        """
+        INSERT INTO orders (
+            buyer_student_no, seller_student_no,
+            order_type, status, total_amount,
+            consignee_name, consignee_phone, shipping_address,
+            created_at, hold_expires_at
+        )
+        SELECT $1, $2, 'direct', 'Created', $3,
+               full_name, phone, '校內面交',
+               NOW(), NOW() + make_interval(secs => $4)
+        FROM users WHERE student_no=$1
+        RETURNING order_id, hold_expires_at
+        """,
+    ),
+    "po_insert_order_item": (
+        ("integer", "integer", "integer"),
+        """
+        INSERT INTO order_items (order_id, item_id, qty, price_each, title_snapshot)
+        SELECT $1, item_id, $2, price, title FROM items WHERE item_id=$3
+        """,
+    ),
+    "po_insert_payment": (
+        ("integer", "numeric"),
+        """
+        INSERT INTO payments (order_id, method, amount, status)
+        VALUES ($1, 'credit_card', $2, 'Pending')
+        """,
+    ),
+    "po_update_stock": (
+        ("integer", "varchar", "integer"),
+        """
+        UPDATE items SET quantity=$1, status=$2, updated_at=NOW()
+        WHERE item_id=$3
+        """,
+    ),
+    # ---------- 常用查詢 ----------
+    "my_orders": (
+        ("varchar",),
+        """
+        SELECT o.order_id, o.status, o.total_amount,
+               u.full_name AS seller_name,
+               o.created_at, o.paid_at, o.shipped_at, o.completed_at,
+               sr.avg_rating, sr.review_count, o.hold_expires_at
+        FROM orders o
+        JOIN users u ON u.student_no=o.seller_student_no
+        LEFT JOIN seller_ratings sr ON sr.seller_student_no=o.seller_student_no
+        WHERE o.buyer_student_no=$1
+        ORDER BY o.created_at DESC
+        """,
+    ),
+    "my_selling_items": (
+        ("varchar",),
+        """
+        SELECT item_id, title, price, quantity, status
+        FROM items
+        WHERE seller_student_no=$1
+        ORDER BY item_id
+        """,
+    ),
+}
+
+
+class PreparedConnection(connection):
+    """記錄這條連線已經 PREPARE 過哪些 statement（連線池重用時不必再送）"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.pool = None        # 由連線池借出時設定
+
+
+def execute_prepared(cur, name, params):
+    conn = cur.connection
+    types, sql = STATEMENTS[name]
+
+    if name not in conn.prepared:
+        # PREPARE 是 session 層級，不會跟著交易 rollback 消失
+        cur.execute(f"PREPARE {name} ({', '.join(types)}) AS {sql}")
+        conn.prepared.add(name)
+
+    placeholders = ", ".join(["%s"] * len(types))
+    cur.execute(f"EXECUTE {name} ({placeholders})", params)
@@ -0,0 +1,71 @@
+# ==========================================
+# NTU Marketplace - Rate Limiter
+# 記憶體內的 token bucket：每個 (scope, key) 一個 [tokens, last]，
+# 檢查 / 扣除都是 O(1)；閒置到補滿的 bucket 和不存在等價，順手淘汰
+# ==========================================
+import threading
+import time
+from collections import OrderedDict
+
+MAX_BUCKETS = 100_000       # 上限，超過時從最久沒用的開始丟
+
+
+class RateLimiter:
+    """
+    limits：{scope: (每秒補充數, 最大突發)}。
+    一次請求可同時扣多個 bucket（例如 ip + user + 類別），全部都夠才扣，
+    不會因為其中一個拒絕而白白消耗其他 bucket。
+    """
+
+    def __init__(self, limits, max_buckets=MAX_BUCKETS, clock=time.monotonic):
+        self.limits = dict(limits)
+        self.max_buckets = max_buckets
+        self._clock = clock
+        # 閒置超過這麼久的 bucket 一定已經補滿，可以安全刪掉
+        self._idle = max(burst / rate for rate, burst in self.limits.values())
+        self._buckets = OrderedDict()   # (scope, key) -> [tokens, last]；依最後使用時間排序
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        buckets = self._buckets
+        while buckets:
+            _, (_, last) = next(iter(buckets.items()))
+            if now - last < self._idle and len(buckets) < self.max_buckets:
+                break
+            buckets.popitem(last=False)
+
+    def take(self, keys, cost=1):
+        """
+        keys：[(scope, key), ...]，scope 不在 limits 裡的略過。
+        允許回傳 (0, None)；拒絕回傳 (建議等待秒數, 擋下的 scope)。
+        """
+        now = self._clock()
+        with self._lock:
+            self._evict(now)
+            wait, blocked, entries = 0.0, None, []
+            for scope, key in keys:
+                limit = self.limits.get(scope)
+                if limit is None:
+                    continue
+                rate, burst = limit
+                bucket = self._buckets.get((scope, key))
+                if bucket is None:
+                    bucket = self._buckets[(scope, key)] = [float(burst), now]
+                else:
+                    bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                    bucket[1] = now
+                    self._buckets.move_to_end((scope, key))
+                entries.append(bucket)
+                if bucket[0] < cost:
+                    need = (cost - bucket[0]) / rate
+                    if need > wait:
+                        wait, blocked = need, scope
+
+            if blocked is None:
+                for bucket in entries:
+                    bucket[0] -= cost
+            return wait, blocked
+
+    def __len__(self):
+        with self._lock:
+            return len(self._buckets)
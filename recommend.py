@@ -0,0 +1,238 @@
+# ==========================================
+# NTU Marketplace - Recommendation Index
+# 「看過/買過這個的人也看了」：item-to-item 共現索引
+# ==========================================
+import math
+import threading
+import time
+from collections import defaultdict
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:     # numpy / scipy 為選用，沒裝時共現矩陣用純 Python 迴圈計算
+    np = sparse = None
+
+REBUILD_INTERVAL = 600      # 秒，背景重建週期
+HISTORY_DAYS = 90           # 只看最近 N 天的行為
+TOP_K = 20                  # 每個商品保留的鄰居數
+MAX_BASKET = 50             # 每位使用者最多取最近 N 個商品，避免 O(n^2) 爆掉
+FETCH_ROWS = 10000          # server-side cursor 每次取回的列數
+
+VIEW_WEIGHT = 1.0
+ORDER_WEIGHT = 3.0
+
+
+class CoOccurrenceIndex:
+    """
+    唯讀的推薦索引快照。
+    重建時產生一個新物件，再整個換掉 Recommender.index，
+    查詢端拿到的永遠是完整的一份，不需要上鎖。
+    """
+
+    def __init__(self, neighbors, user_items, titles, built_at):
+        self.neighbors = neighbors      # item_id -> [(item_id, score), ...]，已排序
+        self.user_items = user_items    # student_no -> [item_id, ...]，新到舊
+        self.titles = titles            # 可購買商品 item_id -> title
+        self.built_at = built_at
+
+    @classmethod
+    def empty(cls):
+        return cls({}, {}, {}, None)
+
+    def for_item(self, item_id, limit):
+        out = []
+        for other, score in self.neighbors.get(item_id, ()):
+            if other in self.titles:
+                out.append((other, score))
+                if len(out) >= limit:
+                    break
+        return out
+
+    def for_user(self, student_no, limit):
+        history = self.user_items.get(student_no, [])
+        seen = set(history)
+        scores = defaultdict(float)
+
+        # 越近期的行為權重越高
+        for rank, item_id in enumerate(history):
+            decay = 1.0 / (1 + rank)
+            for other, score in self.neighbors.get(item_id, ()):
+                if other not in seen and other in self.titles:
+                    scores[other] += score * decay
+
+        return sorted(scores.items(), key=lambda kv: kv[1], reverse=True)[:limit]
+
+
+def load_baskets(conn):
+    """
+    每位使用者的 basket：[(item_id, weight)]，新到舊，最多 MAX_BASKET 個。
+    用 named cursor 分批串流，90 天的行為紀錄不會一次全部載入記憶體。
+    """
+    baskets = defaultdict(list)
+    with conn.cursor(name="recommend_history") as cur:
+        cur.itersize = FETCH_ROWS
+        cur.execute(
+            """
+            SELECT student_no, item_id, MAX(weight) AS weight, MAX(ts) AS last_ts
+            FROM (
+                SELECT v.student_no, v.item_id, %s AS weight, v.viewed_at AS ts
+                FROM view_logs v
+                WHERE v.student_no IS NOT NULL AND v.item_id IS NOT NULL
+                  AND v.viewed_at >= NOW() - make_interval(days => %s)
+                UNION ALL
+                SELECT o.buyer_student_no, oi.item_id, %s, o.created_at
+                FROM orders o
+                JOIN order_items oi ON oi.order_id = o.order_id
+                WHERE o.status <> 'Cancelled'
+                  AND o.created_at >= NOW() - make_interval(days => %s)
+            ) t
+            GROUP BY student_no, item_id
+            ORDER BY student_no, last_ts DESC
+        """,
+            (VIEW_WEIGHT, HISTORY_DAYS, ORDER_WEIGHT, HISTORY_DAYS),
+        )
+        for student_no, item_id, weight, _ in cur:
+            basket = baskets[student_no]
+            if len(basket) < MAX_BASKET:
+                basket.append((item_id, float(weight)))
+    return baskets
+
+
+def neighbors_sparse(baskets, top_k):
+    """basket 矩陣 B（使用者 × 商品）→ 共現 C = Bᵀ·B，再以對角線做 cosine 正規化"""
+    item_ids = sorted({item_id for basket in baskets.values() for item_id, _ in basket})
+    if not item_ids:
+        return {}
+    col = {item_id: j for j, item_id in enumerate(item_ids)}
+
+    rows, cols, data = [], [], []
+    for i, basket in enumerate(baskets.values()):
+        for item_id, w in basket:
+            rows.append(i)
+            cols.append(col[item_id])
+            data.append(w)
+    b = sparse.csr_matrix((data, (rows, cols)), shape=(len(baskets), len(item_ids)))
+
+    c = (b.T @ b).tocsr()
+    norm = np.sqrt(c.diagonal())
+    c.setdiag(0)
+    c.eliminate_zeros()
+    inv = sparse.diags(1.0 / norm)
+    c = (inv @ c @ inv).tocsr()
+
+    neighbors = {}
+    ids = np.asarray(item_ids)
+    for a in range(c.shape[0]):
+        lo, hi = c.indptr[a], c.indptr[a + 1]
+        if lo == hi:
+            continue
+        scores = c.data[lo:hi]
+        others = c.indices[lo:hi]
+        if len(scores) > top_k:
+            keep = np.argpartition(-scores, top_k - 1)[:top_k]
+            scores, others = scores[keep], others[keep]
+        order = np.argsort(-scores, kind="stable")
+        neighbors[item_ids[a]] = [
+            (int(ids[j]), round(float(s), 4)) for j, s in zip(others[order], scores[order])
+        ]
+    return neighbors
+
+
+def neighbors_python(baskets, top_k):
+    popularity = defaultdict(float)
+    pair_scores = defaultdict(lambda: defaultdict(float))
+
+    for basket in baskets.values():
+        for item_id, w in basket:
+            popularity[item_id] += w * w
+        for i, (a, wa) in enumerate(basket):
+            for b, wb in basket[i + 1:]:
+                pair_scores[a][b] += wa * wb
+                pair_scores[b][a] += wa * wb
+
+    # cosine 正規化，避免熱門商品永遠霸榜
+    neighbors = {}
+    for a, others in pair_scores.items():
+        norm_a = math.sqrt(popularity[a])
+        scored = [
+            (b, round(s / (norm_a * math.sqrt(popularity[b])), 4))
+            for b, s in others.items()
+        ]
+        scored.sort(key=lambda kv: kv[1], reverse=True)
+        neighbors[a] = scored[:top_k]
+    return neighbors
+
+
+def build_index(conn, top_k=TOP_K):
+    """從 view_logs + order_items 建立共現索引（串流掃描一次，其餘在記憶體完成）"""
+    baskets = load_baskets(conn)
+
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT item_id, title FROM items
+            WHERE status='Listed' AND quantity > 0
+        """
+        )
+        titles = dict(cur.fetchall())
+    conn.rollback()
+
+    if sparse is not None:
+        neighbors = neighbors_sparse(baskets, top_k)
+    else:
+        neighbors = neighbors_python(baskets, top_k)
+
+    user_items = {sno: [item_id for item_id, _ in basket] for sno, basket in baskets.items()}
+
+    return CoOccurrenceIndex(neighbors, user_items, titles, time.time())
+
+
+class Recommender:
+    """持有目前的索引，背景執行緒定期重建後原子替換。"""
+
+    def __init__(self, connect, interval=REBUILD_INTERVAL):
+        self._connect = connect
+        self.interval = interval
+        self.index = CoOccurrenceIndex.empty()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def rebuild(self):
+        conn = self._connect()
+        try:
+            index = build_index(conn)
+        finally:
+            conn.close()
+        # 單一參考賦值，對讀取端來說是原子的
+        self.index = index
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.rebuild()
+            except Exception as e:
+                print("[RECOMMEND] rebuild failed:", e)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self._thread is not None:
+            self._thread.join()     # stop() 不等執行緒；重新啟動前確定上一輪已結束
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def recommend(self, item_id=None, student_no=None, limit=10):
+        index = self.index
+        if item_id is not None:
+            pairs = index.for_item(item_id, limit)
+        else:
+            pairs = index.for_user(student_no, limit)
+
+        return [
+            {"item_id": i, "title": index.titles.get(i), "score": score}
+            for i, score in pairs
+        ]
@@ -0,0 +1,136 @@
+# ==========================================
+# NTU Marketplace - Stock Hold Sweeper
+# place_order 只保留庫存（訂單 Created + hold_expires_at），
+# 逾時沒付款的訂單由這裡分批取消並把庫存放回
+# ==========================================
+import threading
+
+from outbox import emit_event
+
+HOLD_SECONDS = 15 * 60      # 下單後保留庫存多久
+SWEEP_INTERVAL = 10         # 秒
+SWEEP_BATCH = 200
+
+# SKIP LOCKED：正在 confirm_payment 的訂單直接跳過，不互等；多個 sweeper 也不會搶同一批
+# 已送出付款（next_attempt_at 有值）的訂單由 payment_worker 決定成敗，這裡不取消
+CANCEL_EXPIRED_SQL = """
+    WITH expired AS (
+        SELECT o.order_id
+        FROM orders o
+        WHERE o.status='Created' AND o.hold_expires_at < NOW()
+          AND NOT EXISTS (
+              SELECT 1 FROM payments p
+              WHERE p.order_id=o.order_id AND p.status='Pending'
+                AND p.next_attempt_at IS NOT NULL
+          )
+        ORDER BY o.hold_expires_at
+        LIMIT %s
+        FOR UPDATE OF o SKIP LOCKED
+    )
+    UPDATE orders o
+    SET status='Cancelled', cancelled_at=NOW(), hold_expires_at=NULL
+    FROM expired e
+    WHERE o.order_id=e.order_id
+    RETURNING o.order_id, o.buyer_student_no, o.seller_student_no
+"""
+
+
+def release_orders(cur, orders, event_type):
+    """
+    orders：剛改成 Cancelled 的 [(order_id, buyer, seller)]。
+    在呼叫端的交易內放回庫存、Pending 付款改 Failed，並發出 event_type 事件。
+    """
+    order_ids = [o[0] for o in orders]
+
+    cur.execute(
+        """
+        SELECT item_id, SUM(qty)
+        FROM order_items
+        WHERE order_id = ANY(%s)
+        GROUP BY item_id
+        ORDER BY item_id
+    """,
+        (order_ids,),
+    )
+    restock = cur.fetchall()
+
+    # 依 item_id 順序上鎖，和其他批次 / 下單不會互相死鎖
+    for item_id, qty in restock:
+        cur.execute(
+            """
+            UPDATE items
+            SET quantity=quantity + %s,
+                status=CASE WHEN status='SoldOut' THEN 'Listed' ELSE status END,
+                updated_at=NOW()
+            WHERE item_id=%s
+        """,
+            (qty, item_id),
+        )
+
+    cur.execute(
+        "UPDATE payments SET status='Failed' WHERE order_id = ANY(%s) AND status='Pending'",
+        (order_ids,),
+    )
+
+    for order_id, buyer, seller in orders:
+        emit_event(cur, event_type, "order", order_id, {
+            "order_id": order_id,
+            "buyer_student_no": buyer,
+            "seller_student_no": seller,
+        })
+
+
+def release_expired(conn, batch=SWEEP_BATCH):
+    """取消一批逾時訂單並放回庫存（一個交易），回傳處理的訂單數"""
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute(CANCEL_EXPIRED_SQL, (batch,))
+            orders = cur.fetchall()
+            if orders:
+                release_orders(cur, orders, "order.expired")
+    return len(orders)
+
+
+class HoldSweeper:
+    def __init__(self, connect, interval=SWEEP_INTERVAL, batch=SWEEP_BATCH):
+        self._connect = connect
+        self.interval = interval
+        self.batch = batch
+        self.released = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sweep(self):
+        conn = self._connect()
+        try:
+            total = 0
+            # 滿批代表還有積壓，繼續下一批（每批各自 commit，鎖不會拖太久）
+            while not self._stop.is_set():
+                n = release_expired(conn, self.batch)
+                total += n
+                if n < self.batch:
+                    break
+        finally:
+            conn.close()
+        self.released += total
+        return total
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                n = self.sweep()
+                if n:
+                    print(f"[HOLDS] released {n} expired order(s)")
+            except Exception as e:
+                print("[HOLDS] sweep failed:", e)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -5,6 +5,14 @@
 ------------------------------------------------------------
 -- DROP TABLES (依外鍵順序)
 ------------------------------------------------------------
+DROP TABLE IF EXISTS cache_versions CASCADE;
+DROP SEQUENCE IF EXISTS cache_version_seq;
+DROP TABLE IF EXISTS outbox_offsets CASCADE;
+DROP TABLE IF EXISTS outbox_events  CASCADE;
+DROP TABLE IF EXISTS auction_bids CASCADE;
+DROP TABLE IF EXISTS auctions     CASCADE;
+DROP TABLE IF EXISTS trending_buckets CASCADE;
+DROP TABLE IF EXISTS seller_ratings CASCADE;
 DROP TABLE IF EXISTS reviews      CASCADE;
 DROP TABLE IF EXISTS shipments    CASCADE;
 DROP TABLE IF EXISTS payments     CASCADE;
@@ -52,6 +60,9 @@ CREATE TABLE categories (
     path                VARCHAR(400)
 );
 
+-- materialized path：子樹查詢 = path LIKE '/Books/%' 的一次 index range scan
+CREATE UNIQUE INDEX idx_categories_path ON categories (path text_pattern_ops);
+
 ------------------------------------------------------------
 -- ITEMS
 ------------------------------------------------------------
@@ -72,6 +83,8 @@ CREATE TABLE items (
     CHECK (status IN ('Draft','Listed','SoldOut','Removed'))
 );
 
+CREATE INDEX idx_items_category ON items (category_id);
+
 ------------------------------------------------------------
 -- ITEM IMAGES
 ------------------------------------------------------------
@@ -79,9 +92,17 @@ CREATE TABLE item_images (
     image_id    SERIAL PRIMARY KEY,
     item_id     INTEGER NOT NULL REFERENCES items(item_id) ON DELETE CASCADE,
     image_url   VARCHAR(500) NOT NULL,
-    sort_order  INTEGER NOT NULL DEFAULT 0
+    sort_order  INTEGER NOT NULL DEFAULT 0,
+    -- 上傳到 server 圖片庫的圖（外部網址的舊資料這幾欄為 NULL）
+    sha256        CHAR(64),
+    content_type  VARCHAR(40),
+    byte_size     INTEGER,
+    thumb_sha256  CHAR(64)      -- 背景產生縮圖後填入
 );
 
+-- list_items 取每個商品的第一張圖
+CREATE INDEX idx_item_images_item_sort ON item_images (item_id, sort_order, image_id);
+
 ------------------------------------------------------------
 -- ORDERS
 ------------------------------------------------------------
@@ -100,12 +121,47 @@ CREATE TABLE orders (
     shipped_at        TIMESTAMP,
     completed_at      TIMESTAMP,
     cancelled_at      TIMESTAMP,
+    hold_expires_at   TIMESTAMP,     -- Created 訂單保留庫存到何時，逾時由 sweeper 取消
     FOREIGN KEY (buyer_student_no)  REFERENCES users(student_no),
     FOREIGN KEY (seller_student_no) REFERENCES users(student_no),
     CHECK (order_type IN ('direct','auction')),
     CHECK (status IN ('Created','Paid','Shipped','Completed','Cancelled'))
 );
 
+-- 後台報表按月切段時，每一段都是 paid_at 的範圍掃描
+CREATE INDEX idx_orders_completed_paid_at
+    ON orders (paid_at) WHERE status='Completed';
+CREATE INDEX idx_orders_created_at ON orders (created_at);
+
+-- sweeper 只掃還在保留中的訂單
+CREATE INDEX idx_orders_hold_expires
+    ON orders (hold_expires_at) WHERE status='Created';
+
+-- 訂單新增 / 狀態變更時 NOTIFY，server 端 LISTEN 後推給在線的買家與賣家
+CREATE OR REPLACE FUNCTION notify_order_event() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND NEW.status IS NOT DISTINCT FROM OLD.status THEN
+        RETURN NEW;
+    END IF;
+
+    PERFORM pg_notify('order_events', json_build_object(
+        'order_id',     NEW.order_id,
+        'op',           TG_OP,
+        'status',       NEW.status,
+        'old_status',   CASE WHEN TG_OP = 'UPDATE' THEN OLD.status END,
+        'buyer',        NEW.buyer_student_no,
+        'seller',       NEW.seller_student_no,
+        'total_amount', NEW.total_amount
+    )::text);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_orders_notify
+    AFTER INSERT OR UPDATE OF status ON orders
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_order_event();
+
 ------------------------------------------------------------
 -- ORDER ITEMS
 ------------------------------------------------------------
@@ -131,10 +187,17 @@ CREATE TABLE payments (
     status      VARCHAR(20) NOT NULL DEFAULT 'Pending',
     txn_ref     VARCHAR(120),
     paid_at     TIMESTAMP,
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP,       -- NULL = 買家尚未送出付款；有值 = payment_worker 到期時認領
+    last_error      TEXT,
     FOREIGN KEY (order_id) REFERENCES orders(order_id) ON DELETE CASCADE,
     CHECK (status IN ('Pending','Success','Failed','Refunded'))
 );
 
+-- payment_worker 認領到期的付款
+CREATE INDEX idx_payments_due
+    ON payments (next_attempt_at) WHERE status='Pending';
+
 ------------------------------------------------------------
 -- SHIPMENTS
 ------------------------------------------------------------
@@ -164,6 +227,8 @@ CREATE TABLE reviews (
     FOREIGN KEY (ratee_student_no) REFERENCES users(student_no)
 );
 
+CREATE INDEX idx_reviews_created_at ON reviews (created_at);
+
 ------------------------------------------------------------
 -- VIEW LOGS (for NoSQL JSONB analytics)
 ------------------------------------------------------------
@@ -177,11 +242,189 @@ CREATE TABLE view_logs (
     FOREIGN KEY (item_id)  REFERENCES items(item_id)
 );
 
+CREATE INDEX idx_view_logs_viewed_at ON view_logs (viewed_at);
+
+------------------------------------------------------------
+-- SELLER RATINGS（賣家評價彙總，由 create_review 在同一交易內維護）
+------------------------------------------------------------
+CREATE TABLE seller_ratings (
+    seller_student_no  VARCHAR(20) PRIMARY KEY,
+    review_count       INTEGER NOT NULL DEFAULT 0 CHECK (review_count >= 0),
+    rating_sum         INTEGER NOT NULL DEFAULT 0 CHECK (rating_sum >= 0),
+    avg_rating         NUMERIC(3,2) NOT NULL DEFAULT 0,
+    last_review_at     TIMESTAMP,
+    FOREIGN KEY (seller_student_no) REFERENCES users(student_no) ON DELETE CASCADE
+);
+
+-- 後台「賣家平均評價」排行直接走這個 index
+CREATE INDEX idx_seller_ratings_avg
+    ON seller_ratings (avg_rating DESC, review_count DESC);
+
+------------------------------------------------------------
+-- TRENDING BUCKETS（server 記憶體滑動視窗計數的 checkpoint）
+------------------------------------------------------------
+CREATE TABLE trending_buckets (
+    bucket_epoch  BIGINT  NOT NULL,    -- 5 分鐘格的起點（epoch 秒）
+    item_id       INTEGER NOT NULL REFERENCES items(item_id) ON DELETE CASCADE,
+    views         INTEGER NOT NULL DEFAULT 0,
+    orders        INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket_epoch, item_id)
+);
+
+------------------------------------------------------------
+-- AUCTIONS（出價狀態在 server 記憶體 + WAL，結標時才一次寫回）
+------------------------------------------------------------
+CREATE TABLE auctions (
+    auction_id         SERIAL PRIMARY KEY,
+    item_id            INTEGER NOT NULL REFERENCES items(item_id),
+    seller_student_no  VARCHAR(20) NOT NULL REFERENCES users(student_no),
+    start_price        NUMERIC(12,2) NOT NULL CHECK (start_price >= 0),
+    min_increment      NUMERIC(12,2) NOT NULL DEFAULT 1 CHECK (min_increment > 0),
+    status             VARCHAR(12) NOT NULL DEFAULT 'Open',
+    created_at         TIMESTAMP NOT NULL DEFAULT NOW(),
+    ends_at            TIMESTAMP NOT NULL,     -- 原訂結標時間；防狙擊延長後以結標時寫回的為準
+    closed_at          TIMESTAMP,
+    winner_student_no  VARCHAR(20) REFERENCES users(student_no),
+    final_price        NUMERIC(12,2),
+    order_id           INTEGER REFERENCES orders(order_id),
+    CHECK (status IN ('Open','Closed','Unsold'))
+);
+
+-- server 啟動時載入進行中的拍賣
+CREATE INDEX idx_auctions_open ON auctions (ends_at) WHERE status='Open';
+
+-- 結標時整批寫入的出價紀錄
+CREATE TABLE auction_bids (
+    auction_id         INTEGER NOT NULL REFERENCES auctions(auction_id) ON DELETE CASCADE,
+    seq                INTEGER NOT NULL,
+    bidder_student_no  VARCHAR(20) NOT NULL REFERENCES users(student_no),
+    amount             NUMERIC(12,2) NOT NULL,
+    placed_at          TIMESTAMP NOT NULL,
+    PRIMARY KEY (auction_id, seq)
+);
+
+------------------------------------------------------------
+-- OUTBOX（交易內寫入的異動事件，由 server 的 dispatcher 批次分送）
+------------------------------------------------------------
+CREATE TABLE outbox_events (
+    event_id        BIGSERIAL PRIMARY KEY,
+    txid            XID8 NOT NULL DEFAULT pg_current_xact_id(),
+    event_type      VARCHAR(40) NOT NULL,     -- order.placed / order.shipped / item.added / review.created
+    aggregate_type  VARCHAR(20) NOT NULL,
+    aggregate_id    INTEGER NOT NULL,
+    payload         JSONB NOT NULL,
+    created_at      TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- dispatcher 依 (txid, event_id) 往前讀
+CREATE INDEX idx_outbox_events_pos ON outbox_events (txid, event_id);
+
+CREATE TABLE outbox_offsets (
+    consumer        VARCHAR(80) PRIMARY KEY,
+    last_txid       BIGINT NOT NULL DEFAULT 0,
+    last_event_id   BIGINT NOT NULL DEFAULT 0,
+    updated_at      TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+------------------------------------------------------------
+-- CACHE VERSIONS（list_items / my_orders / list_my_selling_items 的 ETag）
+-- 全域 scope 分 16 個 shard（依 backend pid），避免所有下單搶同一列；
+-- ETag 取各 shard 的 SUM，任何一個 shard commit 都會讓總和變大。
+------------------------------------------------------------
+CREATE SEQUENCE cache_version_seq;
+
+CREATE TABLE cache_versions (
+    scope      VARCHAR(20) NOT NULL,     -- items / selling / orders / ratings / users / categories
+    scope_key  VARCHAR(20) NOT NULL,     -- student_no；全域 scope 為 '*'
+    shard      SMALLINT    NOT NULL DEFAULT 0,
+    version    BIGINT      NOT NULL,
+    PRIMARY KEY (scope, scope_key, shard)
+);
+
+CREATE OR REPLACE FUNCTION bump_cache_version(p_scope TEXT, p_key TEXT) RETURNS void AS $$
+BEGIN
+    INSERT INTO cache_versions (scope, scope_key, shard, version)
+    VALUES (p_scope, p_key,
+            CASE WHEN p_key = '*' THEN pg_backend_pid() % 16 ELSE 0 END,
+            nextval('cache_version_seq'))
+    ON CONFLICT (scope, scope_key, shard)
+    DO UPDATE SET version = EXCLUDED.version;
+END;
+$$ LANGUAGE plpgsql;
+
+-- statement-level trigger + transition table：COPY / 批次更新也只 bump 一次
+CREATE OR REPLACE FUNCTION items_bump_cache() RETURNS trigger AS $$
+BEGIN
+    PERFORM bump_cache_version('items', '*');
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM bump_cache_version('selling', k)
+        FROM (SELECT DISTINCT seller_student_no AS k FROM new_rows) t;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM bump_cache_version('selling', k)
+        FROM (SELECT DISTINCT seller_student_no AS k FROM old_rows) t;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_items_cache_ins AFTER INSERT ON items
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION items_bump_cache();
+CREATE TRIGGER trg_items_cache_upd AFTER UPDATE ON items
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION items_bump_cache();
+CREATE TRIGGER trg_items_cache_del AFTER DELETE ON items
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION items_bump_cache();
+
+CREATE OR REPLACE FUNCTION orders_bump_cache() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM bump_cache_version('orders', k)
+        FROM (SELECT DISTINCT buyer_student_no AS k FROM new_rows) t;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM bump_cache_version('orders', k)
+        FROM (SELECT DISTINCT buyer_student_no AS k FROM old_rows) t;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_orders_cache_ins AFTER INSERT ON orders
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION orders_bump_cache();
+CREATE TRIGGER trg_orders_cache_upd AFTER UPDATE ON orders
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION orders_bump_cache();
+CREATE TRIGGER trg_orders_cache_del AFTER DELETE ON orders
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION orders_bump_cache();
+
+-- 顯示在列表上的賣家名稱 / 評價 / 分類名稱，變動時整體失效
+CREATE OR REPLACE FUNCTION global_bump_cache() RETURNS trigger AS $$
+BEGIN
+    PERFORM bump_cache_version(TG_ARGV[0], '*');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_seller_ratings_cache AFTER INSERT OR UPDATE OR DELETE ON seller_ratings
+    FOR EACH STATEMENT EXECUTE FUNCTION global_bump_cache('ratings');
+CREATE TRIGGER trg_users_cache AFTER UPDATE OF full_name ON users
+    FOR EACH STATEMENT EXECUTE FUNCTION global_bump_cache('users');
+CREATE TRIGGER trg_categories_cache AFTER INSERT OR UPDATE OR DELETE ON categories
+    FOR EACH STATEMENT EXECUTE FUNCTION global_bump_cache('categories');
+-- 新圖片 / 縮圖產生完成時，列表上的縮圖要跟著更新
+CREATE TRIGGER trg_item_images_cache AFTER INSERT OR UPDATE OR DELETE ON item_images
+    FOR EACH STATEMENT EXECUTE FUNCTION global_bump_cache('items');
+
 
 ------------------------------------------------------------
 -- 清空資料
 ------------------------------------------------------------
-TRUNCATE TABLE reviews, shipments, payments, order_items, orders,
+TRUNCATE TABLE cache_versions, outbox_offsets, outbox_events, auction_bids, auctions, trending_buckets, seller_ratings, reviews, shipments, payments, order_items, orders,
                item_images, items, categories, user_roles, users
 RESTART IDENTITY CASCADE;
 
@@ -532,6 +775,18 @@ SELECT setval('reviews_review_id_seq',
               TRUE);
 
 
+------------------------------------------------------------
+-- SELLER RATINGS：依 reviews 回填彙總
+------------------------------------------------------------
+INSERT INTO seller_ratings (seller_student_no, review_count, rating_sum, avg_rating, last_review_at)
+SELECT ratee_student_no,
+       COUNT(*),
+       SUM(rating),
+       ROUND(AVG(rating), 2),
+       MAX(created_at)
+FROM reviews
+GROUP BY ratee_student_no;
+
 
 ------------------------------------------------------------
 -- 完成
@@ -1,25 +1,223 @@
 # ==========================================
 # NTU Marketplace - Final Server.py (Admin + JSON Fix)
 # ==========================================
+import math
+import os
+import select
+import signal
 import socket
+import subprocess
+import sys
 import threading
+import time
 import json
+import zlib
+from contextlib import contextmanager
 from datetime import datetime
 from decimal import Decimal
 
-import psycopg2
-from psycopg2.extras import RealDictCursor
-
-from db_config import DB_CONFIG
+try:
+    import zstandard
+except ImportError:     # zstd 為選用，沒裝就只提供 zlib
+    zstandard = None
+from psycopg2.extensions import QueryCanceledError
+from psycopg2.extras import Json, RealDictCursor
+
+from db_config import (
+    ANALYTICS_BACKEND,
+    DB_CONFIG,
+    OLAP_SYNC_SECONDS,
+    PAYMENT_GATEWAY_FAILURE_RATE,
+    PAYMENT_GATEWAY_LATENCY_MS,
+    PAYMENT_WORKERS,
+    POOL_MAX_CONNECTIONS,
+    POOL_WAIT_SECONDS,
+    RATE_LIMITS,
+    REPLICA_DSNS,
+    REPLICA_MAX_LAG_SECONDS,
+    STICKY_PRIMARY_SECONDS,
+)
+from auction import AuctionEngine, BidRejected
+from analytics import ParallelAggregator, Window, merge_rows, ratio
+from db_router import DBRouter
+from export import DATASETS as EXPORT_DATASETS, export_range
+from images import MAX_IMAGE_BYTES, READ_CHUNK, ImageStore, ThumbnailPool
+from notifier import OrderNotifier
+from olap import OlapStore, duckdb
+from outbox import OutboxDispatcher, emit_event, serve_feed
+from payment_worker import PaymentWorker, SimulatedGateway
+from prepared import execute_prepared
+from rate_limit import RateLimiter
+from recommend import Recommender
+from reservations import HOLD_SECONDS, HoldSweeper
+from trending import TrendingService
 
 HOST = "127.0.0.1"
 PORT = 5000
 
+# 回應超過這個大小才壓縮（bytes）
+COMPRESS_THRESHOLD = 4096
+
+# 可轉成 columnar 格式的欄位（list of dict）
+COLUMNAR_KEYS = ("items", "orders", "data", "categories", "auctions")
+
+# 不需要 DB 連線、直接讀記憶體結構的 action
+MEMORY_ACTIONS = {"recommend_items", "place_bid", "get_image"}
+# 請求本身帶大量資料：handler 自己分段取用執行名額 / DB 連線
+STREAMING_ACTIONS = {"upload_image"}
+
+# 只讀不寫的 action，可以丟給副本
+READ_ONLY_ACTIONS = {
+    "login",
+    "list_items",
+    "list_my_selling_items",
+    "my_orders",
+    "orders_to_ship",
+    "pending_reviews",
+    "trending_items",
+    "auction_status",
+    "analytics_category_revenue",
+    "analytics_monthly_revenue",
+    "analytics_seller_rating",
+    "analytics_top_items",
+    "analytics_category_rollup",
+    "nosql_mobile_views",
+    "nosql_hot_views",
+    "export_data",
+    "server_metrics",
+    "list_categories",
+}
+
+# 後台重查詢，與瀏覽 / 下單分開排隊
+ANALYTICS_ACTIONS = {
+    "analytics_category_revenue",
+    "analytics_monthly_revenue",
+    "analytics_seller_rating",
+    "analytics_top_items",
+    "analytics_category_rollup",
+    "nosql_mobile_views",
+    "nosql_hot_views",
+    "export_data",
+}
+
+# 成功後要讓該使用者暫時黏在主庫（read-your-writes）
+# view_item 只寫 view_logs、使用者不會讀回，不算：否則瀏覽中的使用者全被固定在主庫
+WRITE_ACTIONS = {
+    "place_order",
+    "confirm_payment",
+    "ship_order",
+    "create_review",
+    "add_item",
+    "create_auction",
+    "upload_image",
+}
+
+# 速率限制的「寫入」類：會下單 / 扣款 / 建資料，或可被拿來暴力嘗試（login）
+RATE_WRITE_ACTIONS = {
+    "login",
+    "place_order",
+    "confirm_payment",
+    "ship_order",
+    "create_review",
+    "add_item",
+    "create_auction",
+    "place_bid",
+    "upload_image",
+}
+
 # ------------------------------------------
 # Utility
 # ------------------------------------------
+# -------- 逾時 / 併發預算（依 action 類別）--------
+STATEMENT_TIMEOUT_MS = {"interactive": 3000, "analytics": 30000}
+CONCURRENCY_LIMITS = {"interactive": 64, "analytics": 4}
+ADMISSION_WAIT_SECONDS = {"interactive": 5, "analytics": 2}
+ANALYTICS_WORKERS = 8           # 報表分段平行查詢的 worker 數（所有 analytics 請求共用）
+CLIENT_SOCKET_TIMEOUT = 10      # 秒，等 client 送出請求 / 收回應的上限
+UPLOAD_DEADLINE_SECONDS = 60    # 上傳圖片整個 body 的收檔上限（CLIENT_SOCKET_TIMEOUT 只管單次 recv）
+DRAIN_BODY_SECONDS = 2          # 沒讀完 body 就回應時，關閉前最多再丟棄 client 送來的資料多久
+
+ADMISSION = {cls: threading.BoundedSemaphore(n) for cls, n in CONCURRENCY_LIMITS.items()}
+
+# -------- 速率限制（額度設定在 db_config.RATE_LIMITS）--------
+LIMITER = RateLimiter(RATE_LIMITS)
+
+
+def action_class(action):
+    return "analytics" if action in ANALYTICS_ACTIONS else "interactive"
+
+
+def rate_class(action):
+    if action in ANALYTICS_ACTIONS:
+        return "analytics"
+    return "write" if action in RATE_WRITE_ACTIONS else "read"
+
+
+def rate_keys(action, req, addr):
+    ip = addr[0]
+    keys = [("ip", ip)]
+    if action == "subscribe":
+        return keys
+    student_no = req.get("student_no")
+    if student_no:
+        keys.append(("user", student_no))
+    keys.append((rate_class(action), student_no or ip))
+    return keys
+
+
+class Metrics:
+    """簡單的 thread-safe 計數器，給 server_metrics 查詢"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + n
+
+    def snapshot(self):
+        with self._lock:
+            return dict(sorted(self._counts.items()))
+
+
+METRICS = Metrics()
+
+ROUTER = DBRouter(
+    DB_CONFIG,
+    REPLICA_DSNS,
+    max_lag=REPLICA_MAX_LAG_SECONDS,
+    sticky_seconds=STICKY_PRIMARY_SECONDS,
+    pool_size=POOL_MAX_CONNECTIONS,
+    pool_wait=POOL_WAIT_SECONDS,
+)
+
+
+# 報表的時間分段各自借一條池化連線平行彙總
+AGGREGATOR = ParallelAggregator(
+    ROUTER.acquire,
+    ROUTER.release,
+    workers=ANALYTICS_WORKERS,
+    statement_timeout_ms=STATEMENT_TIMEOUT_MS["analytics"],
+)
+
+
 def get_db_connection():
-    return psycopg2.connect(**DB_CONFIG)
+    return ROUTER.connect_primary()
+
+
+def get_read_connection():
+    return ROUTER.connect(read_only=True)
+
+
+# 瀏覽 / 下單事件的 24h 滑動視窗計數（定期 checkpoint 到 trending_buckets）
+TRENDING = TrendingService(get_db_connection)
+
+# outbox_events → 行程內訂閱者 + NDJSON feed（FEED_PORT）
+OUTBOX = OutboxDispatcher(get_db_connection)
+
+# orders trigger 的 NOTIFY → 推給 subscribe 長連線
+NOTIFIER = OrderNotifier(get_db_connection)
 
 
 def serialize_value(v):
@@ -47,6 +245,31 @@ def serialize_rows(rows):
     return out
 
 
+# ------------------------------------------
+# ETag（cache_versions 由 trigger 維護）
+# ------------------------------------------
+def cache_etag(conn, scopes):
+    """scopes: [(scope, scope_key)]，回傳組合後的版本字串"""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT scope, scope_key, SUM(version)
+            FROM cache_versions
+            WHERE (scope, scope_key) IN %s
+            GROUP BY scope, scope_key
+        """,
+            (tuple(scopes),),
+        )
+        versions = {(r[0], r[1]): r[2] for r in cur.fetchall()}
+    return "-".join(str(versions.get(sc, 0)) for sc in scopes)
+
+
+def not_modified(req, etag):
+    if req.get("if_none_match") == etag:
+        return {"status": "not_modified", "etag": etag}
+    return None
+
+
 # ============================================================
 # Login
 # ============================================================
@@ -88,19 +311,52 @@ def handle_login(conn, req):
 # =========================================================
 # Browsing items
 # =========================================================
+LIST_ITEMS_SCOPES = [("items", "*"), ("ratings", "*"), ("users", "*"), ("categories", "*")]
+
+
 def handle_list_items(conn, req):
+    # 先讀版本再讀資料：中間若有異動，下次請求版本一定對不上，不會誤回 not_modified
+    etag = cache_etag(conn, LIST_ITEMS_SCOPES)
+    cached = not_modified(req, etag)
+    if cached:
+        return cached
+
+    category_id = req.get("category_id")
+    where = ["i.status='Listed'", "i.quantity > 0"]
+    params = []
+
+    # 指定分類時包含整個子樹（例如 Books 會包含 Books > Textbooks）
+    if category_id is not None:
+        path = get_category_path(conn, category_id)
+        if path is None:
+            return {"status": "fail", "message": "找不到分類"}
+        where.append("c.path LIKE %s")
+        params.append(subtree_pattern(path))
+
     with conn.cursor() as cur:
         cur.execute(
-            """
+            f"""
             SELECT i.item_id, i.title, i.price, i.condition,
                    i.quantity, c.name AS category_name,
-                   u.full_name AS seller_name
+                   u.full_name AS seller_name,
+                   sr.avg_rating, sr.review_count,
+                   c.path AS category_path,
+                   img.thumb_sha256
             FROM items i
             LEFT JOIN categories c ON i.category_id = c.category_id
             JOIN users u ON i.seller_student_no = u.student_no
-            WHERE i.status='Listed' AND i.quantity > 0
+            LEFT JOIN seller_ratings sr ON sr.seller_student_no = i.seller_student_no
+            LEFT JOIN LATERAL (
+                -- 只取第一張圖（sort_order 最小）的縮圖代碼，圖本身另外用 get_image 取
+                SELECT thumb_sha256 FROM item_images im
+                WHERE im.item_id = i.item_id
+                ORDER BY im.sort_order, im.image_id
+                LIMIT 1
+            ) img ON TRUE
+            WHERE {" AND ".join(where)}
             ORDER BY i.item_id
-        """
+        """,
+            params,
         )
         rows = cur.fetchall()
 
@@ -113,29 +369,343 @@ def handle_list_items(conn, req):
             "quantity": r[4],
             "category_name": r[5],
             "seller_name": r[6],
+            "seller_rating": float(r[7]) if r[7] is not None else None,
+            "seller_review_count": r[8] or 0,
+            "category_path": r[9],
+            "thumbnail": r[10],
         }
         for r in rows
     ]
 
-    return {"status": "ok", "items": items}
+    return {"status": "ok", "items": items, "etag": etag}
 
 
 # =========================================================
-# My selling items
+# Categories（materialized path：categories.path = '/Books/Textbooks/'）
 # =========================================================
-def handle_list_my_selling_items(conn, req):
-    student_no = req.get("student_no")
+def get_category_path(conn, category_id):
+    with conn.cursor() as cur:
+        cur.execute("SELECT path FROM categories WHERE category_id=%s", (category_id,))
+        row = cur.fetchone()
+    return row[0] if row else None
+
 
+def subtree_pattern(path):
+    """把 path 轉成 LIKE 前綴，跳脫 % _ \\ 以免分類名稱被當成萬用字元"""
+    escaped = path.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped + "%"
+
+
+def handle_list_categories(conn, req):
     with conn.cursor() as cur:
         cur.execute(
             """
-            SELECT item_id, title, price, quantity, status
-            FROM items
-            WHERE seller_student_no=%s
-            ORDER BY item_id
+            SELECT category_id, name, parent_category_id, path
+            FROM categories
+            ORDER BY path
+        """
+        )
+        rows = cur.fetchall()
+
+    categories = [
+        {
+            "category_id": r[0],
+            "name": r[1],
+            "parent_category_id": r[2],
+            "path": r[3],
+            "depth": r[3].count("/") - 2 if r[3] else 0,
+        }
+        for r in rows
+    ]
+
+    return {"status": "ok", "categories": categories}
+
+
+# -------- Category rollup（後台報表：子樹累計營收）----------
+def analytics_category_rollup(conn, window):
+    """各分類營收 + 含子分類的累計營收（category_id / root_category_id 只看某個子樹）"""
+    pattern = window.category_pattern or "%"
+
+    own, n_parts = run_report(
+        conn,
+        f"""
+        SELECT i.category_id,
+               SUM(oi.qty * oi.price_each) AS revenue
+        FROM orders o
+        JOIN order_items oi ON oi.order_id=o.order_id
+        JOIN items i ON i.item_id=oi.item_id
+        JOIN categories c ON c.category_id=i.category_id
+        WHERE o.status='Completed'
+              {window.where("o.paid_at", "o.seller_student_no", path_col="c.path")}
+        GROUP BY i.category_id
+    """,
+        window,
+    )
+    own = {r["category_id"]: r["revenue"] for r in merge_rows(own, ["category_id"], sums=["revenue"])}
+
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(
+            """
+            SELECT category_id, name, path
+            FROM categories
+            WHERE path LIKE %s
+            ORDER BY path
         """,
-            (student_no,),
+            (pattern,),
+        )
+        rows = cur.fetchall()
+
+    for r in rows:
+        r["own_revenue"] = own.get(r["category_id"], Decimal(0))
+        r["subtree_revenue"] = Decimal(0)
+
+    # 沿著 path 前綴往上累加，每個節點只走自己的祖先鏈
+    by_path = {r["path"]: r for r in rows}
+    for r in rows:
+        parts = r["path"].strip("/").split("/")
+        for depth in range(1, len(parts) + 1):
+            ancestor = by_path.get("/" + "/".join(parts[:depth]) + "/")
+            if ancestor is not None:
+                ancestor["subtree_revenue"] += r["own_revenue"]
+
+    return {"status": "ok", "data": serialize_rows(rows), "window": window.describe(n_parts)}
+
+
+# =========================================================
+# View item（寫入 view_logs + 趨勢計數）
+# =========================================================
+def handle_view_item(conn, req):
+    student_no = req.get("student_no")
+    item_id = req.get("item_id")
+    meta = {"device": req.get("device") or "cli"}
+
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT i.item_id, i.title, i.description, i.price, i.condition,
+                           i.quantity, i.status, c.name AS category_name,
+                           u.full_name AS seller_name,
+                           sr.avg_rating, sr.review_count
+                    FROM items i
+                    LEFT JOIN categories c ON i.category_id = c.category_id
+                    JOIN users u ON i.seller_student_no = u.student_no
+                    LEFT JOIN seller_ratings sr ON sr.seller_student_no = i.seller_student_no
+                    WHERE i.item_id=%s
+                """,
+                    (item_id,),
+                )
+                r = cur.fetchone()
+
+                if not r:
+                    return {"status": "fail", "message": "找不到商品"}
+
+                cur.execute(
+                    """
+                    SELECT image_id, image_url, sha256, thumb_sha256
+                    FROM item_images
+                    WHERE item_id=%s
+                    ORDER BY sort_order, image_id
+                """,
+                    (item_id,),
+                )
+                images = [
+                    {"image_id": im[0], "image_url": im[1], "sha256": im[2], "thumbnail": im[3]}
+                    for im in cur.fetchall()
+                ]
+
+                cur.execute(
+                    """
+                    INSERT INTO view_logs (student_no, item_id, viewed_at, meta)
+                    VALUES (%s, %s, NOW(), %s)
+                """,
+                    (student_no, item_id, Json(meta)),
+                )
+
+        TRENDING.record_view(r[0])
+
+        return {
+            "status": "ok",
+            "item": {
+                "item_id": r[0],
+                "title": r[1],
+                "description": r[2],
+                "price": float(r[3]),
+                "condition": r[4],
+                "quantity": r[5],
+                "status": r[6],
+                "category_name": r[7],
+                "seller_name": r[8],
+                "seller_rating": float(r[9]) if r[9] is not None else None,
+                "seller_review_count": r[10] or 0,
+                "images": images,
+            },
+        }
+
+    except QueryCanceledError:
+        raise
+    except Exception as e:
+        return {"status": "fail", "message": f"查詢商品失敗：{e}"}
+
+
+# =========================================================
+# Item images（內容定址圖片庫；上傳 / 下載都不經過 JSON）
+# =========================================================
+IMAGES = ImageStore()
+THUMBNAILS = ThumbnailPool(IMAGES, get_db_connection)
+
+
+def read_body(socket_conn, received, size, deadline):
+    """header 之後的 binary body：先給已經收到的部分，再從 socket 分段讀到 size 為止，整體不超過 deadline"""
+    remaining = size
+    if received:
+        received = received[:remaining]
+        remaining -= len(received)
+        yield received
+    while remaining > 0:
+        left = deadline - time.monotonic()
+        if left <= 0:
+            raise ConnectionError("上傳逾時")
+        socket_conn.settimeout(min(CLIENT_SOCKET_TIMEOUT, left))
+        chunk = socket_conn.recv(min(READ_CHUNK, remaining))
+        if not chunk:
+            raise ConnectionError("上傳中斷")
+        remaining -= len(chunk)
+        yield chunk
+
+
+def handle_upload_image(req, socket_conn, received):
+    """
+    請求格式：JSON header（含 item_id、size）+ 換行 + size bytes 的圖檔。
+    先確認是自己的商品再收檔，避免替別人的商品白收 8 MB。
+    收檔可能很慢：只有查擁有者、寫入 item_images 兩段各自短暫佔用執行名額與 DB 連線。
+    """
+    seller_no = req.get("student_no")
+    item_id = req.get("item_id")
+    try:
+        size = int(req.get("size"))
+    except (TypeError, ValueError):
+        return {"status": "fail", "message": "需指定圖片大小 size"}
+    if not 0 < size <= MAX_IMAGE_BYTES:
+        return {"status": "fail", "message": f"圖片大小需介於 1 byte 到 {MAX_IMAGE_BYTES // (1024 * 1024)} MB"}
+
+    with db_session("upload_image", req) as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT seller_student_no FROM items WHERE item_id=%s", (item_id,))
+            row = cur.fetchone()
+    if not row:
+        return {"status": "fail", "message": "找不到商品"}
+    if row[0] != seller_no:
+        return {"status": "fail", "message": "只能替自己的商品上傳圖片"}
+
+    deadline = time.monotonic() + UPLOAD_DEADLINE_SECONDS
+    try:
+        sha, size, content_type = IMAGES.put_stream(read_body(socket_conn, received, size, deadline))
+    except ValueError as e:
+        return {"status": "fail", "message": str(e)}
+    except (ConnectionError, socket.timeout) as e:
+        METRICS.incr("images.upload_aborted")
+        return {"status": "fail", "message": f"上傳中斷：{e}"}
+
+    try:
+        with db_session("upload_image", req) as conn:
+            with conn:
+                with conn.cursor() as cur:
+                    # 同一張圖若已產生過縮圖就直接沿用
+                    cur.execute(
+                        """
+                        INSERT INTO item_images
+                            (item_id, image_url, sort_order, sha256, content_type, byte_size, thumb_sha256)
+                        SELECT %s, %s,
+                               COALESCE((SELECT MAX(sort_order) + 1 FROM item_images WHERE item_id=%s), 0),
+                               %s, %s, %s,
+                               (SELECT thumb_sha256 FROM item_images
+                                WHERE sha256=%s AND thumb_sha256 IS NOT NULL LIMIT 1)
+                        RETURNING image_id, sort_order, thumb_sha256
+                    """,
+                        (item_id, f"store://{sha}", item_id, sha, content_type, size, sha),
+                    )
+                    image_id, sort_order, thumb = cur.fetchone()
+    except (QueryCanceledError, Overloaded):
+        raise
+    except Exception as e:
+        return {"status": "fail", "message": f"上傳圖片失敗：{e}"}
+
+    if thumb is None:
+        THUMBNAILS.submit(sha)
+    METRICS.incr("images.uploaded")
+
+    return {
+        "status": "ok",
+        "message": f"已上傳圖片（ID={image_id}）",
+        "image_id": image_id,
+        "sha256": sha,
+        "sort_order": sort_order,
+    }
+
+
+def handle_get_image(req):
+    """回傳 (header, 檔案路徑)；圖檔依內容定址，不需要查 DB"""
+    try:
+        path = IMAGES.path(req.get("sha256"))
+    except ValueError as e:
+        return {"status": "fail", "message": str(e)}, None
+    if not os.path.exists(path):
+        return {"status": "fail", "message": "找不到圖片"}, None
+    return {"status": "ok", "sha256": req["sha256"]}, path
+
+
+def send_file(socket_conn, res, path):
+    """一行 JSON header 後接檔案內容；sendfile 直接從 page cache 送出，不經過 Python 的 buffer"""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        res["size"] = size
+        socket_conn.sendall((json.dumps(res) + "\n").encode("utf-8"))
+        socket_conn.sendfile(f)
+    METRICS.incr("images.served")
+    METRICS.incr("bytes.sent", size)
+
+
+# =========================================================
+# Trending items（記憶體計數，只對前 k 名查 title）
+# =========================================================
+def handle_trending_items(conn, req):
+    try:
+        k = min(int(req.get("limit") or 10), 50)
+    except Exception:
+        return {"status": "fail", "message": "limit 格式錯誤"}
+
+    top = TRENDING.top(k)
+    if not top:
+        return {"status": "ok", "items": []}
+
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT item_id, title FROM items WHERE item_id = ANY(%s)",
+            ([t["item_id"] for t in top],),
         )
+        titles = dict(cur.fetchall())
+
+    for t in top:
+        t["title"] = titles.get(t["item_id"])
+
+    return {"status": "ok", "items": top}
+
+
+# =========================================================
+# My selling items
+# =========================================================
+def handle_list_my_selling_items(conn, req):
+    student_no = req.get("student_no")
+
+    etag = cache_etag(conn, [("selling", student_no)])
+    cached = not_modified(req, etag)
+    if cached:
+        return cached
+
+    with conn.cursor() as cur:
+        execute_prepared(cur, "my_selling_items", (student_no,))
         rows = cur.fetchall()
 
     items = [
@@ -149,12 +719,17 @@ def handle_list_my_selling_items(conn, req):
         for r in rows
     ]
 
-    return {"status": "ok", "items": items}
+    return {"status": "ok", "items": items, "etag": etag}
 
 
 # =========================================================
 # Place order
+# 兩階段結帳：下單只保留庫存（Created + hold_expires_at）並立即回傳，
+# 付款另外由 confirm_payment 確認；逾時未付款由 HOLDS 取消並放回庫存
 # =========================================================
+HOLDS = HoldSweeper(get_db_connection)
+
+
 def handle_place_order(conn, req):
     buyer_no = req.get("student_no")
     item_id = req.get("item_id")
@@ -166,14 +741,8 @@ def handle_place_order(conn, req):
     try:
         with conn:
             with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    SELECT seller_student_no, price, quantity, status
-                    FROM items
-                    WHERE item_id=%s FOR UPDATE
-                """,
-                    (item_id,),
-                )
+                # 熱路徑：statement 已在這條連線 PREPARE 過，只送 EXECUTE
+                execute_prepared(cur, "po_lock_item", (item_id,))
                 row = cur.fetchone()
 
                 if not row:
@@ -189,58 +758,122 @@ def handle_place_order(conn, req):
 
                 total_amount = price * qty
 
-                cur.execute(
-                    """
-                    INSERT INTO orders (
-                        buyer_student_no, seller_student_no,
-                        order_type, status, total_amount,
-                        consignee_name, consignee_phone, shipping_address,
-                        created_at, paid_at
-                    )
-                    SELECT %s, %s, 'direct', 'Paid', %s,
-                           full_name, phone, '校內面交',
-                           NOW(), NOW()
-                    FROM users WHERE student_no=%s
-                    RETURNING order_id
-                """,
-                    (buyer_no, seller_no, total_amount, buyer_no),
+                execute_prepared(
+                    cur, "po_insert_order", (buyer_no, seller_no, total_amount, HOLD_SECONDS)
                 )
-                order_id = cur.fetchone()[0]
+                order_id, hold_expires_at = cur.fetchone()
 
-                cur.execute(
-                    """
-                    INSERT INTO order_items (order_id, item_id, qty, price_each, title_snapshot)
-                    SELECT %s, item_id, %s, price, title FROM items WHERE item_id=%s
-                """,
-                    (order_id, qty, item_id),
-                )
+                execute_prepared(cur, "po_insert_order_item", (order_id, qty, item_id))
+                execute_prepared(cur, "po_insert_payment", (order_id, total_amount))
+
+                new_stock = stock - qty
+                new_status = "SoldOut" if new_stock == 0 else "Listed"
+                execute_prepared(cur, "po_update_stock", (new_stock, new_status, item_id))
+
+                emit_event(cur, "order.placed", "order", order_id, {
+                    "order_id": order_id,
+                    "buyer_student_no": buyer_no,
+                    "seller_student_no": seller_no,
+                    "item_id": item_id,
+                    "qty": qty,
+                    "total_amount": float(total_amount),
+                    "item_status": new_status,
+                    "status": "Created",
+                })
+
+        TRENDING.record_order(item_id)
+
+        return {
+            "status": "ok",
+            "order_id": order_id,
+            "total_amount": float(total_amount),
+            "hold_expires_at": serialize_value(hold_expires_at),
+        }
+
+    except QueryCanceledError:
+        raise
+    except Exception as e:
+        return {"status": "fail", "message": f"下單失敗：{e}"}
 
+
+# =========================================================
+# Confirm payment
+# 只把付款標記為已送出並叫醒 PAYMENTS，金流呼叫在背景 worker，
+# 結果（Paid / Cancelled）由 my_orders 或即時通知得知
+# =========================================================
+PAYMENTS = PaymentWorker(
+    get_db_connection,
+    SimulatedGateway(
+        latency_ms=PAYMENT_GATEWAY_LATENCY_MS,
+        failure_rate=PAYMENT_GATEWAY_FAILURE_RATE,
+    ),
+    workers=PAYMENT_WORKERS,
+    metrics=METRICS,
+)
+
+
+def handle_confirm_payment(conn, req):
+    buyer_no = req.get("student_no")
+    order_id = req.get("order_id")
+
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                # 鎖住訂單與付款：和 sweeper / worker 互斥（兩者都用 SKIP LOCKED 會跳過這筆）
                 cur.execute(
                     """
-                    INSERT INTO payments (order_id, method, amount, status, txn_ref, paid_at)
-                    VALUES (%s, 'credit_card', %s, 'Success', %s, NOW())
+                    SELECT o.status, o.buyer_student_no, o.hold_expires_at < NOW(),
+                           p.status, p.next_attempt_at IS NOT NULL, p.last_error
+                    FROM orders o
+                    JOIN payments p ON p.order_id = o.order_id
+                    WHERE o.order_id=%s
+                    FOR UPDATE
                 """,
-                    (order_id, total_amount, f"TXN-{order_id:06d}"),
+                    (order_id,),
                 )
+                row = cur.fetchone()
+
+                if not row:
+                    return {"status": "fail", "message": "找不到訂單"}
+
+                status, buyer_db, expired, pay_status, submitted, last_error = row
+                if buyer_db != buyer_no:
+                    return {"status": "fail", "message": "此訂單非你的"}
+
+                # 重送同一個確認不重複扣款
+                if status == "Paid":
+                    return {"status": "ok", "order_id": order_id,
+                            "payment_status": pay_status, "message": "訂單已付款"}
+
+                if status != "Created":
+                    message = f"訂單狀態為 {status}，無法付款"
+                    if last_error:
+                        message += f"（{last_error}）"
+                    return {"status": "fail", "message": message}
+
+                if submitted:
+                    return {"status": "ok", "order_id": order_id,
+                            "payment_status": pay_status, "message": "付款處理中"}
+
+                if expired:
+                    return {"status": "fail", "message": "保留時間已過，請重新下單"}
 
-                new_stock = stock - qty
-                new_status = "SoldOut" if new_stock == 0 else "Listed"
                 cur.execute(
                     """
-                    UPDATE items SET quantity=%s, status=%s, updated_at=NOW()
-                    WHERE item_id=%s
+                    UPDATE payments SET next_attempt_at=NOW()
+                    WHERE order_id=%s AND status='Pending'
                 """,
-                    (new_stock, new_status, item_id),
+                    (order_id,),
                 )
 
-        return {
-            "status": "ok",
-            "order_id": order_id,
-            "total_amount": float(total_amount),
-        }
+        PAYMENTS.wake()
+        return {"status": "ok", "order_id": order_id,
+                "payment_status": "Pending", "message": "付款處理中"}
 
+    except QueryCanceledError:
+        raise
     except Exception as e:
-        return {"status": "fail", "message": f"下單失敗：{e}"}
+        return {"status": "fail", "message": f"付款失敗：{e}"}
 
 
 # =========================================================
@@ -249,19 +882,13 @@ def handle_place_order(conn, req):
 def handle_my_orders(conn, req):
     student_no = req.get("student_no")
 
+    etag = cache_etag(conn, [("orders", student_no), ("ratings", "*"), ("users", "*")])
+    cached = not_modified(req, etag)
+    if cached:
+        return cached
+
     with conn.cursor() as cur:
-        cur.execute(
-            """
-            SELECT o.order_id, o.status, o.total_amount,
-                   u.full_name AS seller_name,
-                   o.created_at, o.paid_at, o.shipped_at, o.completed_at
-            FROM orders o
-            JOIN users u ON u.student_no=o.seller_student_no
-            WHERE o.buyer_student_no=%s
-            ORDER BY o.created_at DESC
-        """,
-            (student_no,),
-        )
+        execute_prepared(cur, "my_orders", (student_no,))
         rows = cur.fetchall()
 
     orders = []
@@ -276,10 +903,13 @@ def handle_my_orders(conn, req):
                 "paid_at": serialize_value(r[5]) if r[5] else None,
                 "shipped_at": serialize_value(r[6]) if r[6] else None,
                 "completed_at": serialize_value(r[7]) if r[7] else None,
+                "seller_rating": float(r[8]) if r[8] is not None else None,
+                "seller_review_count": r[9] or 0,
+                "hold_expires_at": serialize_value(r[10]) if r[10] else None,
             }
         )
 
-    return {"status": "ok", "orders": orders}
+    return {"status": "ok", "orders": orders, "etag": etag}
 
 
 # =========================================================
@@ -367,8 +997,17 @@ def handle_ship_order(conn, req):
                     (order_id, carrier, tracking_no),
                 )
 
+                emit_event(cur, "order.shipped", "order", order_id, {
+                    "order_id": order_id,
+                    "seller_student_no": seller_no,
+                    "carrier": carrier,
+                    "tracking_no": tracking_no,
+                })
+
         return {"status": "ok", "message": "成功出貨"}
 
+    except QueryCanceledError:
+        raise
     except Exception as e:
         return {"status": "fail", "message": f"出貨失敗：{e}"}
 
@@ -467,8 +1106,34 @@ def handle_create_review(conn, req):
                     (order_id, buyer_no, seller_db, rating, comment),
                 )
 
+                # 同一交易內更新賣家評價彙總（seller_ratings）
+                cur.execute(
+                    """
+                    INSERT INTO seller_ratings (seller_student_no, review_count,
+                                                rating_sum, avg_rating, last_review_at)
+                    VALUES (%s, 1, %s, %s, NOW())
+                    ON CONFLICT (seller_student_no)
+                    DO UPDATE SET review_count   = seller_ratings.review_count + 1,
+                                  rating_sum     = seller_ratings.rating_sum + EXCLUDED.rating_sum,
+                                  avg_rating     = ROUND(
+                                      (seller_ratings.rating_sum + EXCLUDED.rating_sum)::NUMERIC
+                                      / (seller_ratings.review_count + 1), 2),
+                                  last_review_at = EXCLUDED.last_review_at
+                """,
+                    (seller_db, rating, rating),
+                )
+
+                emit_event(cur, "review.created", "order", order_id, {
+                    "order_id": order_id,
+                    "rater_student_no": buyer_no,
+                    "ratee_student_no": seller_db,
+                    "rating": rating,
+                })
+
         return {"status": "ok", "message": "評價成功"}
 
+    except QueryCanceledError:
+        raise
     except Exception as e:
         return {"status": "fail", "message": f"評價失敗：{e}"}
 
@@ -520,12 +1185,182 @@ def handle_add_item(conn, req):
                 )
                 item_id = cur.fetchone()[0]
 
+                emit_event(cur, "item.added", "item", item_id, {
+                    "item_id": item_id,
+                    "seller_student_no": seller_no,
+                    "category_id": category_id,
+                    "title": title,
+                    "quantity": quantity,
+                    "price": price,
+                })
+
         return {"status": "ok", "message": f"成功上架（ID={item_id}）"}
 
+    except QueryCanceledError:
+        raise
     except Exception as e:
         return {"status": "fail", "message": f"新增商品失敗：{e}"}
 
 
+# =========================================================
+# Auctions（出價在記憶體 + WAL，結標時才寫回 DB）
+# =========================================================
+AUCTIONS = AuctionEngine(get_db_connection)
+
+AUCTION_MIN_MINUTES = 1
+AUCTION_MAX_MINUTES = 7 * 24 * 60
+
+
+def handle_create_auction(conn, req):
+    """開拍時先從庫存保留 1 件，流標再放回"""
+    seller_no = req.get("student_no")
+    item_id = req.get("item_id")
+
+    try:
+        start_price = Decimal(str(req.get("start_price")))
+        min_increment = Decimal(str(req.get("min_increment") or 1))
+        minutes = int(req.get("duration_minutes") or 60)
+        if not (start_price.is_finite() and min_increment.is_finite()):
+            raise ValueError
+    except Exception:
+        return {"status": "fail", "message": "起標價 / 加價幅度 / 時間格式錯誤"}
+
+    if start_price < 0 or min_increment <= 0:
+        return {"status": "fail", "message": "起標價或加價幅度不合法"}
+    if not AUCTION_MIN_MINUTES <= minutes <= AUCTION_MAX_MINUTES:
+        return {"status": "fail", "message": f"拍賣時間需介於 {AUCTION_MIN_MINUTES} 到 {AUCTION_MAX_MINUTES} 分鐘"}
+
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT seller_student_no, quantity, status
+                    FROM items
+                    WHERE item_id=%s FOR UPDATE
+                """,
+                    (item_id,),
+                )
+                row = cur.fetchone()
+                if not row:
+                    return {"status": "fail", "message": "找不到商品"}
+
+                owner, stock, status = row
+                if owner != seller_no:
+                    return {"status": "fail", "message": "只能拍賣自己的商品"}
+                if status != "Listed" or stock <= 0:
+                    return {"status": "fail", "message": "商品已下架或無庫存"}
+
+                cur.execute(
+                    """
+                    UPDATE items
+                    SET quantity=quantity - 1,
+                        status=CASE WHEN quantity - 1 = 0 THEN 'SoldOut' ELSE status END,
+                        updated_at=NOW()
+                    WHERE item_id=%s
+                """,
+                    (item_id,),
+                )
+                cur.execute(
+                    """
+                    INSERT INTO auctions (item_id, seller_student_no, start_price, min_increment, ends_at)
+                    VALUES (%s, %s, %s, %s, NOW() + make_interval(mins => %s))
+                    RETURNING auction_id
+                """,
+                    (item_id, seller_no, start_price, min_increment, minutes),
+                )
+                auction_id = cur.fetchone()[0]
+
+                emit_event(cur, "auction.created", "auction", auction_id, {
+                    "auction_id": auction_id,
+                    "item_id": item_id,
+                    "seller_student_no": seller_no,
+                    "start_price": float(start_price),
+                    "duration_minutes": minutes,
+                })
+
+        auction = AUCTIONS.open(auction_id, item_id, seller_no, start_price, min_increment, minutes * 60)
+        return {"status": "ok", "message": f"開始拍賣（ID={auction_id}）", "auction": auction}
+
+    except QueryCanceledError:
+        raise
+    except Exception as e:
+        return {"status": "fail", "message": f"建立拍賣失敗：{e}"}
+
+
+def handle_place_bid(req):
+    try:
+        auction_id = int(req.get("auction_id"))
+    except (TypeError, ValueError):
+        return {"status": "fail", "message": "需指定 auction_id"}
+
+    try:
+        auction = AUCTIONS.place_bid(auction_id, req.get("student_no"), req.get("amount"))
+    except BidRejected as e:
+        METRICS.incr("auction.bid_rejected")
+        return {"status": "fail", "message": str(e)}
+
+    METRICS.incr("auction.bids")
+    return {"status": "ok", "auction": auction}
+
+
+def handle_auction_status(conn, req):
+    """不帶 auction_id：列出進行中的拍賣；帶 id：進行中讀記憶體，已結標讀 DB"""
+    if req.get("auction_id") is None:
+        return {"status": "ok", "auctions": AUCTIONS.open_auctions()}
+    try:
+        auction_id = int(req.get("auction_id"))
+    except (TypeError, ValueError):
+        return {"status": "fail", "message": "auction_id 格式錯誤"}
+
+    live = AUCTIONS.snapshot(auction_id)
+    if live is not None:
+        return {"status": "ok", "auction": live}
+
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(
+            """
+            SELECT a.auction_id, a.item_id, a.seller_student_no, a.status,
+                   a.final_price AS current_price, a.winner_student_no AS high_bidder,
+                   a.order_id, a.closed_at,
+                   (SELECT COUNT(*) FROM auction_bids b WHERE b.auction_id=a.auction_id) AS bid_count
+            FROM auctions a
+            WHERE a.auction_id=%s
+        """,
+            (auction_id,),
+        )
+        row = cur.fetchone()
+
+    if row is None:
+        return {"status": "fail", "message": "找不到拍賣"}
+    return {"status": "ok", "auction": serialize_rows([row])[0]}
+
+
+# =========================================================
+# Recommendations（記憶體共現索引，不碰 DB）
+# =========================================================
+RECOMMENDER = Recommender(get_read_connection)
+
+
+def handle_recommend_items(req):
+    item_id = req.get("item_id")
+    student_no = req.get("student_no")
+
+    try:
+        limit = max(1, min(int(req.get("limit") or 10), 50))
+        item_id = int(item_id) if item_id is not None else None
+    except Exception:
+        return {"status": "fail", "message": "item_id / limit 格式錯誤"}
+
+    if item_id is None and not student_no:
+        return {"status": "fail", "message": "需指定 item_id 或 student_no"}
+
+    return {
+        "status": "ok",
+        "items": RECOMMENDER.recommend(item_id=item_id, student_no=student_no, limit=limit),
+    }
+
+
 # ================================
 # Admin SQL / NoSQL Analytics
 # ================================
@@ -548,225 +1383,765 @@ def check_admin(db_conn, req):
 
 
 # -------- SQL Analytics ---------
-def analytics_category_revenue(conn):
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(
-            """
-            SELECT c.name AS category,
-                   SUM(oi.qty * oi.price_each) AS revenue
-            FROM orders o
-            JOIN order_items oi ON oi.order_id=o.order_id
-            JOIN items i ON i.item_id=oi.item_id
-            JOIN categories c ON c.category_id=i.category_id
-            WHERE o.status='Completed'
-            GROUP BY c.name
-            ORDER BY revenue DESC
-        """
-        )
-        rows = cur.fetchall()
-    return {"status": "ok", "data": serialize_rows(rows)}
+# 選用的 DuckDB 快照；沒裝 duckdb 時退回 Postgres
+OLAP = None
+if ANALYTICS_BACKEND == "duckdb":
+    if duckdb is None:
+        print("[OLAP] ANALYTICS_BACKEND=duckdb 但未安裝 duckdb，報表改走 Postgres")
+    else:
+        OLAP = OlapStore(get_read_connection, interval=OLAP_SYNC_SECONDS)
 
 
-def analytics_monthly_revenue(conn):
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(
+def analytics_window(conn, req, partitioned=True):
+    """
+    解析報表參數；category_id 換成子樹 pattern（不合法時丟 ValueError）。
+    partitioned：報表會按月分段，區間過長在這裡就先擋下（匯出不分段）。
+    """
+    window = Window.from_request(req)
+    if partitioned:
+        window.partitions()
+    if window.category_id is not None:
+        path = get_category_path(conn, window.category_id)
+        if path is None:
+            raise ValueError("找不到分類")
+        window.category_pattern = subtree_pattern(path)
+    return window
+
+
+def run_report(conn, sql, window):
+    """DuckDB 快照就緒就整段在本機跑（不需要切段），否則在 Postgres 按月分段平行跑"""
+    if OLAP is not None and OLAP.ready:
+        METRICS.incr("olap.queries")
+        return OLAP.query(sql, window.params(window.start, window.end)), 1
+    return AGGREGATOR.run(conn, sql, window)
+
+
+def analytics_category_revenue(conn, window):
+    rows, n_parts = run_report(
+        conn,
+        f"""
+        SELECT c.name AS category,
+               SUM(oi.qty * oi.price_each) AS revenue
+        FROM orders o
+        JOIN order_items oi ON oi.order_id=o.order_id
+        JOIN items i ON i.item_id=oi.item_id
+        JOIN categories c ON c.category_id=i.category_id
+        WHERE o.status='Completed'
+              {window.where("o.paid_at", "o.seller_student_no", path_col="c.path")}
+        GROUP BY c.name
+    """,
+        window,
+    )
+    rows = merge_rows(rows, ["category"], sums=["revenue"])
+    rows.sort(key=lambda r: r["revenue"], reverse=True)
+    return {"status": "ok", "data": serialize_rows(rows), "window": window.describe(n_parts)}
+
+
+def analytics_monthly_revenue(conn, window):
+    """依 granularity 分期；週的邊界可能跨月，各段同一期的部分和直接相加"""
+    rows, n_parts = run_report(
+        conn,
+        f"""
+        SELECT DATE_TRUNC(%(granularity)s, o.paid_at) AS period,
+               SUM(o.total_amount) AS revenue,
+               COUNT(*) AS order_count
+        FROM orders o
+        WHERE o.status='Completed'
+              {window.where("o.paid_at", "o.seller_student_no", order_col="o.order_id")}
+        GROUP BY period
+    """,
+        window,
+    )
+    rows = merge_rows(rows, ["period"], sums=["revenue", "order_count"])
+    for r in rows:
+        r["avg_order_value"] = ratio(r["revenue"], r["order_count"])
+    rows.sort(key=lambda r: r["period"])
+    return {"status": "ok", "data": serialize_rows(rows), "window": window.describe(n_parts)}
+
+
+def analytics_seller_rating(conn, window):
+    if not window.filtered:
+        # 全期間：直接讀 seller_ratings 彙總表
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                """
+                SELECT seller_student_no AS seller,
+                       avg_rating,
+                       review_count,
+                       last_review_at
+                FROM seller_ratings
+                ORDER BY avg_rating DESC, review_count DESC
             """
-            SELECT DATE_TRUNC('month', paid_at) AS month,
-                   SUM(total_amount) AS revenue
-            FROM orders
-            WHERE status='Completed'
-            GROUP BY month
-            ORDER BY month
-        """
-        )
-        rows = cur.fetchall()
-    return {"status": "ok", "data": serialize_rows(rows)}
+            )
+            rows = cur.fetchall()
+        return {"status": "ok", "data": serialize_rows(rows), "window": window.describe(1)}
+
+    rows, n_parts = run_report(
+        conn,
+        f"""
+        SELECT r.ratee_student_no AS seller,
+               SUM(r.rating) AS rating_sum,
+               COUNT(*) AS review_count,
+               MAX(r.created_at) AS last_review_at
+        FROM reviews r
+        WHERE TRUE
+              {window.where("r.created_at", "r.ratee_student_no", order_col="r.order_id")}
+        GROUP BY r.ratee_student_no
+    """,
+        window,
+    )
+    rows = merge_rows(rows, ["seller"], sums=["rating_sum", "review_count"],
+                      maxes=["last_review_at"])
+    data = [
+        {
+            "seller": r["seller"],
+            "avg_rating": ratio(r["rating_sum"], r["review_count"]),
+            "review_count": r["review_count"],
+            "last_review_at": r["last_review_at"],
+        }
+        for r in rows
+    ]
+    data.sort(key=lambda r: (r["avg_rating"], r["review_count"]), reverse=True)
+    return {"status": "ok", "data": serialize_rows(data), "window": window.describe(n_parts)}
+
+
+def analytics_top_items(conn, window):
+    # 每段要回傳完整的 item 計數，合併後才能取 Top N
+    rows, n_parts = run_report(
+        conn,
+        f"""
+        SELECT oi.item_id, i.title, SUM(oi.qty) AS total_sold
+        FROM orders o
+        JOIN order_items oi ON oi.order_id=o.order_id
+        JOIN items i ON i.item_id=oi.item_id
+        LEFT JOIN categories c ON c.category_id=i.category_id
+        WHERE TRUE
+              {window.where("o.created_at", "o.seller_student_no", path_col="c.path")}
+        GROUP BY oi.item_id, i.title
+    """,
+        window,
+    )
+    rows = merge_rows(rows, ["item_id"], sums=["total_sold"])
+    rows.sort(key=lambda r: r["total_sold"], reverse=True)
+    return {
+        "status": "ok",
+        "data": serialize_rows(rows[: window.limit or 10]),
+        "window": window.describe(n_parts),
+    }
 
 
-def analytics_seller_rating(conn):
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(
-            """
-            SELECT ratee_student_no AS seller,
-                   AVG(rating) AS avg_rating,
-                   COUNT(*) AS review_count
-            FROM reviews
-            GROUP BY ratee_student_no
-            ORDER BY avg_rating DESC
-        """
+# -------- NoSQL analytics ----------
+def nosql_mobile_views(conn, window):
+    # 每段各取最新 N 筆，合併後再取一次
+    limit = window.limit or 30
+    rows, n_parts = run_report(
+        conn,
+        f"""
+        SELECT
+            v.student_no,
+            i.title,
+            v.meta->>'device' AS device,
+            v.viewed_at
+        FROM view_logs v
+        JOIN items i ON i.item_id = v.item_id
+        LEFT JOIN categories c ON c.category_id = i.category_id
+        WHERE v.meta->>'device' = 'mobile'
+              {window.where("v.viewed_at", "i.seller_student_no", path_col="c.path")}
+        ORDER BY v.viewed_at DESC
+        LIMIT {limit}
+    """,
+        window,
+    )
+    rows.sort(key=lambda r: r["viewed_at"], reverse=True)
+    return {"status": "ok", "data": serialize_rows(rows[:limit]), "window": window.describe(n_parts)}
+
+
+def nosql_hot_views(conn, window):
+    rows, n_parts = run_report(
+        conn,
+        f"""
+        SELECT i.item_id,
+               i.title,
+               COUNT(*) AS views
+        FROM view_logs v
+        JOIN items i ON i.item_id = v.item_id
+        LEFT JOIN categories c ON c.category_id = i.category_id
+        WHERE TRUE
+              {window.where("v.viewed_at", "i.seller_student_no", path_col="c.path")}
+        GROUP BY i.item_id, i.title
+    """,
+        window,
+    )
+    rows = merge_rows(rows, ["item_id"], sums=["views"])
+    rows.sort(key=lambda r: r["views"], reverse=True)
+    return {
+        "status": "ok",
+        "data": serialize_rows(rows[: window.limit or 10]),
+        "window": window.describe(n_parts),
+    }
+
+
+# -------- Columnar export ----------
+def handle_export_data(window, req):
+    """匯出到伺服器本機的 EXPORT_DIR，回傳檔案路徑與列數"""
+    datasets = req.get("datasets") or list(EXPORT_DATASETS)
+    try:
+        files = export_range(
+            get_read_connection,
+            window,
+            datasets,
+            fmt=req.get("format") or "parquet",
+            statement_timeout_ms=STATEMENT_TIMEOUT_MS["analytics"],
         )
-        rows = cur.fetchall()
-    return {"status": "ok", "data": serialize_rows(rows)}
+    except (ValueError, RuntimeError) as e:
+        return {"status": "fail", "message": str(e)}
 
+    METRICS.incr("export.rows", sum(f["rows"] for f in files))
+    return {"status": "ok", "files": files, "window": window.describe(1)}
 
-def analytics_top_items(conn):
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(
-            """
-            SELECT oi.item_id, i.title, SUM(oi.qty) AS total_sold
-            FROM order_items oi
-            JOIN items i ON i.item_id=oi.item_id
-            GROUP BY oi.item_id, i.title
-            ORDER BY total_sold DESC
-            LIMIT 10
-        """
-        )
-        rows = cur.fetchall()
-    return {"status": "ok", "data": serialize_rows(rows)}
 
+# =========================================================
+# Action routing
+# =========================================================
+def route_action(db_conn, action, req):
+    if action == "login":
+        return handle_login(db_conn, req)
 
-# -------- NoSQL analytics ----------
-def nosql_mobile_views(conn):
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(
-            """
-            SELECT
-                v.student_no,
-                i.title,
-                v.meta->>'device' AS device,
-                v.viewed_at
-            FROM view_logs v
-            JOIN items i ON i.item_id = v.item_id
-            WHERE v.meta->>'device' = 'mobile'
-            ORDER BY v.viewed_at DESC
-            LIMIT 30
-        """
-        )
-        rows = cur.fetchall()
-    return {"status": "ok", "data": serialize_rows(rows)}
+    elif action == "list_items":
+        return handle_list_items(db_conn, req)
 
+    elif action == "list_categories":
+        return handle_list_categories(db_conn, req)
 
-def nosql_hot_views(conn):
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(
-            """
-            SELECT i.title,
-                   COUNT(*) AS views
-            FROM view_logs v
-            JOIN items i ON i.item_id = v.item_id
-            GROUP BY i.title
-            ORDER BY views DESC
-            LIMIT 10
-        """
-        )
-        rows = cur.fetchall()
-    return {"status": "ok", "data": serialize_rows(rows)}
+    elif action == "list_my_selling_items":
+        return handle_list_my_selling_items(db_conn, req)
+
+    elif action == "place_order":
+        return handle_place_order(db_conn, req)
+
+    elif action == "confirm_payment":
+        return handle_confirm_payment(db_conn, req)
+
+    elif action == "my_orders":
+        return handle_my_orders(db_conn, req)
+
+    elif action == "orders_to_ship":
+        return handle_orders_to_ship(db_conn, req)
+
+    elif action == "ship_order":
+        return handle_ship_order(db_conn, req)
+
+    elif action == "pending_reviews":
+        return handle_pending_reviews(db_conn, req)
+
+    elif action == "create_review":
+        return handle_create_review(db_conn, req)
+
+    elif action == "add_item":
+        return handle_add_item(db_conn, req)
+
+    elif action == "recommend_items":
+        return handle_recommend_items(req)
+
+    elif action == "view_item":
+        return handle_view_item(db_conn, req)
+
+    elif action == "trending_items":
+        return handle_trending_items(db_conn, req)
+
+    elif action == "create_auction":
+        return handle_create_auction(db_conn, req)
+
+    elif action == "place_bid":
+        return handle_place_bid(req)
+
+    elif action == "auction_status":
+        return handle_auction_status(db_conn, req)
+
+    # ========== Admin SQL / NoSQL ==========
+    elif action in ANALYTICS_ACTIONS or action == "server_metrics":
+        # ★ Admin 身分驗證（伺服端強制）
+        if not check_admin(db_conn, req):
+            return {"status": "fail", "message": "此功能僅限管理員使用"}
+
+        if action in ANALYTICS_ACTIONS:
+            try:
+                window = analytics_window(db_conn, req, partitioned=action != "export_data")
+            except ValueError as e:
+                return {"status": "fail", "message": str(e)}
+
+        if action == "analytics_category_revenue":
+            return analytics_category_revenue(db_conn, window)
+        elif action == "analytics_monthly_revenue":
+            return analytics_monthly_revenue(db_conn, window)
+        elif action == "analytics_seller_rating":
+            return analytics_seller_rating(db_conn, window)
+        elif action == "analytics_top_items":
+            return analytics_top_items(db_conn, window)
+        elif action == "analytics_category_rollup":
+            return analytics_category_rollup(db_conn, window)
+        elif action == "nosql_mobile_views":
+            return nosql_mobile_views(db_conn, window)
+        elif action == "nosql_hot_views":
+            return nosql_hot_views(db_conn, window)
+        elif action == "export_data":
+            return handle_export_data(window, req)
+        elif action == "server_metrics":
+            return {"status": "ok", "data": METRICS.snapshot()}
+
+    return {"status": "fail", "message": f"未知 action: {action}"}
 
 
 # =========================================================
 # Client handler
 # =========================================================
-def handle_client(socket_conn, addr):
-    db_conn = None
-    try:
-        raw = socket_conn.recv(16384).decode("utf-8")
-        if not raw:
-            return
+def send_json(socket_conn, res):
+    socket_conn.sendall(json.dumps(res, ensure_ascii=False).encode("utf-8"))
+
+
+def to_columnar(res):
+    """list of dict → {"columns": [...], "rows": [[...]]}，欄位名稱只出現一次"""
+    for key in COLUMNAR_KEYS:
+        rows = res.get(key)
+        if isinstance(rows, list) and rows and isinstance(rows[0], dict):
+            columns = list(rows[0].keys())
+            res[key] = {
+                "columns": columns,
+                "rows": [[r.get(c) for c in columns] for r in rows],
+            }
+    res["format"] = "columnar"
+    return res
 
-        req = json.loads(raw)
-        action = req.get("action")
 
-        db_conn = get_db_connection()
+def compress_body(body, accepted):
+    """依 client 的偏好挑第一個支援的編碼；回傳 (encoding, bytes)"""
+    for enc in accepted or ():
+        if enc == "zstd" and zstandard is not None:
+            return enc, zstandard.ZstdCompressor(level=3).compress(body)
+        if enc == "zlib":
+            return enc, zlib.compress(body, 6)
+    return None, body
+
+
+def send_response(socket_conn, res, req):
+    """
+    壓縮時的格式：0x00 + 編碼名稱 + 換行 + 壓縮後的 JSON。
+    JSON 不可能以 0x00 開頭，舊 client 不送 accept_encoding 就永遠拿到純 JSON。
+    """
+    if req.get("format") == "columnar" and res.get("status") == "ok":
+        res = to_columnar(res)
+
+    body = json.dumps(res, ensure_ascii=False).encode("utf-8")
+    METRICS.incr("bytes.raw", len(body))
+
+    if len(body) >= COMPRESS_THRESHOLD:
+        enc, packed = compress_body(body, req.get("accept_encoding"))
+        if enc:
+            body = b"\x00" + enc.encode("ascii") + b"\n" + packed
+
+    METRICS.incr("bytes.sent", len(body))
+    socket_conn.sendall(body)
 
-        # -----------------------
-        # Action Routing
-        # -----------------------
-        if action == "login":
-            res = handle_login(db_conn, req)
 
-        elif action == "list_items":
-            res = handle_list_items(db_conn, req)
+def drain_body(socket_conn):
+    """
+    上傳圖片在收完 body 前就被拒絕（限流、不是自己的商品…）時，
+    直接 close 一個還有未讀資料的 socket 會送出 RST，client 可能連回應都讀不到。
+    回應送出後先關寫入端，再把剩下的 body 讀掉丟棄（有時間與大小上限）。
+    """
+    try:
+        socket_conn.shutdown(socket.SHUT_WR)
+        deadline = time.monotonic() + DRAIN_BODY_SECONDS
+        drained = 0
+        while drained <= MAX_IMAGE_BYTES:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            socket_conn.settimeout(left)
+            chunk = socket_conn.recv(READ_CHUNK)
+            if not chunk:
+                break
+            drained += len(chunk)
+    except OSError:
+        pass
+
+
+# -------- 執行名額 / DB 連線 --------
+class Overloaded(Exception):
+    """分類排隊排不到名額"""
+
+
+def admit(cls):
+    # ★ 分類排隊：analytics 滿了就短暫排隊，排不到直接拒絕，不影響下單
+    if not ADMISSION[cls].acquire(timeout=ADMISSION_WAIT_SECONDS[cls]):
+        METRICS.incr(f"shed.{cls}")
+        raise Overloaded()
+
+
+def acquire_db(action, req, cls):
+    db_conn = ROUTER.acquire(
+        read_only=action in READ_ONLY_ACTIONS,
+        student_no=req.get("student_no"),
+    )
+    try:
+        # 只在這個交易內有效；handler commit / rollback 或歸還連線池時失效
+        with db_conn.cursor() as cur:
+            cur.execute(
+                "SET LOCAL statement_timeout = %s",
+                (STATEMENT_TIMEOUT_MS[cls],),
+            )
+    except Exception:
+        ROUTER.release(db_conn)
+        raise
+    return db_conn
+
 
-        elif action == "list_my_selling_items":
-            res = handle_list_my_selling_items(db_conn, req)
+@contextmanager
+def db_session(action, req):
+    """給分段使用 DB 的 handler：每段各自取得名額與連線，段與段之間不佔"""
+    cls = action_class(action)
+    admit(cls)
+    try:
+        db_conn = acquire_db(action, req, cls)
+        try:
+            yield db_conn
+        finally:
+            ROUTER.release(db_conn)
+    finally:
+        ADMISSION[cls].release()
 
-        elif action == "place_order":
-            res = handle_place_order(db_conn, req)
 
-        elif action == "my_orders":
-            res = handle_my_orders(db_conn, req)
+def handle_client(socket_conn, addr):
+    db_conn = None
+    admitted = None
+    tracked = True          # accept 迴圈已 INFLIGHT.enter()
+    try:
+        socket_conn.settimeout(CLIENT_SOCKET_TIMEOUT)
+        raw = socket_conn.recv(16384)
+        if not raw:
+            return
 
-        elif action == "orders_to_ship":
-            res = handle_orders_to_ship(db_conn, req)
+        # 一般請求就是一段 JSON；上傳圖片是「JSON header + 換行 + binary body」
+        head, _, received = raw.partition(b"\n")
+        req = json.loads(head.decode("utf-8"))
+        action = req.get("action")
 
-        elif action == "ship_order":
-            res = handle_ship_order(db_conn, req)
+        # ★ 速率限制：在佔用執行名額 / DB 連線之前就擋下
+        wait, scope = LIMITER.take(rate_keys(action, req, addr))
+        if wait:
+            METRICS.incr(f"ratelimited.{scope}")
+            retry_after = math.ceil(wait)
+            send_json(socket_conn, {
+                "status": "fail",
+                "message": f"請求過於頻繁，請 {retry_after} 秒後再試",
+                "retry_after": retry_after,
+            })
+            if action in STREAMING_ACTIONS:
+                drain_body(socket_conn)
+            return
 
-        elif action == "pending_reviews":
-            res = handle_pending_reviews(db_conn, req)
+        # 長連線訂閱：不佔 interactive 名額，也不需要 DB 連線
+        if action == "subscribe":
+            if not req.get("student_no"):
+                send_json(socket_conn, {"status": "fail", "message": "需指定 student_no"})
+                return
+            METRICS.incr("subscribe")
+            # 長連線不算進行中請求，drain 時由 NOTIFIER.stop() 關閉
+            INFLIGHT.leave()
+            tracked = False
+            NOTIFIER.serve(req["student_no"], socket_conn)
+            return
 
-        elif action == "create_review":
-            res = handle_create_review(db_conn, req)
+        cls = action_class(action)
+        METRICS.incr(f"requests.{cls}")
 
-        elif action == "add_item":
-            res = handle_add_item(db_conn, req)
+        # 上傳圖片自己分段取用名額與連線（db_session），收檔期間不佔
+        if action not in STREAMING_ACTIONS:
+            admit(cls)
+            admitted = cls
+            if action not in MEMORY_ACTIONS:
+                db_conn = acquire_db(action, req, cls)
 
-        # ========== Admin SQL / NoSQL ==========
-        elif action in [
-            "analytics_category_revenue",
-            "analytics_monthly_revenue",
-            "analytics_seller_rating",
-            "analytics_top_items",
-            "nosql_mobile_views",
-            "nosql_hot_views",
-        ]:
-            # ★ Admin 身分驗證（伺服端強制）
-            if not check_admin(db_conn, req):
-                res = {"status": "fail", "message": "此功能僅限管理員使用"}
+        path = None
+        try:
+            if action == "upload_image":
+                res = handle_upload_image(req, socket_conn, received)
+            elif action == "get_image":
+                res, path = handle_get_image(req)
             else:
-                if action == "analytics_category_revenue":
-                    res = analytics_category_revenue(db_conn)
-                elif action == "analytics_monthly_revenue":
-                    res = analytics_monthly_revenue(db_conn)
-                elif action == "analytics_seller_rating":
-                    res = analytics_seller_rating(db_conn)
-                elif action == "analytics_top_items":
-                    res = analytics_top_items(db_conn)
-                elif action == "nosql_mobile_views":
-                    res = nosql_mobile_views(db_conn)
-                elif action == "nosql_hot_views":
-                    res = nosql_hot_views(db_conn)
-
+                res = route_action(db_conn, action, req)
+        except QueryCanceledError:
+            # 各 handler 自己的 except Exception 會先放行 QueryCanceledError，統一在這裡計數
+            METRICS.incr(f"timeout.{cls}")
+            res = {"status": "fail", "message": "查詢逾時，請稍後再試"}
+        except Overloaded:
+            res = {"status": "fail", "message": "系統忙碌中，請稍後再試", "retry_after": 1}
+
+        if action in WRITE_ACTIONS and res.get("status") == "ok":
+            ROUTER.mark_write(req.get("student_no"))
+
+        if path:
+            send_file(socket_conn, res, path)
         else:
-            res = {"status": "fail", "message": f"未知 action: {action}"}
-
-        socket_conn.send(json.dumps(res, ensure_ascii=False).encode("utf-8"))
+            send_response(socket_conn, res, req)
+            if action in STREAMING_ACTIONS:
+                drain_body(socket_conn)
 
     except Exception as e:
         try:
-            socket_conn.send(
-                json.dumps(
-                    {"status": "fail", "message": f"Server error: {e}"},
-                    ensure_ascii=False,
-                ).encode("utf-8")
-            )
+            send_json(socket_conn, {"status": "fail", "message": f"Server error: {e}"})
         except Exception:
             pass
     finally:
+        if admitted:
+            ADMISSION[admitted].release()
         if db_conn:
-            db_conn.close()
+            ROUTER.release(db_conn)
         socket_conn.close()
+        if tracked:
+            INFLIGHT.leave()
 
 
 # =========================================================
 # Main Server
 # =========================================================
-def main():
-    print(f"[SERVER] Running on {HOST}:{PORT}")
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind((HOST, PORT))
-    s.listen(5)
+def log_event(ev):
+    print(f"[EVENT] {ev['event_type']} {ev['aggregate_type']}#{ev['aggregate_id']}")
+
 
+# -------- Graceful drain / 熱重啟 --------
+# SIGTERM / SIGINT：停止 accept → 等進行中請求做完（最多 DRAIN_SECONDS）→ 停止並 flush 背景服務 → 結束
+# SIGHUP / SIGUSR2：同樣 drain 後，把 listening socket 交給新起的 server 行程（熱重啟）；
+#   交接期間新連線在 kernel backlog 排隊，不會被拒絕
+# 拍賣簿 / WAL、trending 計數都在記憶體，兩個行程不能同時服務，所以是先 drain 再交接；
+#   交接失敗時殺掉新行程、重新啟動背景服務，由原行程繼續 accept
+# 交接期間沒有人 accept（drain + 停服務 + 新行程啟動），client.REQUEST_TIMEOUT（15 秒）內要能接手，
+#   所以熱重啟的 drain 比正常關機短，實際空窗時間會印在 log 上
+LISTEN_BACKLOG = 128
+ACCEPT_POLL_SECONDS = 0.5
+DRAIN_SECONDS = 30
+RESTART_DRAIN_SECONDS = 5       # 熱重啟只等 interactive（statement_timeout 3 秒）做完；更久的報表請求會被中斷
+HANDOFF_READY_SECONDS = 15
+SD_LISTEN_FDS_START = 3         # systemd socket activation 的第一個 fd
+
+SHUTDOWN = {"mode": None}       # None / "stop" / "restart"
+
+
+class InFlight:
+    """進行中請求計數；drain 時等它歸零"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.count = 0
+
+    def enter(self):
+        with self._cond:
+            self.count += 1
+
+    def leave(self):
+        with self._cond:
+            self.count -= 1
+            if self.count == 0:
+                self._cond.notify_all()
+
+    def wait_idle(self, timeout):
+        """回傳逾時後仍未完成的請求數"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self.count
+
+
+INFLIGHT = InFlight()
+
+
+def inherited_sockets():
+    """
+    回傳 (主 socket, feed socket)，沒有繼承到的是 None。
+    LISTEN_FD / FEED_FD：上一個 server 行程 handoff 時傳下來的；
+    LISTEN_FDS：systemd socket activation（第 1 個是主 port，第 2 個是 feed）。
+    """
+    fds = []
+    if "LISTEN_FD" in os.environ:
+        fds = [int(os.environ.pop("LISTEN_FD"))]
+        if "FEED_FD" in os.environ:
+            fds.append(int(os.environ.pop("FEED_FD")))
+    elif os.environ.get("LISTEN_PID") == str(os.getpid()):
+        n = int(os.environ.get("LISTEN_FDS", "0"))
+        fds = list(range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + min(n, 2)))
+    for key in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"):
+        os.environ.pop(key, None)
+
+    socks = [socket.socket(fileno=fd) for fd in fds]
+    return (socks + [None, None])[:2]
+
+
+def listen_socket(sock=None):
+    if sock is None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((HOST, PORT))
+        sock.listen(LISTEN_BACKLOG)
+    else:
+        print(f"[SERVER] Inherited listening socket fd={sock.fileno()}")
+    # 用 timeout 輪詢 accept，才能在收到 signal 後跳出迴圈
+    sock.settimeout(ACCEPT_POLL_SECONDS)
+    return sock
+
+
+def notify_ready():
+    """告訴交接的上一個行程：服務都起來了，可以結束"""
+    fd = os.environ.pop("READY_FD", None)
+    if fd is not None:
+        os.write(int(fd), b"ready\n")
+        os.close(int(fd))
+
+
+def on_signal(signum, frame):
+    if SHUTDOWN["mode"] is not None:
+        # drain 中再收到一次 SIGTERM / SIGINT：不等了
+        if signum in (signal.SIGTERM, signal.SIGINT):
+            print("[SERVER] Forced exit")
+            os._exit(1)
+        return
+    SHUTDOWN["mode"] = "stop" if signum in (signal.SIGTERM, signal.SIGINT) else "restart"
+
+
+def start_services():
+    RECOMMENDER.start()
+    TRENDING.start()
+    AUCTIONS.start()
+    THUMBNAILS.start()
+    HOLDS.start()
+    PAYMENTS.start()
+    if OLAP is not None:
+        OLAP.start()
+
+    NOTIFIER.start()
+
+    OUTBOX.subscribe("server-log", log_event)
+    OUTBOX.start()
+
+
+def stop_services():
+    """先停產生工作的，再停下游；各自 flush 記憶體內還沒寫回的部分"""
+    steps = [
+        ("notifier", NOTIFIER.stop),
+        ("holds", HOLDS.stop),
+        ("payments", PAYMENTS.stop),            # 等進行中的金流呼叫寫回
+        ("auctions", AUCTIONS.stop),            # WAL fsync + close
+        ("thumbnails", THUMBNAILS.stop),
+        ("trending", TRENDING.stop),            # 最後一次 checkpoint
+        ("recommender", RECOMMENDER.stop),
+        ("outbox", OUTBOX.stop),
+        ("server-log", lambda: OUTBOX.unsubscribe("server-log")),
+    ]
+    if OLAP is not None:
+        steps.append(("olap", OLAP.stop))
+    for name, stop in steps:
+        try:
+            stop()
+        except Exception as e:
+            print(f"[SERVER] stop {name} failed:", e)
+
+
+def hand_off(sockets):
+    """
+    以同樣的命令列起新的 server 行程，listening socket 以 pass_fds 傳下去，
+    等新行程回報 ready 才回傳 True。
+    """
+    ready_r, ready_w = os.pipe()
+    env = dict(os.environ, READY_FD=str(ready_w), LISTEN_FD=str(sockets[0].fileno()))
+    if len(sockets) > 1:
+        env["FEED_FD"] = str(sockets[1].fileno())
+    fds = [s.fileno() for s in sockets] + [ready_w]
+
+    child = subprocess.Popen([sys.executable] + sys.argv, env=env, pass_fds=fds)
+    os.close(ready_w)
     try:
-        while True:
-            client, addr = s.accept()
+        readable, _, _ = select.select([ready_r], [], [], HANDOFF_READY_SECONDS)
+        ok = bool(readable) and os.read(ready_r, 16).startswith(b"ready")
+    finally:
+        os.close(ready_r)
+    if ok:
+        print(f"[SERVER] Handed off to pid {child.pid}")
+    else:
+        # 還沒 ready 的新行程不能留著：之後若起來會和原行程同時服務
+        child.kill()
+        print(f"[SERVER] Handoff failed (pid {child.pid} exit={child.wait()})")
+    return ok
+
+
+def main():
+    listen_sock, feed_sock = inherited_sockets()
+    s = listen_socket(listen_sock)
+    print(f"[SERVER] Running on {HOST}:{PORT} (pid {os.getpid()})")
+
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR2):
+        signal.signal(signum, on_signal)
+
+    resuming = False
+    while True:
+        try:
+            start_services()
+        except Exception as e:
+            if not resuming:
+                raise
+            # 例如 outbox 上一輪的投遞還沒結束：寧可停機，也不讓兩份背景服務同時跑
+            print("[SERVER] Cannot resume service:", e)
+            stop_services()
+            code = 1
+            break
+        feed_sock, feed_thread = serve_feed(OUTBOX, sock=feed_sock)
+        notify_ready()
+
+        while SHUTDOWN["mode"] is None:
+            try:
+                client, addr = s.accept()
+            except (socket.timeout, InterruptedError):
+                continue
             print("[SERVER] Client connected:", addr)
+            INFLIGHT.enter()
             threading.Thread(
                 target=handle_client, args=(client, addr), daemon=True
             ).start()
-    finally:
-        s.close()
+
+        mode = SHUTDOWN["mode"]
+        stopped_at = time.monotonic()
+        print(f"[SERVER] Draining {INFLIGHT.count} in-flight request(s) ({mode})")
+        left = INFLIGHT.wait_idle(RESTART_DRAIN_SECONDS if mode == "restart" else DRAIN_SECONDS)
+        if left:
+            print(f"[SERVER] Drain deadline reached, {left} request(s) aborted")
+        drained_at = time.monotonic()
+
+        stop_services()
+        feed_thread.join()
+
+        if mode != "restart":
+            code = 0
+            break
+        stopped = time.monotonic()
+        if hand_off([s, feed_sock]):
+            done = time.monotonic()
+            print(f"[SERVER] Accept gap {done - stopped_at:.1f}s "
+                  f"(drain {drained_at - stopped_at:.1f}s, stop {stopped - drained_at:.1f}s, "
+                  f"new process {done - stopped:.1f}s)")
+            code = 0
+            break
+
+        # 交接失敗：自己繼續服務，listening socket 一直開著，排隊的連線不會掉
+        print("[SERVER] Resuming service")
+        SHUTDOWN["mode"] = None
+        resuming = True
+
+    s.close()
+    feed_sock.close()
+    print("[SERVER] Stopped")
+    sys.exit(code)
 
 
 if __name__ == "__main__":
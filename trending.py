@@ -0,0 +1,224 @@
+# ==========================================
+# NTU Marketplace - Trending Counters
+# 24 小時滑動視窗（5 分鐘一格）的瀏覽 / 下單計數
+# ==========================================
+import heapq
+import threading
+import time
+
+from psycopg2.extras import execute_values
+
+BUCKET_SECONDS = 300            # 每格 5 分鐘
+WINDOW_BUCKETS = 288            # 288 格 = 24 小時
+CHECKPOINT_INTERVAL = 60        # 秒，寫回 trending_buckets 的週期
+ORDER_WEIGHT = 5                # 一筆下單相當於幾次瀏覽
+
+
+class SlidingWindowCounter:
+    """
+    以時間分桶的計數器。
+    _buckets 保存每一格的明細（給 checkpoint 用），
+    _totals 保存整個視窗的加總，查詢時不必再把每一格加起來。
+    """
+
+    def __init__(self, bucket_seconds=BUCKET_SECONDS, window_buckets=WINDOW_BUCKETS):
+        self.bucket_seconds = bucket_seconds
+        self.window_buckets = window_buckets
+        self._lock = threading.Lock()
+        self._buckets = {}      # bucket_epoch -> {item_id: [views, orders]}
+        self._totals = {}       # item_id -> [views, orders]
+        self._dirty = set()     # (bucket_epoch, item_id)，尚未寫回 DB
+        self._oldest = None
+
+    def _bucket_of(self, ts):
+        return int(ts) // self.bucket_seconds * self.bucket_seconds
+
+    def _expire(self, now_bucket):
+        cutoff = now_bucket - (self.window_buckets - 1) * self.bucket_seconds
+        if self._oldest is not None and self._oldest >= cutoff:
+            return
+
+        for b in [b for b in self._buckets if b < cutoff]:
+            for item_id, (views, orders) in self._buckets.pop(b).items():
+                total = self._totals[item_id]
+                total[0] -= views
+                total[1] -= orders
+                if total[0] <= 0 and total[1] <= 0:
+                    del self._totals[item_id]
+                self._dirty.discard((b, item_id))
+
+        self._oldest = min(self._buckets) if self._buckets else None
+
+    def record(self, item_id, views=0, orders=0, ts=None):
+        now = time.time()
+        bucket = self._bucket_of(ts if ts is not None else now)
+
+        with self._lock:
+            self._expire(self._bucket_of(now))
+            if bucket < self._bucket_of(now) - (self.window_buckets - 1) * self.bucket_seconds:
+                return
+
+            cell = self._buckets.setdefault(bucket, {}).setdefault(item_id, [0, 0])
+            cell[0] += views
+            cell[1] += orders
+
+            total = self._totals.setdefault(item_id, [0, 0])
+            total[0] += views
+            total[1] += orders
+
+            self._dirty.add((bucket, item_id))
+            if self._oldest is None or bucket < self._oldest:
+                self._oldest = bucket
+
+    def top(self, k, order_weight=ORDER_WEIGHT):
+        with self._lock:
+            self._expire(self._bucket_of(time.time()))
+            best = heapq.nlargest(
+                k,
+                self._totals.items(),
+                key=lambda kv: kv[1][0] + order_weight * kv[1][1],
+            )
+        return [
+            {
+                "item_id": item_id,
+                "views": views,
+                "orders": orders,
+                "score": views + order_weight * orders,
+            }
+            for item_id, (views, orders) in best
+        ]
+
+    def drain_dirty(self):
+        """取出需要 checkpoint 的格子（絕對值，重複寫入也不會錯）"""
+        with self._lock:
+            rows = [
+                (b, item_id, *self._buckets[b][item_id])
+                for b, item_id in self._dirty
+            ]
+            self._dirty.clear()
+        return rows
+
+    def restore_dirty(self, rows):
+        with self._lock:
+            for b, item_id, _, _ in rows:
+                if b in self._buckets:
+                    self._dirty.add((b, item_id))
+
+    def load(self, rows):
+        """
+        從 checkpoint 還原：checkpoint 存的是每格的絕對值，直接設定而不是累加，
+        重複載入也不會把計數加倍。還沒寫回的格子（dirty）只含即時事件，才把兩者相加。
+        """
+        now_bucket = self._bucket_of(time.time())
+        cutoff = now_bucket - (self.window_buckets - 1) * self.bucket_seconds
+        with self._lock:
+            self._expire(now_bucket)
+            for b, item_id, views, orders in rows:
+                if b < cutoff:
+                    continue
+                cell = self._buckets.setdefault(b, {}).setdefault(item_id, [0, 0])
+                if (b, item_id) in self._dirty:
+                    new_views, new_orders = cell[0] + views, cell[1] + orders
+                else:
+                    new_views, new_orders = views, orders
+                total = self._totals.setdefault(item_id, [0, 0])
+                total[0] += new_views - cell[0]
+                total[1] += new_orders - cell[1]
+                cell[0], cell[1] = new_views, new_orders
+                if self._oldest is None or b < self._oldest:
+                    self._oldest = b
+
+
+class TrendingService:
+    """計數器 + 背景 checkpoint 執行緒"""
+
+    def __init__(self, connect, interval=CHECKPOINT_INTERVAL):
+        self._connect = connect
+        self.interval = interval
+        self.counter = SlidingWindowCounter()
+        self._restored = False      # 交接失敗重新 start 時不再還原：記憶體裡已是最新計數
+        self._stop = threading.Event()
+        self._thread = None
+
+    def record_view(self, item_id):
+        self.counter.record(item_id, views=1)
+
+    def record_order(self, item_id):
+        self.counter.record(item_id, orders=1)
+
+    def top(self, k):
+        return self.counter.top(k)
+
+    def restore(self):
+        window = WINDOW_BUCKETS * BUCKET_SECONDS
+        conn = self._connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT bucket_epoch, item_id, views, orders
+                    FROM trending_buckets
+                    WHERE bucket_epoch >= %s
+                """,
+                    (int(time.time()) - window,),
+                )
+                rows = cur.fetchall()
+        finally:
+            conn.close()
+        self.counter.load(rows)
+
+    def checkpoint(self):
+        rows = self.counter.drain_dirty()
+        if not rows:
+            return
+
+        cutoff = int(time.time()) - WINDOW_BUCKETS * BUCKET_SECONDS
+        conn = self._connect()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    execute_values(
+                        cur,
+                        """
+                        INSERT INTO trending_buckets (bucket_epoch, item_id, views, orders)
+                        VALUES %s
+                        ON CONFLICT (bucket_epoch, item_id)
+                        DO UPDATE SET views=EXCLUDED.views, orders=EXCLUDED.orders
+                    """,
+                        rows,
+                    )
+                    cur.execute(
+                        "DELETE FROM trending_buckets WHERE bucket_epoch < %s",
+                        (cutoff,),
+                    )
+        except Exception:
+            self.counter.restore_dirty(rows)
+            raise
+        finally:
+            conn.close()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.checkpoint()
+            except Exception as e:
+                print("[TRENDING] checkpoint failed:", e)
+
+    def start(self):
+        # 在開始服務前同步還原，避免和即時事件交錯
+        if not self._restored:
+            try:
+                self.restore()
+                self._restored = True
+            except Exception as e:
+                print("[TRENDING] restore failed:", e)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止背景 checkpoint，並把還沒寫回的計數最後 flush 一次"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.checkpoint()